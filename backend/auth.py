@@ -5,7 +5,9 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from pydantic import BaseModel
+from sqlalchemy import select
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from database import get_db, User, UserRole, get_ist_now
 import os
 from dotenv import load_dotenv
@@ -111,6 +113,18 @@ def authenticate_user(db: Session, username: str, password: str):
         return False
     return user
 
+async def authenticate_user_async(db: AsyncSession, username: str, password: str):
+    """authenticate_user with the bcrypt check run on the password worker pool"""
+    from password_pool import password_pool
+    user = (await db.execute(select(User).where(User.username == username))).scalars().first()
+    if not user:
+        return False
+    # End the read transaction so the connection goes back to the pool while bcrypt runs
+    await db.commit()
+    if not await password_pool.verify(password, user.hashed_password):
+        return False
+    return user
+
 def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -126,9 +140,17 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
     except JWTError:
         raise credentials_exception
     
-    user = db.query(User).filter(User.username == token_data.username).first()
+    from principal_cache import principal_cache
+    user = principal_cache.get(token_data.username)
     if user is None:
-        raise credentials_exception
+        user = db.query(User).filter(User.username == token_data.username).first()
+        if user is None:
+            raise credentials_exception
+        user = principal_cache.put(user)
+    if user.role == UserRole.NURSING:
+        # OPD codes signed into the token spare the access checks a database lookup
+        from opd_access import opd_access_map
+        opd_access_map.seed_from_claims(user.id, payload)
     return user
 
 def get_current_active_user(current_user: User = Depends(get_current_user)):
@@ -168,8 +190,8 @@ def check_opd_access(user: User, opd_code: str, db: Session):
     
     # For nursing staff, check OPD access
     if user.role == UserRole.NURSING:
-        from database import user_has_opd_access
-        if user_has_opd_access(db, user.id, opd_code):
+        from opd_access import opd_access_map
+        if opd_code in opd_access_map.get_allowed(user.id, db):
             return True
         else:
             raise HTTPException(
@@ -183,6 +205,10 @@ def check_opd_access(user: User, opd_code: str, db: Session):
         detail="Your role does not have OPD access"
     )
 
+async def check_opd_access_async(user: User, opd_code: str, db: AsyncSession):
+    """check_opd_access for routes that use an AsyncSession"""
+    return await db.run_sync(lambda session: check_opd_access(user, opd_code, session))
+
 def require_opd_access(opd_code: str):
     """
     Dependency to check if user has access to a specific OPD.
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Login-storm benchmark for the bcrypt worker pool (password_pool.py).
+
+Simulates a shift change: LOGINS sign-ins arriving at once, each verifying a
+real bcrypt hash. For every pool size it reports how long the storm took, the
+per-login latency, how many sign-ins were turned away and the worst event-loop
+stall seen by a 10 ms ticker (what Socket.IO pushes and display polls would
+feel). "inline" is the old behaviour, bcrypt called directly in the handler.
+
+Usage: python bench_login_storm.py [--logins 50] [--workers 1,2,4,8] [--max-waiting 100]
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from fastapi import HTTPException
+from auth import get_password_hash, verify_password
+from password_pool import PasswordHasherPool
+
+TICK_SECONDS = 0.01
+
+
+async def run_storm(logins: int, hashed: str, verify):
+    """Fire `logins` verifications at once; returns (elapsed, latencies, rejected, max loop lag)"""
+    lags = []
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(TICK_SECONDS)
+            lags.append(time.perf_counter() - started - TICK_SECONDS)
+
+    async def login():
+        try:
+            await verify("password", hashed)
+        except HTTPException:
+            return None
+        # Everyone arrived at once, so latency counts from the start of the storm
+        return time.perf_counter() - started
+
+    tick_task = asyncio.create_task(ticker())
+    await asyncio.sleep(TICK_SECONDS)
+    started = time.perf_counter()
+    results = await asyncio.gather(*[login() for _ in range(logins)])
+    elapsed = time.perf_counter() - started
+    done.set()
+    await tick_task
+
+    latencies = sorted(result for result in results if result is not None)
+    return elapsed, latencies, logins - len(latencies), max(lags, default=0.0)
+
+
+def report(label: str, elapsed: float, latencies, rejected: int, max_lag: float):
+    p50 = statistics.median(latencies) if latencies else 0.0
+    p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else 0.0
+    print(f"{label:>8} {elapsed:8.2f}s {p50 * 1000:9.0f}ms {p95 * 1000:9.0f}ms {rejected:9d} {max_lag * 1000:10.1f}ms")
+
+
+async def main(logins: int, worker_counts, max_waiting: int):
+    hashed = get_password_hash("password")
+    started = time.perf_counter()
+    verify_password("password", hashed)
+    print(f"One bcrypt verification: {(time.perf_counter() - started) * 1000:.0f}ms, {os.cpu_count()} CPUs, {logins} logins")
+    print(f"{'workers':>8} {'storm':>9} {'p50':>11} {'p95':>11} {'rejected':>9} {'loop stall':>12}")
+
+    async def verify_inline(password, hashed_password):
+        return verify_password(password, hashed_password)
+
+    report("inline", *await run_storm(logins, hashed, verify_inline))
+    for workers in worker_counts:
+        pool = PasswordHasherPool(workers, max_waiting)
+        try:
+            report(str(workers), *await run_storm(logins, hashed, pool.verify))
+        finally:
+            pool.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure a burst of concurrent sign-ins against the bcrypt pool")
+    parser.add_argument("--logins", type=int, default=50)
+    parser.add_argument("--workers", default="1,2,4,8", help="Comma-separated pool sizes to try")
+    parser.add_argument("--max-waiting", type=int, default=100)
+    args = parser.parse_args()
+    asyncio.run(main(args.logins, [int(count) for count in args.workers.split(",")], args.max_waiting))
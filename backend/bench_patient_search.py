@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Patient search benchmark: the old ILIKE scan against the search index
+(patient_search.py).
+
+Fills a throwaway SQLite database with PATIENTS registrations (400 a day),
+builds the FTS5 index and times both filters on a few typical registration
+desk searches, checking that they return the same rows.
+
+Usage: python bench_patient_search.py [--patients 200000] [--db /tmp/search_bench.db]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+FIRST_NAMES = ["Ramesh", "Suresh", "Anita", "Sunita", "Mahesh", "Kavita", "Rajesh", "Pooja", "Amit", "Neha", "Geeta", "Arjun"]
+LAST_NAMES = ["Kumar", "Sharma", "Verma", "Patil", "Deshmukh", "Gupta", "Rao", "Joshi", "Kulkarni", "Singh"]
+SEARCHES = ["Deshmukh 77", "REG0123456", "20240115-1123", "Kulk"]
+RUNS = 5
+
+
+def main(patients: int, db_path: str):
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    # Must be set before database is imported
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    from sqlalchemy import select
+    from database import Base, engine, SessionLocal, Patient
+    from patient_search import ilike_condition, patient_search
+
+    Base.metadata.create_all(bind=engine)
+    random.seed(1)
+    start = datetime(2023, 1, 1)
+    rows = []
+    for n in range(patients):
+        day = start + timedelta(days=n // 400)
+        rows.append({
+            "registration_number": f"REG{n:07d}",
+            "token_number": f"{day:%Y%m%d}-{1000 + n % 400}",
+            "name": f"{random.choice(FIRST_NAMES)} {random.choice(LAST_NAMES)} {random.randint(1, 999)}",
+            "registration_time": day + timedelta(minutes=n % 400),
+            "current_status": "COMPLETED",
+            "is_dilated": False,
+        })
+    with engine.begin() as conn:
+        conn.execute(Patient.__table__.insert(), rows)
+
+    started = time.perf_counter()
+    patient_search.install()
+    print(f"{patients} patients, index ({patient_search.backend}) built in {time.perf_counter() - started:.2f}s")
+    if patient_search.backend is None:
+        sys.exit("No search index available on this SQLite build")
+
+    db = SessionLocal()
+    try:
+        def timed(condition):
+            query = select(Patient.id).where(condition).order_by(Patient.registration_time.desc())
+            started = time.perf_counter()
+            for _ in range(RUNS):
+                ids = db.execute(query).scalars().all()
+            return (time.perf_counter() - started) / RUNS, set(ids)
+
+        print(f"{'search':>16} {'ILIKE':>10} {'index':>10} {'rows':>6}")
+        for term in SEARCHES:
+            scan_seconds, scan_ids = timed(ilike_condition(term))
+            index_seconds, index_ids = timed(patient_search.condition(term))
+            same = "" if scan_ids == index_ids else "  MISMATCH"
+            print(f"{term:>16} {scan_seconds * 1000:8.1f}ms {index_seconds * 1000:8.1f}ms {len(index_ids):6d}{same}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time patient search with and without the search index")
+    parser.add_argument("--patients", type=int, default=200000)
+    parser.add_argument("--db", default=os.path.join(tempfile.gettempdir(), "search_bench.db"))
+    args = parser.parse_args()
+    main(args.patients, args.db)
@@ -0,0 +1,192 @@
+"""
+Bulk patient registration.
+
+Registering through /api/patients/register costs an HTTP call and two commits
+per patient, far too slow for a batch handed over by the hospital's original
+registration software or for back-loading a camp day. This registers a whole
+CSV or JSON list in one transaction:
+
+- every row is validated first, and bad rows are reported by row number
+  instead of failing the batch
+- one block of consecutive token numbers is reserved for the valid rows
+- patients go in as multi-row INSERT ... RETURNING statements (SQLAlchemy's
+  insertmanyvalues), their "registration" flow rows and outbox events as
+  multi-row inserts after them
+
+COPY would be marginally faster on PostgreSQL, but it can't return the new
+patient ids the flow rows need.
+
+Also usable from the command line:
+
+    python bulk_registration.py patients.csv [--dry-run]
+"""
+
+import csv
+import io
+import json
+import os
+from typing import List, Optional, Tuple
+from pydantic import BaseModel, ValidationError, field_validator
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+from database import Patient, PatientFlow, PatientStatus, get_ist_now
+from event_outbox import insert_events
+from tokens import reserve_token_numbers
+
+BULK_REGISTRATION_MAX_ROWS = int(os.getenv("BULK_REGISTRATION_MAX_ROWS", "20000"))
+
+ROW_FIELDS = ("registration_number", "name", "age", "phone")
+
+
+class BulkPatientRow(BaseModel):
+    registration_number: Optional[str] = None  # Hospital's original software registration number
+    name: str
+    age: Optional[int] = None
+    phone: Optional[str] = None
+
+    @field_validator("name")
+    @classmethod
+    def name_not_blank(cls, value: str) -> str:
+        value = value.strip()
+        if not value:
+            raise ValueError("name is required")
+        return value
+
+
+class BulkRegisteredPatient(BaseModel):
+    row: int  # 1-based position in the submitted list (data rows, not counting a CSV header)
+    id: int
+    token_number: str
+
+
+class BulkRowError(BaseModel):
+    row: int
+    error: str
+
+
+class BulkRegistrationResult(BaseModel):
+    registered: int
+    failed: int
+    patients: List[BulkRegisteredPatient]
+    errors: List[BulkRowError]
+
+
+def parse_csv(content: str) -> List[dict]:
+    """Rows of a CSV with a header line naming (some of) registration_number, name, age, phone"""
+    reader = csv.DictReader(io.StringIO(content.lstrip("\ufeff")))
+    return [
+        {(key or "").strip().lower(): value for key, value in row.items()}
+        for row in reader
+    ]
+
+
+def parse_json(content: str) -> List[dict]:
+    rows = json.loads(content)
+    if isinstance(rows, dict):
+        rows = rows.get("patients")
+    if not isinstance(rows, list):
+        raise ValueError("Expected a JSON list of patients (or {\"patients\": [...]})")
+    return rows
+
+
+def validate_rows(rows: List) -> Tuple[List[Tuple[int, BulkPatientRow]], List[BulkRowError]]:
+    valid, errors = [], []
+    for index, row in enumerate(rows, start=1):
+        if not isinstance(row, dict):
+            errors.append(BulkRowError(row=index, error="Expected an object"))
+            continue
+        # Blank CSV cells mean "not given"
+        values = {field: row.get(field) for field in ROW_FIELDS}
+        values = {field: (value.strip() or None) if isinstance(value, str) else value for field, value in values.items()}
+        if values["name"] is None:
+            errors.append(BulkRowError(row=index, error="name: is required"))
+            continue
+        try:
+            valid.append((index, BulkPatientRow(**values)))
+        except ValidationError as e:
+            message = "; ".join(f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in e.errors())
+            errors.append(BulkRowError(row=index, error=message))
+    return valid, errors
+
+
+def register_patients(db: Session, rows: List, dry_run: bool = False) -> BulkRegistrationResult:
+    """Validate and insert the rows in the caller's transaction; the caller commits (or rolls back)"""
+    if len(rows) > BULK_REGISTRATION_MAX_ROWS:
+        raise ValueError(f"At most {BULK_REGISTRATION_MAX_ROWS} patients per batch")
+    valid, errors = validate_rows(rows)
+    registered: List[BulkRegisteredPatient] = []
+    if valid and not dry_run:
+        token_numbers = reserve_token_numbers(db, len(valid))
+        now = get_ist_now()
+        patient_ids = db.execute(
+            insert(Patient).returning(Patient.id, sort_by_parameter_order=True),
+            [
+                {
+                    "registration_number": row.registration_number,
+                    "token_number": token_number,
+                    "name": row.name,
+                    "age": row.age,
+                    "phone": row.phone,
+                    "registration_time": now,
+                    "current_status": PatientStatus.PENDING,
+                    "is_dilated": False,
+                    "dilation_flag": False,
+                }
+                for (_, row), token_number in zip(valid, token_numbers)
+            ]
+        ).scalars().all()
+
+        db.execute(insert(PatientFlow), [
+            {"patient_id": patient_id, "to_room": "registration", "status": PatientStatus.PENDING, "timestamp": now}
+            for patient_id in patient_ids
+        ])
+        insert_events(db, [
+            {"patient_id": patient_id, "token_number": token_number, "status": PatientStatus.PENDING.value, "to_room": "registration"}
+            for patient_id, token_number in zip(patient_ids, token_numbers)
+        ])
+        registered = [
+            BulkRegisteredPatient(row=index, id=patient_id, token_number=token_number)
+            for (index, _), patient_id, token_number in zip(valid, patient_ids, token_numbers)
+        ]
+
+    return BulkRegistrationResult(
+        registered=len(registered),
+        failed=len(errors),
+        patients=registered,
+        errors=errors
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Register a CSV or JSON list of patients in one transaction")
+    parser.add_argument("file", help="CSV with a header row (registration_number,name,age,phone) or a JSON list")
+    parser.add_argument("--dry-run", action="store_true", help="Only validate the rows")
+    args = parser.parse_args()
+
+    with open(args.file, encoding="utf-8") as f:
+        content = f.read()
+    rows = parse_json(content) if args.file.lower().endswith(".json") else parse_csv(content)
+
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        result = register_patients(db, rows, dry_run=args.dry_run)
+        db.commit()
+        elapsed = time.perf_counter() - started
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    for error in result.errors:
+        print(f"Row {error.row}: {error.error}")
+    if args.dry_run:
+        print(f"{len(rows) - result.failed} rows valid, {result.failed} invalid (dry run, nothing registered)")
+    else:
+        tokens = f" (tokens {result.patients[0].token_number} to {result.patients[-1].token_number})" if result.patients else ""
+        print(f"Registered {result.registered} patients in {elapsed:.2f}s{tokens}, {result.failed} rows failed")
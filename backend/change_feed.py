@@ -0,0 +1,433 @@
+"""
+Change feed for queue and patient writes.
+
+Broadcasts used to fire only from the process that handled the write, so
+changes made by another worker, by scripts such as
+setup_individual_opd_logins.py or directly in the database never reached the
+screens, and left this process's display snapshots and status counters stale.
+
+On PostgreSQL, statement triggers on queues and patients publish one compact
+NOTIFY per write statement, whoever made it: the OPDs it touched and the net
+change it made to the status counters (from the statement's transition
+tables), so a 10k-row import is one notification, not 10k. A listener task in
+each process ignores notifications from its own connections (those are
+already broadcast by the request that made them), and for everything else it
+invalidates the affected display snapshots, applies the counter changes and
+has the broadcast dispatcher rebuild and emit the OPD to this process's
+clients. Writes from other API workers are not re-emitted when a shared
+Socket.IO bus already delivered them, except for the display deltas, whose
+sequence numbers are per process. A statement trigger on opds drops the cached
+active OPD list when OPDs are added or (de)activated elsewhere.
+
+SQLite has no NOTIFY, so there the listener polls a fingerprint of every OPD's
+live queue instead. After each write of our own the OPD's fingerprint is taken
+again, so the next poll only reports what changed after it, whoever else
+wrote at the same time.
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Set
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+from database import engine, async_engine, AsyncSessionLocal, DATABASE_URL, Queue, Patient, PatientStatus
+from display_cache import display_cache
+from status_counters import status_counters
+from socket_bus import SOCKETIO_MANAGER, get_plain_postgres_url
+from websocket_manager import broadcast_dispatcher
+
+# auto: LISTEN/NOTIFY on PostgreSQL, polling otherwise; poll: always poll; off: disabled
+CHANGE_FEED = os.getenv("CHANGE_FEED", "auto").lower()
+CHANGE_FEED_POLL_SECONDS = float(os.getenv("CHANGE_FEED_POLL_SECONDS", "2"))
+CHANGE_FEED_CHANNEL = "eye_hospital_changes"
+# Connections of the API set this, so triggers can tell its writes from scripts and manual edits
+APP_NAME = "eye_hospital_api"
+
+IS_POSTGRES = DATABASE_URL.startswith("postgresql")
+
+TRIGGER_SQL = f"""
+-- One notification per statement, however many rows it touched: the OPDs it
+-- touched, the net change to the status counters and, for a single patient,
+-- the patient and their new status
+CREATE OR REPLACE FUNCTION eye_hospital_publish_changes(table_name TEXT, changed JSONB) RETURNS void AS $$
+DECLARE
+    payload TEXT;
+BEGIN
+    IF jsonb_array_length(changed) = 0 THEN
+        RETURN;
+    END IF;
+    WITH entry AS (
+        SELECT e->>'opd' AS opd, e->>'status' AS status, (e->>'patient')::int AS patient, (e->>'delta')::int AS delta,
+               coalesce((e->>'today')::boolean, false) AS today,
+               coalesce((e->>'completed_today')::boolean, false) AS completed_today
+        FROM jsonb_array_elements(changed) e
+    ), counts AS (
+        SELECT 'queue' AS kind, json_build_array(opd, status)::text AS key, delta FROM entry WHERE table_name = 'queues'
+        UNION ALL SELECT 'patient', to_json(status)::text, delta FROM entry WHERE table_name = 'patients'
+        UNION ALL SELECT 'allocated', to_json(opd)::text, delta FROM entry WHERE table_name = 'patients' AND opd IS NOT NULL
+        UNION ALL SELECT 'registered_today', 'null', delta FROM entry WHERE table_name = 'patients' AND today
+        UNION ALL SELECT 'completed_today', 'null', delta FROM entry WHERE table_name = 'patients' AND completed_today
+    ), net AS (
+        SELECT kind, key, sum(delta) AS delta FROM counts GROUP BY kind, key HAVING sum(delta) <> 0
+    )
+    SELECT json_build_object(
+        'opds', (SELECT coalesce(json_agg(DISTINCT opd), '[]') FROM entry WHERE opd IS NOT NULL),
+        'counts', (SELECT coalesce(json_agg(json_build_array(kind, key::json, delta)), '[]') FROM net),
+        'patient', (SELECT min(patient) FROM entry HAVING count(DISTINCT patient) = 1),
+        'status', (SELECT min(status) FROM entry WHERE delta = 1 HAVING count(*) = 1),
+        'app', current_setting('application_name') = '{APP_NAME}'
+    )::text INTO payload;
+    IF octet_length(payload) > 7500 THEN
+        -- NOTIFY payloads are limited to 8000 bytes
+        payload := json_build_object('stale', true, 'app', current_setting('application_name') = '{APP_NAME}')::text;
+    END IF;
+    PERFORM pg_notify('{CHANGE_FEED_CHANNEL}', payload);
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION eye_hospital_notify_queue_change() RETURNS trigger AS $$
+DECLARE
+    changed JSONB := '[]';
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        SELECT changed || coalesce(jsonb_agg(jsonb_build_object(
+            'opd', opd_type, 'status', status, 'patient', patient_id, 'delta', -1
+        )), '[]') INTO changed FROM old_rows;
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        SELECT changed || coalesce(jsonb_agg(jsonb_build_object(
+            'opd', opd_type, 'status', status, 'patient', patient_id, 'delta', 1
+        )), '[]') INTO changed FROM new_rows;
+    END IF;
+    PERFORM eye_hospital_publish_changes('queues', changed);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION eye_hospital_notify_patient_change() RETURNS trigger AS $$
+DECLARE
+    changed JSONB := '[]';
+    today DATE := (now() AT TIME ZONE 'Asia/Kolkata')::date;
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        SELECT changed || coalesce(jsonb_agg(jsonb_build_object(
+            'opd', allocated_opd, 'status', current_status, 'patient', id, 'delta', -1,
+            'today', registration_time::date = today,
+            'completed_today', current_status = 'COMPLETED' AND completed_at::date = today
+        )), '[]') INTO changed FROM old_rows;
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        SELECT changed || coalesce(jsonb_agg(jsonb_build_object(
+            'opd', allocated_opd, 'status', current_status, 'patient', id, 'delta', 1,
+            'today', registration_time::date = today,
+            'completed_today', current_status = 'COMPLETED' AND completed_at::date = today
+        )), '[]') INTO changed FROM new_rows;
+    END IF;
+    PERFORM eye_hospital_publish_changes('patients', changed);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION eye_hospital_notify_opd_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('{CHANGE_FEED_CHANNEL}', json_build_object('opd_list', true)::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Row-level triggers of earlier versions
+DROP TRIGGER IF EXISTS queues_notify_change ON queues;
+DROP TRIGGER IF EXISTS patients_notify_change ON patients;
+
+-- Transition tables can only be declared for one event per trigger
+DROP TRIGGER IF EXISTS queues_notify_insert ON queues;
+CREATE TRIGGER queues_notify_insert AFTER INSERT ON queues REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE eye_hospital_notify_queue_change();
+DROP TRIGGER IF EXISTS queues_notify_update ON queues;
+CREATE TRIGGER queues_notify_update AFTER UPDATE ON queues REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE eye_hospital_notify_queue_change();
+DROP TRIGGER IF EXISTS queues_notify_delete ON queues;
+CREATE TRIGGER queues_notify_delete AFTER DELETE ON queues REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE eye_hospital_notify_queue_change();
+
+DROP TRIGGER IF EXISTS patients_notify_insert ON patients;
+CREATE TRIGGER patients_notify_insert AFTER INSERT ON patients REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE eye_hospital_notify_patient_change();
+DROP TRIGGER IF EXISTS patients_notify_update ON patients;
+CREATE TRIGGER patients_notify_update AFTER UPDATE ON patients REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE eye_hospital_notify_patient_change();
+DROP TRIGGER IF EXISTS patients_notify_delete ON patients;
+CREATE TRIGGER patients_notify_delete AFTER DELETE ON patients REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE eye_hospital_notify_patient_change();
+
+DROP TRIGGER IF EXISTS opds_notify_change ON opds;
+CREATE TRIGGER opds_notify_change AFTER INSERT OR UPDATE OR DELETE ON opds
+    FOR EACH STATEMENT EXECUTE PROCEDURE eye_hospital_notify_opd_change();
+"""
+
+
+def _parse_status(value: Optional[str]) -> Optional[PatientStatus]:
+    """Statuses arrive as the database enum label (the member name)"""
+    if value is None:
+        return None
+    try:
+        return PatientStatus[value]
+    except KeyError:
+        try:
+            return PatientStatus(value)
+        except ValueError:
+            return None
+
+
+def _counter_changes(counts: list) -> Optional[List[tuple]]:
+    """status_counters changes from a notification's [kind, key, delta] list; None if one can't be read"""
+    changes = []
+    for kind, key, delta in counts:
+        if kind == "queue":
+            opd_code, status = key
+            key = (opd_code, _parse_status(status))
+            if key[1] is None:
+                return None
+        elif kind == "patient":
+            key = _parse_status(key)
+            if key is None:
+                return None
+        changes.append((kind, key, delta))
+    return changes
+
+
+def queue_fingerprints(db: Session, opd_codes: Optional[Iterable[str]] = None) -> Dict[str, int]:
+    """Hash of each OPD's live queue, covering everything the queue and display payloads show"""
+    query = db.query(
+        Queue.opd_type, Queue.id, Queue.position, Queue.status,
+        Patient.token_number, Patient.name, Patient.current_status, Patient.is_dilated
+    ).join(Patient).filter(
+        Queue.status.in_([PatientStatus.PENDING, PatientStatus.IN_OPD, PatientStatus.DILATED, PatientStatus.REFERRED]),
+        Patient.current_status != PatientStatus.COMPLETED
+    )
+    if opd_codes is not None:
+        query = query.filter(Queue.opd_type.in_(list(opd_codes)))
+    rows = query.order_by(Queue.opd_type, Queue.id).all()
+
+    entries: Dict[str, list] = {}
+    for row in rows:
+        entries.setdefault(row[0], []).append(tuple(row[1:]))
+    return {opd_code: hash(tuple(opd_entries)) for opd_code, opd_entries in entries.items()}
+
+
+class ChangeFeed:
+    def __init__(self):
+        self._own_pids: Set[int] = set()  # Postgres backends of this process's connections
+        self._task: Optional[asyncio.Task] = None
+        # Polling: last fingerprint per OPD, and marks to tell whether it predates our latest write
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._fingerprints: Optional[Dict[str, int]] = None
+        self._write_marks = itertools.count(1)
+        self._own_writes: Dict[str, int] = {}  # opd_code -> mark of our latest write
+        self._baseline_marks: Dict[str, int] = {}  # opd_code -> latest write its fingerprint covers
+        self._applying_thread: Optional[int] = None
+        self.mode: Optional[str] = None
+        self.notifications = 0
+        self.own_skipped = 0
+        self.applied = 0
+        self.polls = 0
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(f"SELECT pg_backend_pid(), set_config('application_name', '{APP_NAME}', false)")
+            pid = cursor.fetchone()[0]
+        finally:
+            cursor.close()
+        dbapi_connection.commit()
+        connection_record.info["backend_pid"] = pid
+        self._own_pids.add(pid)
+
+    def _on_close(self, dbapi_connection, connection_record):
+        self._own_pids.discard(connection_record.info.pop("backend_pid", None))
+
+    def track_connections(self):
+        for target in (engine, async_engine.sync_engine):
+            event.listen(target, "connect", self._on_connect)
+            event.listen(target, "close", self._on_close)
+
+    def install_triggers(self):
+        """Create or replace the NOTIFY triggers on queues and patients"""
+        with engine.begin() as conn:
+            conn.execute(text(TRIGGER_SQL))
+
+    def start(self):
+        if CHANGE_FEED == "off" or self._task is not None:
+            return
+        if CHANGE_FEED == "auto" and IS_POSTGRES:
+            try:
+                self.install_triggers()
+            except Exception as e:
+                print(f"Change feed: could not install triggers, polling instead: {e}")
+            else:
+                self.mode = "listen"
+                self._task = asyncio.create_task(self._listen())
+                return
+        self.mode = "poll"
+        self._task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except (asyncio.CancelledError, RuntimeError):
+            pass
+        self._task = None
+
+    def apply(self, opd_codes: Set[str], patient_id: Optional[int] = None,
+              status: Optional[PatientStatus] = None, emit: bool = True,
+              counter_changes: Optional[List[tuple]] = None):
+        """
+        A change made outside this process: refresh local state and tell our own
+        clients. Without counter_changes the status counters are recounted.
+        """
+        self.applied += 1
+        self._applying_thread = threading.get_ident()
+        try:
+            display_cache.invalidate(*opd_codes)
+        finally:
+            self._applying_thread = None
+        if counter_changes is None:
+            status_counters.mark_stale()
+        elif counter_changes:
+            status_counters.apply(counter_changes)
+        if not opd_codes:
+            return
+        if not emit:
+            # Display delta sequence numbers are per process, so our display rooms still need theirs
+            broadcast_dispatcher.display_deltas_changed()
+            return
+        broadcast_dispatcher.queue_changed(*opd_codes, local_only=True)
+        if patient_id is not None and status is not None:
+            broadcast_dispatcher.patient_status_changed(patient_id, status, local_only=True)
+        broadcast_dispatcher.display_changed(local_only=True)
+
+    def _on_notification(self, pid: int, payload: str):
+        self.notifications += 1
+        if pid in self._own_pids:
+            self.own_skipped += 1
+            return
+        try:
+            change = json.loads(payload)
+        except ValueError:
+            return
+        if change.get("opd_list"):
+            # An OPD was added, changed or (de)activated by another process
+            display_cache.invalidate_opd_list()
+            return
+        # Another API worker has already broadcast its own write through the shared bus
+        emit = not (change.get("app") and SOCKETIO_MANAGER != "local")
+        if change.get("stale"):
+            # Too much changed for one notification
+            self.apply(set(display_cache.get_versions()), emit=emit)
+            return
+        self.apply(
+            set(change.get("opds") or []), change.get("patient"), _parse_status(change.get("status")), emit,
+            _counter_changes(change.get("counts") or [])
+        )
+
+    async def _listen(self):
+        import asyncpg
+        url = get_plain_postgres_url()
+        while True:
+            try:
+                conn = await asyncpg.connect(url)
+                await conn.add_listener(
+                    CHANGE_FEED_CHANNEL,
+                    lambda _conn, pid, _channel, payload: self._on_notification(pid, payload)
+                )
+            except Exception as e:
+                print(f"Change feed: could not listen on Postgres, retrying: {e}")
+                await asyncio.sleep(5)
+                continue
+            try:
+                while not conn.is_closed():
+                    await asyncio.sleep(5)
+            finally:
+                if not conn.is_closed():
+                    await conn.close()
+            print("Change feed: listener connection lost, reconnecting")
+            # Anything may have changed while we weren't listening
+            self.apply(set(display_cache.get_versions()))
+
+    def _on_local_change(self, opd_codes: List[str]):
+        """display_cache listener: our own write changed these OPDs (called from whichever thread)"""
+        loop = self._loop
+        if threading.get_ident() == self._applying_thread or loop is None or loop.is_closed():
+            return
+        for opd_code in opd_codes:
+            self._own_writes[opd_code] = next(self._write_marks)
+        loop.call_soon_threadsafe(lambda: loop.create_task(self._refresh_baseline(opd_codes)))
+
+    async def _refresh_baseline(self, opd_codes: List[str]):
+        """Fingerprint OPDs right after our own write, so the next poll only sees later changes"""
+        marks = {opd_code: self._own_writes.get(opd_code) for opd_code in opd_codes}
+        try:
+            async with AsyncSessionLocal() as db:
+                current = await db.run_sync(lambda session: queue_fingerprints(session, opd_codes))
+        except Exception as e:
+            # Keep the old baseline: at worst the next poll re-broadcasts our own write
+            print(f"Change feed: fingerprint after write failed: {e}")
+            current = None
+        for opd_code in opd_codes:
+            if current is not None and self._fingerprints is not None:
+                self._set_baseline(opd_code, current.get(opd_code))
+            self._baseline_marks[opd_code] = marks[opd_code]
+
+    def _set_baseline(self, opd_code: str, fingerprint: Optional[int]):
+        if fingerprint is None:
+            self._fingerprints.pop(opd_code, None)
+        else:
+            self._fingerprints[opd_code] = fingerprint
+
+    async def _poll(self):
+        self._loop = asyncio.get_running_loop()
+        display_cache.add_listener(self._on_local_change)
+        while True:
+            await asyncio.sleep(CHANGE_FEED_POLL_SECONDS)
+            writes_before = dict(self._own_writes)
+            try:
+                async with AsyncSessionLocal() as db:
+                    current = await db.run_sync(queue_fingerprints)
+            except Exception as e:
+                print(f"Change feed: poll failed: {e}")
+                continue
+            self.polls += 1
+            if self._fingerprints is None:
+                self._fingerprints = current
+                continue
+            changed = set()
+            for opd_code in set(current) | set(self._fingerprints):
+                written = self._own_writes.get(opd_code)
+                if written != writes_before.get(opd_code) or written != self._baseline_marks.get(opd_code):
+                    # Our own write is newer than this poll or its fingerprint: its baseline is still coming
+                    continue
+                if current.get(opd_code) != self._fingerprints.get(opd_code):
+                    changed.add(opd_code)
+                    self._set_baseline(opd_code, current.get(opd_code))
+            if changed:
+                self.apply(changed)
+
+    def metrics(self) -> dict:
+        return {
+            "mode": self.mode or "off",
+            "notifications": self.notifications,
+            "own_skipped": self.own_skipped,
+            "applied": self.applied,
+            "polls": self.polls,
+        }
+
+
+change_feed = ChangeFeed()
+if IS_POSTGRES and CHANGE_FEED == "auto":
+    change_feed.track_connections()
@@ -1,6 +1,7 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, ForeignKey, Enum as SQLEnum
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, ForeignKey, Index, Enum as SQLEnum
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from datetime import datetime
 import enum
 import os
@@ -68,6 +69,33 @@ engine = create_engine(
     echo=False  # Set to True for SQL query logging
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Async engine for the request handlers, so queries don't block the event loop
+# (which also serves all Socket.IO traffic). Same database, async driver.
+def get_async_database_url(url: str) -> str:
+    if url.startswith("postgresql://"):
+        url = url.replace("postgresql://", "postgresql+asyncpg://", 1)
+        # asyncpg takes "ssl" instead of libpq's "sslmode"
+        url = url.replace("sslmode=", "ssl=")
+    elif url.startswith("sqlite://"):
+        url = url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    return url
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or get_async_database_url(DATABASE_URL)
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    pool_pre_ping=True,
+    echo=False,
+    **({"pool_size": 10, "max_overflow": 20} if ASYNC_DATABASE_URL.startswith("postgresql") else {})
+)
+# Built on SessionLocal's session class so session event hooks apply to both kinds of session.
+# Objects stay loaded after commit: an async session can't lazy-load expired attributes.
+AsyncSessionLocal = async_sessionmaker(
+    async_engine,
+    sync_session_class=SessionLocal.class_,
+    autoflush=False,
+    expire_on_commit=False
+)
 Base = declarative_base()
 
 # Enums
@@ -184,6 +212,44 @@ class PatientFlow(Base):
     
     patient = relationship("Patient")
 
+# Serve the newest-first keyset pages of the patient list and the flow log (see pagination.py)
+KEYSET_INDEXES = [
+    Index("ix_patients_registration_time_id", Patient.registration_time, Patient.id),
+    Index("ix_patient_flows_timestamp_id", PatientFlow.timestamp, PatientFlow.id),
+]
+
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    token_hash = Column(String, unique=True, index=True, nullable=False)  # HMAC of the token, the token itself is never stored
+    family_id = Column(String, index=True, nullable=False)  # Shared by all rotations of one login
+    issued_at = Column(DateTime, default=get_ist_now)
+    expires_at = Column(DateTime, nullable=False)
+    revoked_at = Column(DateTime)
+    replaced_by_id = Column(Integer)  # Token issued when this one was rotated
+
+class TokenCounter(Base):
+    __tablename__ = "token_counters"
+    
+    day = Column(String(8), primary_key=True)  # YYYYMMDD in IST
+    last_number = Column(Integer, nullable=False)  # Last token number handed out that day
+
+class EventOutbox(Base):
+    """Sequenced log of patient movements, written in the same transaction as each PatientFlow row"""
+    __tablename__ = "event_outbox"
+    
+    seq = Column(Integer, primary_key=True, autoincrement=True)
+    created_at = Column(DateTime, default=get_ist_now, index=True)
+    patient_id = Column(Integer, nullable=False)
+    token_number = Column(String)
+    status = Column(String, nullable=False)  # PatientStatus value
+    from_room = Column(String)
+    to_room = Column(String)
+    opd_code = Column(String)  # OPD the patient moved into or within
+    related_opd = Column(String)  # Other OPD involved (e.g. the one a referral came from)
+
 # Helper functions for OPD access
 def get_user_opd_access(db: SessionLocal, user_id: int):
     """
@@ -212,3 +278,8 @@ def get_db():
         yield db
     finally:
         db.close()
+
+# Async dependency for routers that use AsyncSession
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -0,0 +1,351 @@
+"""
+In-memory display snapshot cache.
+
+Every lobby screen polls the display endpoints, so instead of running the queue
+query once per screen we keep a single pre-built snapshot per OPD. A snapshot is
+only rebuilt after a queue mutation invalidates it, and every rebuild is tagged
+with a monotonically increasing version number.
+"""
+
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from fastapi import Request
+from sqlalchemy.orm import Session
+from database import OPD, get_ist_now
+
+# The active OPD list is invalidated by OPD changes made through this process (and,
+# on PostgreSQL, by the change feed); this bounds how long other workers can miss one
+ACTIVE_OPDS_TTL_SECONDS = float(os.getenv("ACTIVE_OPDS_TTL_SECONDS", "30"))
+
+
+# ETag scopes whose responses carry waiting minutes, which change without a version change
+_WAITING_TIME_SCOPES = ("display", "all")
+
+
+def waiting_minutes(registration_time, now) -> Optional[int]:
+    if registration_time is None:
+        return None
+    return int((now - registration_time).total_seconds() / 60)
+
+
+class DisplaySnapshot:
+    """
+    Pre-built queue and display data for one OPD. The waiting minutes in it go
+    stale as the clock moves, so display and payload fill them in afresh from
+    the registration times on every access.
+    """
+
+    def __init__(self, opd_code: str, version: int, queue: list, display):
+        self.opd_code = opd_code
+        self.version = version
+        self.queue = queue  # List[QueueResponse] in display order
+        self._display = display  # DisplayData
+        self._payload = display.model_dump(mode="json")  # JSON-ready copy for socket pushes
+        self._registration_times = {entry.token_number: entry.registration_time for entry in queue}
+        self.built_at = get_ist_now()
+        # Derived from the queue contents only, so every worker gives the same queue state the same token
+        self.content_token = _content_token(self._payload)
+
+    @property
+    def display(self):
+        """DisplayData with the waiting minutes as of now"""
+        now = get_ist_now()
+
+        def current(item):
+            if item is None:
+                return None
+            minutes = waiting_minutes(self._registration_times.get(item.token_number), now)
+            return item.model_copy(update={"waiting_time_minutes": minutes})
+
+        return self._display.model_copy(update={
+            "current_patient": current(self._display.current_patient),
+            "next_patients": [current(item) for item in self._display.next_patients],
+        })
+
+    @property
+    def payload(self) -> dict:
+        """JSON-ready display data with the waiting minutes as of now"""
+        now = get_ist_now()
+
+        def current(item):
+            if item is None:
+                return None
+            return dict(item, waiting_time_minutes=waiting_minutes(self._registration_times.get(item["token_number"]), now))
+
+        return dict(
+            self._payload,
+            current_patient=current(self._payload["current_patient"]),
+            next_patients=[current(item) for item in self._payload["next_patients"]],
+        )
+
+
+class DisplaySnapshotCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counter = itertools.count(1)
+        self._versions: Dict[str, int] = {}
+        self._snapshots: Dict[str, DisplaySnapshot] = {}
+        self._active_opds: Optional[List[str]] = None
+        self._active_opds_loaded_at = 0.0
+        self._opd_list_version = 0
+        # Last state sent to per-OPD display rooms: opd_code -> (sequence number, snapshot)
+        self._published: Dict[str, Tuple[int, DisplaySnapshot]] = {}
+        # Versions restart with the process, so ETags also carry a per-boot id
+        self._boot_id = uuid.uuid4().hex[:8]
+        self._listeners: List[Callable[[List[str]], None]] = []
+        self.rebuilds = 0
+
+    def get_version(self, opd_code: str) -> int:
+        """Current change version of an OPD (0 if it was never built or changed)"""
+        return self._versions.get(opd_code, 0)
+
+    def get_versions(self) -> Dict[str, int]:
+        """Copy of the change versions of every OPD that has one"""
+        with self._lock:
+            return dict(self._versions)
+
+    def add_listener(self, listener: Callable[[List[str]], None]):
+        """Call listener(opd_codes) after every invalidation (from whichever thread invalidated)"""
+        self._listeners.append(listener)
+
+    def invalidate(self, *opd_codes: Optional[str]):
+        """Mark OPD snapshots as stale after a queue mutation has been committed"""
+        changed = []
+        with self._lock:
+            for opd_code in opd_codes:
+                if not opd_code:
+                    continue
+                self._versions[opd_code] = next(self._counter)
+                self._snapshots.pop(opd_code, None)
+                changed.append(opd_code)
+        if changed:
+            for listener in self._listeners:
+                listener(changed)
+
+    def invalidate_opd_list(self):
+        """Forget the cached list of active OPDs (OPD created, activated or deactivated)"""
+        with self._lock:
+            self._active_opds = None
+            self._opd_list_version += 1
+
+    def get_active_opds(self, db: Session) -> List[str]:
+        """Codes of all active OPDs, in the same order as the OPD table"""
+        active_opds = self._active_opds
+        if active_opds is None or time.monotonic() - self._active_opds_loaded_at > ACTIVE_OPDS_TTL_SECONDS:
+            previous = active_opds
+            active_opds = [opd.opd_code for opd in db.query(OPD).filter(OPD.is_active == True).all()]
+            with self._lock:
+                if previous is not None and active_opds != previous:
+                    # Changed elsewhere without an invalidation reaching us
+                    self._opd_list_version += 1
+                self._active_opds = active_opds
+                self._active_opds_loaded_at = time.monotonic()
+        return active_opds
+
+    def _get_fresh(self, opd_code: str) -> Optional[DisplaySnapshot]:
+        snapshot = self._snapshots.get(opd_code)
+        if snapshot is not None and snapshot.version == self.get_version(opd_code):
+            return snapshot
+        return None
+
+    def _reserve_version(self, opd_code: str) -> int:
+        with self._lock:
+            version = self._versions.get(opd_code)
+            if version is None:
+                version = next(self._counter)
+                self._versions[opd_code] = version
+            return version
+
+    def _store(self, opd_code: str, version: int, queue: list) -> DisplaySnapshot:
+        # Imported here to avoid a circular import with the routers
+        from routers.display import format_opd_data
+
+        snapshot = DisplaySnapshot(opd_code, version, queue, format_opd_data(opd_code, queue))
+        self.rebuilds += 1
+        with self._lock:
+            # Only publish if no mutation happened while we were building
+            if self._versions.get(opd_code) == version:
+                self._snapshots[opd_code] = snapshot
+        return snapshot
+
+    def get_snapshot(self, opd_code: str, db: Session) -> DisplaySnapshot:
+        """Return the current snapshot for an OPD, rebuilding it only if it is stale"""
+        snapshot = self._get_fresh(opd_code)
+        if snapshot is not None:
+            return snapshot
+
+        from routers.opd import get_queue_data
+
+        version = self._reserve_version(opd_code)
+        return self._store(opd_code, version, get_queue_data(opd_code, db, None))
+
+    def get_all_snapshots(self, db: Session) -> List[DisplaySnapshot]:
+        """Snapshots for every active OPD, stale ones are rebuilt together with one query"""
+        from routers.opd import get_queue_data_for_opds
+
+        active_opds = self.get_active_opds(db)
+        snapshots = {}
+        stale_versions = {}
+        for opd_code in active_opds:
+            snapshot = self._get_fresh(opd_code)
+            if snapshot is not None:
+                snapshots[opd_code] = snapshot
+            else:
+                stale_versions[opd_code] = self._reserve_version(opd_code)
+
+        if stale_versions:
+            queues = get_queue_data_for_opds(list(stale_versions), db)
+            for opd_code, version in stale_versions.items():
+                snapshots[opd_code] = self._store(opd_code, version, queues[opd_code])
+
+        return [snapshots[opd_code] for opd_code in active_opds]
+
+    def get_all_payload(self, db: Session) -> dict:
+        """JSON-ready display data for all active OPDs, as pushed to display screens"""
+        snapshots = self.get_all_snapshots(db)
+        return {
+            "opds": [snapshot.payload for snapshot in snapshots],
+            "versions": {snapshot.opd_code: snapshot.version for snapshot in snapshots},
+            "last_updated": get_ist_now().isoformat(),
+        }
+
+    def collect_deltas(self, db: Session) -> List[dict]:
+        """
+        Delta events for every OPD whose snapshot changed since it was last published.
+        Each OPD has its own gapless sequence number so clients can detect missed deltas.
+        The numbers are this process's own, so deltas only go to its own clients.
+        """
+        deltas = []
+        for snapshot in self.get_all_snapshots(db):
+            opd_code = snapshot.opd_code
+            published = self._published.get(opd_code)
+            if published is None:
+                # No client can hold a sequence number for this OPD yet, start the baseline here
+                self._published[opd_code] = (0, snapshot)
+                continue
+            seq, published_snapshot = published
+            if published_snapshot.version == snapshot.version:
+                continue
+            delta = compute_display_delta(published_snapshot.payload, snapshot.payload)
+            delta.update(opd_type=opd_code, seq=seq + 1, base_seq=seq)
+            self._published[opd_code] = (seq + 1, snapshot)
+            deltas.append(delta)
+        return deltas
+
+    def get_published(self, opd_code: str, db: Session) -> Tuple[int, dict]:
+        """Sequence number and full payload that delta clients of an OPD should resync to"""
+        published = self._published.get(opd_code)
+        if published is None:
+            published = (0, self.get_snapshot(opd_code, db))
+            self._published[opd_code] = published
+        seq, snapshot = published
+        return seq, snapshot.payload
+
+    def etag(self, opd_codes: Iterable[str], scope: str = "opd") -> str:
+        """Strong ETag for the current versions of the given OPDs"""
+        return self._etag(((opd_code, self.get_version(opd_code)) for opd_code in opd_codes), scope)
+
+    def snapshot_etag(self, snapshots: Iterable[DisplaySnapshot], scope: str = "opd") -> str:
+        """
+        ETag for the versions the given snapshots were built from. Responses must be
+        tagged with this rather than etag(): a mutation committed while a snapshot
+        was being built has already moved the current version past the served body.
+        """
+        return self._etag(((snapshot.opd_code, snapshot.version) for snapshot in snapshots), scope)
+
+    def _etag(self, versions: Iterable[Tuple[str, int]], scope: str) -> str:
+        parts = [self._boot_id, scope, str(self._opd_list_version)]
+        if scope in _WAITING_TIME_SCOPES:
+            # A 304 must not keep a screen showing last minute's waiting times
+            parts.append(get_ist_now().strftime("%Y%m%d%H%M"))
+        parts.extend(f"{opd_code}:{version}" for opd_code, version in versions)
+        digest = hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()[:20]
+        return f'"{digest}"'
+
+
+# Fields that change on every rebuild without a real queue change, clients derive them instead
+_DELTA_IGNORED_FIELDS = ("waiting_time_minutes", "position")
+
+
+def _content_token(payload: dict) -> str:
+    content = dict(
+        payload,
+        current_patient=_without_waiting_time(payload["current_patient"]),
+        next_patients=[_without_waiting_time(item) for item in payload["next_patients"]],
+    )
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()[:20]
+
+
+def _without_waiting_time(item: Optional[dict]) -> Optional[dict]:
+    if item is None:
+        return None
+    return {key: value for key, value in item.items() if key != "waiting_time_minutes"}
+
+
+def _delta_key(item: dict) -> dict:
+    return {key: value for key, value in item.items() if key not in _DELTA_IGNORED_FIELDS}
+
+
+def compute_display_delta(old: dict, new: dict) -> dict:
+    """
+    Describe how one OPD's display payload changed, keyed by token number.
+    
+    Only the keys that changed are present: added/updated items, removed tokens,
+    the new current token (plus "called" when a patient was called in), the new
+    order of next_patients and the summary counters.
+    """
+    def items_by_token(payload):
+        items = list(payload["next_patients"])
+        if payload["current_patient"]:
+            items.insert(0, payload["current_patient"])
+        return {item["token_number"]: item for item in items}
+
+    old_items = items_by_token(old)
+    new_items = items_by_token(new)
+
+    delta = {
+        "added": [item for token, item in new_items.items() if token not in old_items],
+        "removed": [token for token in old_items if token not in new_items],
+        "updated": [
+            item for token, item in new_items.items()
+            if token in old_items and _delta_key(item) != _delta_key(old_items[token])
+        ],
+    }
+
+    old_current = old["current_patient"]["token_number"] if old["current_patient"] else None
+    new_current = new["current_patient"]["token_number"] if new["current_patient"] else None
+    if new_current != old_current:
+        delta["current_token"] = new_current
+        if new_current:
+            delta["called"] = new_current
+
+    new_order = [item["token_number"] for item in new["next_patients"]]
+    if new_order != [item["token_number"] for item in old["next_patients"]]:
+        delta["order"] = new_order
+
+    for key in ("total_patients", "estimated_wait_time"):
+        if new[key] != old[key]:
+            delta[key] = new[key]
+
+    return delta
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Check the request's If-None-Match header against an ETag"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Browsers may send several ETags, weak validators compare equal for GET
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag == etag or tag == f"W/{etag}" for tag in candidates)
+
+
+display_cache = DisplaySnapshotCache()
@@ -0,0 +1,77 @@
+"""
+Long-poll waiters for display changes.
+
+Some lobby TV browsers can't keep a Socket.IO connection alive. Instead of
+polling the display endpoint every few seconds they ask for the OPD's changes
+since the content token they last rendered, and the request is parked here, on
+a per-OPD asyncio condition, until display_cache invalidates that OPD (a write
+through this process or one picked up by the change feed) or the timeout
+passes. A parked request holds no database connection and costs nothing until
+the queue actually changes. Whether the change is one the client hasn't seen
+is decided by the caller, from the rebuilt snapshot's content token.
+"""
+
+import asyncio
+from typing import Dict, List, Optional
+from display_cache import display_cache
+
+
+class DisplayChangeWaiters:
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._conditions: Dict[str, asyncio.Condition] = {}
+        self._listening = False
+        self.waiting = 0
+        self.woken = 0
+        self.timeouts = 0
+
+    def _on_invalidate(self, opd_codes: List[str]):
+        # Invalidations also come from sync handlers on worker threads
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        for opd_code in opd_codes:
+            if opd_code in self._conditions:
+                loop.call_soon_threadsafe(lambda opd_code=opd_code: loop.create_task(self._notify(opd_code)))
+
+    async def _notify(self, opd_code: str):
+        condition = self._conditions.get(opd_code)
+        if condition is not None:
+            async with condition:
+                condition.notify_all()
+
+    async def wait(self, opd_code: str, version: int, timeout: float) -> bool:
+        """Wait until the OPD's local change version moves past version; False on timeout"""
+        if not self._listening:
+            display_cache.add_listener(self._on_invalidate)
+            self._listening = True
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._conditions = {}
+
+        changed = lambda: display_cache.get_version(opd_code) != version
+        if changed():
+            return True
+        condition = self._conditions.setdefault(opd_code, asyncio.Condition())
+        self.waiting += 1
+        try:
+            async with condition:
+                await asyncio.wait_for(condition.wait_for(changed), timeout)
+            self.woken += 1
+            return True
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return False
+        finally:
+            self.waiting -= 1
+
+    def metrics(self) -> dict:
+        return {
+            "waiting": self.waiting,
+            "woken": self.woken,
+            "timeouts": self.timeouts,
+        }
+
+
+display_waiters = DisplayChangeWaiters()
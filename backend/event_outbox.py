@@ -0,0 +1,134 @@
+"""
+Sequenced event outbox for resumable client sync.
+
+Every PatientFlow row written through a session also writes an EventOutbox row
+in the same flush, so the event commits or rolls back together with the change
+it describes. The outbox's sequence number gives clients a position: queue and
+display pushes carry the latest seq they reflect, and a client that comes back
+after a dropped connection sends resume(last_seq) and gets just the events it
+missed, or a full snapshot when the gap is too large or has been purged.
+
+On PostgreSQL concurrent transactions could otherwise commit their sequence
+numbers out of order, letting a resuming client skip an event that became
+visible late, so writing an event takes a transaction-level advisory lock that
+serialises outbox commits.
+"""
+
+import os
+from datetime import timedelta
+from typing import List, Optional
+from sqlalchemy import event, func, insert, or_, text
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.util import identity_key
+from database import SessionLocal, EventOutbox, Patient, PatientFlow, get_ist_now
+
+OUTBOX_RESUME_MAX_EVENTS = int(os.getenv("OUTBOX_RESUME_MAX_EVENTS", "200"))
+OUTBOX_RETENTION_HOURS = float(os.getenv("OUTBOX_RETENTION_HOURS", "48"))
+
+# Arbitrary key for pg_advisory_xact_lock, held from an event's insert until its commit
+_OUTBOX_LOCK_KEY = 72_400_019
+
+
+def _opd_from_room(room: Optional[str]) -> Optional[str]:
+    return room[4:] if room and room.startswith("opd_") else None
+
+
+def _build_event(session: Session, flow: PatientFlow) -> EventOutbox:
+    patient = session.identity_map.get(identity_key(Patient, flow.patient_id))
+    opd_codes = []
+    candidates = [_opd_from_room(flow.to_room), _opd_from_room(flow.from_room)]
+    if patient is not None:
+        candidates += [patient.allocated_opd, patient.referred_to]
+    for opd_code in candidates:
+        if opd_code and opd_code not in opd_codes:
+            opd_codes.append(opd_code)
+
+    status = flow.status.value if hasattr(flow.status, "value") else flow.status
+    return EventOutbox(
+        created_at=get_ist_now(),
+        patient_id=flow.patient_id,
+        token_number=patient.token_number if patient is not None else None,
+        status=status,
+        from_room=flow.from_room,
+        to_room=flow.to_room,
+        opd_code=opd_codes[0] if opd_codes else None,
+        related_opd=opd_codes[1] if len(opd_codes) > 1 else None,
+    )
+
+
+def _lock_outbox(session: Session):
+    if session.get_bind().dialect.name == "postgresql":
+        session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _OUTBOX_LOCK_KEY})
+
+
+@event.listens_for(SessionLocal.class_, "before_flush")
+def _write_outbox_events(session, flush_context, instances):
+    flows = [obj for obj in session.new if isinstance(obj, PatientFlow)]
+    if not flows:
+        return
+    _lock_outbox(session)
+    for flow in flows:
+        session.add(_build_event(session, flow))
+
+
+def insert_events(session: Session, events: List[dict]):
+    """
+    Outbox rows for flows written with bulk inserts, which bypass the flush hook.
+    Each dict holds EventOutbox columns; created_at defaults to now.
+    """
+    if not events:
+        return
+    _lock_outbox(session)
+    now = get_ist_now()
+    session.execute(insert(EventOutbox), [{"created_at": now, **entry} for entry in events])
+
+
+def event_to_dict(entry: EventOutbox) -> dict:
+    return {
+        "seq": entry.seq,
+        "created_at": entry.created_at.isoformat() if entry.created_at else None,
+        "patient_id": entry.patient_id,
+        "token_number": entry.token_number,
+        "status": entry.status,
+        "from_room": entry.from_room,
+        "to_room": entry.to_room,
+        "opd_code": entry.opd_code,
+        "related_opd": entry.related_opd,
+    }
+
+
+def latest_seq(db: Session) -> int:
+    return db.query(func.max(EventOutbox.seq)).scalar() or 0
+
+
+def events_since(db: Session, last_seq: Optional[int], opd_codes: Optional[List[str]] = None) -> Optional[List[dict]]:
+    """
+    Events after last_seq (only those touching opd_codes, if given), oldest first.
+    None when the client has to take a full snapshot instead: no position, a
+    position from before the retained events, or more than OUTBOX_RESUME_MAX_EVENTS.
+    """
+    if last_seq is None:
+        return None
+    oldest, newest = db.query(func.min(EventOutbox.seq), func.max(EventOutbox.seq)).one()
+    if newest is None:
+        return [] if last_seq == 0 else None
+    if last_seq > newest or last_seq < oldest - 1:
+        return None
+
+    query = db.query(EventOutbox).filter(EventOutbox.seq > last_seq)
+    if opd_codes is not None:
+        query = query.filter(or_(EventOutbox.opd_code.in_(opd_codes), EventOutbox.related_opd.in_(opd_codes)))
+    entries = query.order_by(EventOutbox.seq).limit(OUTBOX_RESUME_MAX_EVENTS + 1).all()
+    if len(entries) > OUTBOX_RESUME_MAX_EVENTS:
+        return None
+    return [event_to_dict(entry) for entry in entries]
+
+
+def purge_old_events(db: Session) -> int:
+    """Delete events older than OUTBOX_RETENTION_HOURS, keeping the newest so positions stay valid; the caller commits"""
+    cutoff = get_ist_now() - timedelta(hours=OUTBOX_RETENTION_HOURS)
+    newest = latest_seq(db)
+    return db.query(EventOutbox).filter(
+        EventOutbox.created_at < cutoff,
+        EventOutbox.seq < newest
+    ).delete(synchronize_session=False)
@@ -9,11 +9,19 @@ import uvicorn
 from dotenv import load_dotenv
 import os
 from pathlib import Path
+import asyncio
 
-from database import engine, Base
+from database import engine, Base, SessionLocal
 from routers import auth, patients, opd, admin, display, printing, opd_management
-from websocket_manager import sio
+from websocket_manager import sio, broadcast_dispatcher
 from migrate_dilation_flag import add_dilation_flag_column
+from status_counters import status_counters
+from password_pool import password_pool
+from refresh_tokens import purge_expired_refresh_tokens
+from change_feed import change_feed
+from event_outbox import purge_old_events
+from patient_search import patient_search
+from pagination import create_keyset_indexes
 
 load_dotenv()
 
@@ -28,8 +36,53 @@ async def lifespan(app: FastAPI):
         add_dilation_flag_column()
     except Exception as e:
         print(f"Migration warning: {e}")
+
+    # Trigram index behind patient search (pg_trgm on PostgreSQL, FTS5 on SQLite)
+    patient_search.install()
+    try:
+        create_keyset_indexes()
+    except Exception as e:
+        print(f"Keyset pagination indexes not created: {e}")
+
+    # Load the in-memory status counters, then keep checking them against a full recount
+    db = SessionLocal()
+    try:
+        status_counters.rebuild(db)
+    except Exception as e:
+        print(f"Status counters will be built on first use: {e}")
+    finally:
+        db.close()
+    
+    db = SessionLocal()
+    try:
+        purge_expired_refresh_tokens(db)
+        db.commit()
+    except Exception as e:
+        print(f"Refresh token cleanup skipped: {e}")
+    finally:
+        db.close()
+    
+    db = SessionLocal()
+    try:
+        purge_old_events(db)
+        db.commit()
+    except Exception as e:
+        print(f"Event outbox cleanup skipped: {e}")
+    finally:
+        db.close()
+    reconcile_seconds = int(os.getenv("STATS_RECONCILE_SECONDS", "300"))
+    reconcile_task = asyncio.create_task(status_counters.run_reconciliation_loop(reconcile_seconds))
+    # Socket broadcasts run in the background, after the request has been answered
+    broadcast_dispatcher.start()
+    # Pick up queue/patient changes made by other processes, scripts or by hand
+    change_feed.start()
+
     yield
     # Shutdown
+    reconcile_task.cancel()
+    await change_feed.stop()
+    await broadcast_dispatcher.stop()
+    password_pool.shutdown()
 
 app = FastAPI(
     title="Eye Hospital Patient Management System",
@@ -0,0 +1,119 @@
+"""
+In-process map of which OPDs each nursing user may access.
+
+Access checks run on every queue read, call-next, dilate and stats call, so
+instead of querying user_opd_access each time they look the OPD code up in a
+per-user set held here. The sets come from two places:
+
+- Access tokens carry the user's OPD codes as signed claims, stamped with the
+  access version current at login. While that version is still current the
+  claims are used as-is, without touching the database.
+- Otherwise (access changed since login, token from before a restart, claims
+  too old) the set is loaded from the database once and kept.
+
+assign_opd_access/remove_opd_access bump the user's version and drop their
+entry, so a revocation applies immediately in this process. Every entry expires
+after OPD_ACCESS_TTL_SECONDS, which bounds how long a change made by another
+server process can go unnoticed.
+"""
+
+import os
+import threading
+import time
+import uuid
+from typing import Dict, Iterable, Optional, Tuple
+from sqlalchemy.orm import Session
+from database import get_user_opd_access
+
+OPD_ACCESS_TTL_SECONDS = float(os.getenv("OPD_ACCESS_TTL_SECONDS", "300"))
+
+
+class OPDAccessMap:
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # Versions restart with the process, so stamps also carry a per-boot id
+        self._boot_id = uuid.uuid4().hex[:8]
+        self._versions: Dict[int, int] = {}
+        self._entries: Dict[int, Tuple[float, str, frozenset]] = {}  # user_id -> (expires_at, version stamp, OPD codes)
+        self.hits = 0
+        self.claim_loads = 0
+        self.db_loads = 0
+        self.invalidations = 0
+
+    def version_stamp(self, user_id: int) -> str:
+        return f"{self._boot_id}:{self._versions.get(user_id, 0)}"
+
+    def token_claims(self, user_id: int, opd_codes: Iterable[str], version: Optional[str] = None) -> dict:
+        """
+        Claims to embed in a newly issued access token. Pass the version_stamp()
+        taken before opd_codes were read, so a change made during the read
+        outdates the claims instead of being stamped as current.
+        """
+        return {
+            "opds": sorted(opd_codes),
+            "opd_ver": self.version_stamp(user_id) if version is None else version,
+            "opd_at": int(time.time()),
+        }
+
+    def seed_from_claims(self, user_id: int, claims: dict):
+        """Use a token's OPD claims if they are still current and no entry is cached"""
+        opd_codes = claims.get("opds")
+        issued_at = claims.get("opd_at")
+        if opd_codes is None or issued_at is None:
+            return
+        expires_at = issued_at + self.ttl_seconds
+        with self._lock:
+            if claims.get("opd_ver") != self.version_stamp(user_id) or expires_at <= time.time():
+                return
+            if self._get_valid(user_id) is not None:
+                return
+            self._entries[user_id] = (expires_at, claims["opd_ver"], frozenset(opd_codes))
+            self.claim_loads += 1
+
+    def get_allowed(self, user_id: int, db: Session) -> frozenset:
+        """OPD codes the user may access, from the map or, on a miss, the database"""
+        with self._lock:
+            allowed = self._get_valid(user_id)
+            if allowed is not None:
+                self.hits += 1
+                return allowed
+            version = self.version_stamp(user_id)
+
+        allowed = frozenset(get_user_opd_access(db, user_id))
+        with self._lock:
+            self.db_loads += 1
+            # Don't cache a set that was revoked while we were loading it
+            if self.version_stamp(user_id) == version:
+                self._entries[user_id] = (time.time() + self.ttl_seconds, version, allowed)
+        return allowed
+
+    def invalidate(self, user_id: int):
+        """The user's OPD access changed: outdate their token claims and cached set"""
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            self._entries.pop(user_id, None)
+            self.invalidations += 1
+
+    def _get_valid(self, user_id: int) -> Optional[frozenset]:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        expires_at, version, allowed = entry
+        if expires_at <= time.time() or version != self.version_stamp(user_id):
+            del self._entries[user_id]
+            return None
+        return allowed
+
+    def metrics(self) -> dict:
+        return {
+            "ttl_seconds": self.ttl_seconds,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "claim_loads": self.claim_loads,
+            "db_loads": self.db_loads,
+            "invalidations": self.invalidations,
+        }
+
+
+opd_access_map = OPDAccessMap(OPD_ACCESS_TTL_SECONDS)
@@ -0,0 +1,95 @@
+"""
+Bounded worker pool for bcrypt.
+
+A bcrypt hash or verification takes a noticeable amount of CPU time. Run inline
+in an async handler it stalls the event loop, and with it every Socket.IO push
+and display poll, so hashing and verification are sent to a small thread pool
+(bcrypt releases the GIL while it works). A semaphore caps how many run at
+once, callers beyond the cap wait their turn, and when too many are already
+waiting new requests are turned away with a 503 instead of piling up.
+"""
+
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException, status
+from auth import verify_password, get_password_hash
+
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", "4"))
+BCRYPT_MAX_WAITING = int(os.getenv("BCRYPT_MAX_WAITING", "100"))
+
+
+class PasswordHasherPool:
+    def __init__(self, max_workers: int, max_waiting: int):
+        self.max_workers = max_workers
+        self.max_waiting = max_waiting
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bcrypt")
+        self._semaphore = asyncio.Semaphore(max_workers)
+        # Metrics
+        self.running = 0
+        self.waiting = 0
+        self.peak_waiting = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.total_run_seconds = 0.0
+
+    async def _run(self, fn, *args):
+        if self.waiting >= self.max_waiting:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many sign-ins at once, please try again in a moment",
+                headers={"Retry-After": "1"},
+            )
+
+        queued_at = time.perf_counter()
+        self.waiting += 1
+        self.peak_waiting = max(self.peak_waiting, self.waiting)
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        started_at = time.perf_counter()
+        wait_seconds = started_at - queued_at
+        self.total_wait_seconds += wait_seconds
+        self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+        self.running += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, fn, *args)
+        finally:
+            self.running -= 1
+            self.completed += 1
+            self.total_run_seconds += time.perf_counter() - started_at
+            self._semaphore.release()
+
+    async def hash(self, password: str) -> str:
+        return await self._run(get_password_hash, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(verify_password, plain_password, hashed_password)
+
+    def metrics(self) -> dict:
+        completed = self.completed or 1
+        return {
+            "workers": self.max_workers,
+            "max_waiting": self.max_waiting,
+            "running": self.running,
+            "waiting": self.waiting,
+            "peak_waiting": self.peak_waiting,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.total_wait_seconds / completed * 1000, 2),
+            "max_wait_ms": round(self.max_wait_seconds * 1000, 2),
+            "avg_run_ms": round(self.total_run_seconds / completed * 1000, 2),
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+password_pool = PasswordHasherPool(BCRYPT_WORKERS, BCRYPT_MAX_WAITING)
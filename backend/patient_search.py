@@ -0,0 +1,174 @@
+"""
+Indexed patient search.
+
+The registration desk searches patients by any part of their name,
+registration number or token number (`ILIKE '%term%'`), which no B-tree index
+can serve, so every keystroke scanned the whole, ever-growing patients table.
+This sets up an index that can:
+
+- PostgreSQL: pg_trgm GIN indexes on the three columns. They serve the
+  existing ILIKE filter as-is and give similarity() for ranking.
+- SQLite: an FTS5 table with the trigram tokenizer, shadowing the three
+  columns of patients and kept in sync by triggers on insert, update and
+  delete. Substring search becomes a MATCH on it, ranked with bm25().
+
+Terms shorter than three characters have no trigrams and fall back to the
+plain ILIKE filter, as does everything if the index can't be created (no
+permission for CREATE EXTENSION, SQLite without FTS5).
+"""
+
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+from sqlalchemy import Float, Integer, case, func, or_, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import engine, Patient, PatientStatus
+
+MIN_INDEXED_TERM_LENGTH = 3
+
+POSTGRES_SETUP = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_patients_name_trgm ON patients USING gin (name gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_patients_registration_number_trgm ON patients USING gin (registration_number gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_patients_token_number_trgm ON patients USING gin (token_number gin_trgm_ops)",
+]
+
+SQLITE_SETUP = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS patients_fts USING fts5(
+        name, registration_number, token_number,
+        content='patients', content_rowid='id', tokenize='trigram'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS patients_fts_insert AFTER INSERT ON patients BEGIN
+        INSERT INTO patients_fts(rowid, name, registration_number, token_number)
+        VALUES (new.id, new.name, new.registration_number, new.token_number);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS patients_fts_delete AFTER DELETE ON patients BEGIN
+        INSERT INTO patients_fts(patients_fts, rowid, name, registration_number, token_number)
+        VALUES ('delete', old.id, old.name, old.registration_number, old.token_number);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS patients_fts_update AFTER UPDATE OF name, registration_number, token_number ON patients BEGIN
+        INSERT INTO patients_fts(patients_fts, rowid, name, registration_number, token_number)
+        VALUES ('delete', old.id, old.name, old.registration_number, old.token_number);
+        INSERT INTO patients_fts(rowid, name, registration_number, token_number)
+        VALUES (new.id, new.name, new.registration_number, new.token_number);
+    END""",
+]
+
+
+def _fts_query(term: str) -> str:
+    """The term as one quoted FTS5 string, i.e. a plain substring with no query syntax"""
+    return '"' + term.replace('"', '""') + '"'
+
+
+def ilike_condition(term: str):
+    search_term = f"%{term}%"
+    return or_(
+        Patient.registration_number.ilike(search_term),
+        Patient.name.ilike(search_term),
+        Patient.token_number.ilike(search_term)
+    )
+
+
+class PatientSearchIndex:
+    def __init__(self):
+        self.backend: Optional[str] = None  # "trgm", "fts5" or None (plain ILIKE)
+
+    def install(self):
+        """Create the search index for this database if it doesn't exist yet"""
+        dialect = engine.dialect.name
+        try:
+            if dialect == "postgresql":
+                with engine.begin() as conn:
+                    for statement in POSTGRES_SETUP:
+                        conn.execute(text(statement))
+                self.backend = "trgm"
+            elif dialect == "sqlite":
+                with engine.begin() as conn:
+                    existed = conn.execute(text(
+                        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'patients_fts'"
+                    )).first() is not None
+                    for statement in SQLITE_SETUP:
+                        conn.execute(text(statement))
+                    if not existed:
+                        # Index the patients registered before the table existed
+                        conn.execute(text("INSERT INTO patients_fts(patients_fts) VALUES ('rebuild')"))
+                self.backend = "fts5"
+        except Exception as e:
+            self.backend = None
+            print(f"Patient search index unavailable, searching without it: {e}")
+
+    def _uses_fts(self, term: str) -> bool:
+        return self.backend == "fts5" and len(term) >= MIN_INDEXED_TERM_LENGTH
+
+    def _fts_matches(self, term: str):
+        return text(
+            "SELECT rowid FROM patients_fts WHERE patients_fts MATCH :fts_query"
+        ).bindparams(fts_query=_fts_query(term)).columns(rowid=Integer)
+
+    def condition(self, term: str):
+        """WHERE clause for a substring search on name, registration number or token number"""
+        if self._uses_fts(term):
+            return Patient.id.in_(self._fts_matches(term))
+        # Served by the trigram indexes on PostgreSQL
+        return ilike_condition(term)
+
+    async def search(self, db: AsyncSession, term: str, limit: int,
+                     status: Optional[PatientStatus] = None) -> List[Tuple[Patient, float]]:
+        """Patients matching term, best first, with a relevance score (higher is better)"""
+        exact = case(
+            (or_(Patient.token_number == term, Patient.registration_number == term), 1),
+            else_=0
+        )
+        if self._uses_fts(term):
+            ranked = text(
+                "SELECT rowid, bm25(patients_fts) AS rank FROM patients_fts WHERE patients_fts MATCH :fts_query"
+            ).bindparams(fts_query=_fts_query(term)).columns(rowid=Integer, rank=Float).subquery()
+            # bm25() is lower for better matches
+            score = -ranked.c.rank
+            query = select(Patient, score).join(ranked, ranked.c.rowid == Patient.id)
+        elif self.backend == "trgm":
+            score = func.greatest(
+                func.similarity(Patient.name, term),
+                func.similarity(func.coalesce(Patient.registration_number, ""), term),
+                func.similarity(Patient.token_number, term)
+            )
+            query = select(Patient, score).where(ilike_condition(term))
+        else:
+            score = exact
+            query = select(Patient, score).where(ilike_condition(term))
+
+        if status:
+            query = query.where(Patient.current_status == status)
+        query = query.order_by(exact.desc(), score.desc(), Patient.registration_time.desc()).limit(limit)
+        return [(patient, float(patient_score or 0)) for patient, patient_score in (await db.execute(query)).all()]
+
+
+patient_search = PatientSearchIndex()
+
+
+def patient_list_filters(status: Optional[PatientStatus] = None, search: Optional[str] = None,
+                         date_from: Optional[str] = None, date_to: Optional[str] = None) -> list:
+    """WHERE clauses for the patient list's filters, shared by get_patients and the exports"""
+    conditions = []
+    if status:
+        conditions.append(Patient.current_status == status)
+    
+    # Search by registration number, name or token number
+    if search:
+        conditions.append(patient_search.condition(search))
+    
+    # Filter by date range (YYYY-MM-DD)
+    if date_from:
+        try:
+            from_date = datetime.strptime(date_from, "%Y-%m-%d")
+            conditions.append(Patient.registration_time >= from_date)
+        except ValueError:
+            pass  # Invalid date format, ignore filter
+    
+    if date_to:
+        try:
+            to_date = datetime.strptime(date_to, "%Y-%m-%d")
+            # Add 1 day and use < to include the entire end date
+            conditions.append(Patient.registration_time < to_date + timedelta(days=1))
+        except ValueError:
+            pass  # Invalid date format, ignore filter
+    return conditions
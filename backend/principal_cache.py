@@ -0,0 +1,82 @@
+"""
+Short-lived cache of authenticated users.
+
+Every authenticated request resolves the JWT's username to a User row. Nurse
+consoles and dashboards poll constantly, so the resolved user is kept for a
+moment instead of being selected again on every request. Admin changes to a
+user (update, deactivate) invalidate the entry straight away, and the TTL
+bounds how stale anything else can get.
+"""
+
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from database import User
+
+PRINCIPAL_CACHE_TTL_SECONDS = float(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", "60"))
+
+# User columns copied into cached principals
+_USER_FIELDS = ("id", "username", "email", "hashed_password", "role", "is_active", "created_at")
+
+
+class PrincipalCache:
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Tuple[float, User]] = {}  # username -> (expires_at, user)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, username: str) -> Optional[User]:
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[username]
+            self.misses += 1
+            return None
+
+    def put(self, user: User) -> User:
+        """Cache a detached copy of the user, so no request shares another request's session object"""
+        principal = User(**{field: getattr(user, field) for field in _USER_FIELDS})
+        if self.ttl_seconds > 0:
+            with self._lock:
+                self._entries[user.username] = (time.monotonic() + self.ttl_seconds, principal)
+        return principal
+
+    def invalidate(self, *usernames: Optional[str]):
+        with self._lock:
+            for username in usernames:
+                if username and self._entries.pop(username, None) is not None:
+                    self.invalidations += 1
+
+    def invalidate_user(self, user_id: int):
+        """Drop a user's entry by id (their username may have just changed)"""
+        with self._lock:
+            for username, (_, principal) in list(self._entries.items()):
+                if principal.id == user_id:
+                    del self._entries[username]
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def metrics(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "ttl_seconds": self.ttl_seconds,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "invalidations": self.invalidations,
+        }
+
+
+principal_cache = PrincipalCache(PRINCIPAL_CACHE_TTL_SECONDS)
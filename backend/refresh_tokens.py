@@ -0,0 +1,140 @@
+"""
+Refresh tokens with rotation and server-side revocation.
+
+Access tokens are short-lived. Instead of sending staff back through the
+password login (and a bcrypt verification) whenever one expires, the client
+trades its refresh token for a new access token. Refresh tokens are random
+strings; only their HMAC is stored, so checking one is a keyed hash and an
+indexed lookup.
+
+Every refresh rotates the token: the presented token is revoked and a new one
+in the same family (one family per login) is returned. Presenting a token that
+was already rotated away means it has leaked or been replayed, so the whole
+family is revoked. The exception is a token rotated less than
+REFRESH_TOKEN_REUSE_GRACE_SECONDS ago: two tabs refreshing at once, or a retry
+after the response was lost, get another token in the same family instead.
+Logout, deactivating a user and changing their password revoke tokens as well.
+"""
+
+import hashlib
+import hmac
+import os
+import secrets
+import uuid
+from datetime import timedelta
+from typing import Optional, Tuple
+from sqlalchemy.orm import Session
+from database import RefreshToken, User, get_ist_now
+from auth import SECRET_KEY
+
+REFRESH_TOKEN_EXPIRE_HOURS = float(os.getenv("REFRESH_TOKEN_EXPIRE_HOURS", "14"))
+# How long a rotated token can still be refreshed without being treated as a replay
+REFRESH_TOKEN_REUSE_GRACE_SECONDS = float(os.getenv("REFRESH_TOKEN_REUSE_GRACE_SECONDS", "30"))
+
+
+class RefreshTokenError(Exception):
+    """The refresh token can't be used; the message is safe to show to the client"""
+
+
+def _token_hash(token: str) -> str:
+    return hmac.new(SECRET_KEY.encode("utf-8"), token.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def issue_refresh_token(db: Session, user_id: int, family_id: Optional[str] = None) -> Tuple[str, RefreshToken]:
+    """Create a refresh token (a new family unless one is given); the caller commits"""
+    token = secrets.token_urlsafe(32)
+    entry = RefreshToken(
+        user_id=user_id,
+        token_hash=_token_hash(token),
+        family_id=family_id or uuid.uuid4().hex,
+        issued_at=get_ist_now(),
+        expires_at=get_ist_now() + timedelta(hours=REFRESH_TOKEN_EXPIRE_HOURS),
+    )
+    db.add(entry)
+    db.flush()
+    return token, entry
+
+
+def _reuse_allowed(db: Session, entry: RefreshToken, now) -> bool:
+    """Whether a revoked token was rotated recently enough, in a still live family, to be reused"""
+    if entry.replaced_by_id is None:
+        # Revoked by logout or a detected replay, not by rotation
+        return False
+    if now - entry.revoked_at > timedelta(seconds=REFRESH_TOKEN_REUSE_GRACE_SECONDS):
+        return False
+    live = db.query(RefreshToken.id).filter(
+        RefreshToken.family_id == entry.family_id,
+        RefreshToken.revoked_at.is_(None)
+    ).first()
+    return live is not None
+
+
+def rotate_refresh_token(db: Session, token: str) -> Tuple[User, str]:
+    """Check a refresh token and replace it with a new one. Commits."""
+    entry = db.query(RefreshToken).filter(RefreshToken.token_hash == _token_hash(token)).first()
+    if entry is None:
+        raise RefreshTokenError("Invalid refresh token")
+
+    now = get_ist_now()
+    if entry.revoked_at is not None and not _reuse_allowed(db, entry, now):
+        # An already rotated token came back: assume it leaked and end the whole login
+        revoke_refresh_family(db, entry.family_id)
+        db.commit()
+        raise RefreshTokenError("Refresh token has been revoked")
+    if entry.expires_at <= now:
+        raise RefreshTokenError("Refresh token has expired")
+
+    user = db.query(User).filter(User.id == entry.user_id).first()
+    if user is None or not user.is_active:
+        revoke_refresh_family(db, entry.family_id)
+        db.commit()
+        raise RefreshTokenError("Inactive user")
+
+    if entry.revoked_at is None:
+        new_token, new_entry = issue_refresh_token(db, user.id, entry.family_id)
+        # Conditional update so two concurrent refreshes can't both rotate the same token
+        claimed = db.query(RefreshToken).filter(
+            RefreshToken.id == entry.id,
+            RefreshToken.revoked_at.is_(None)
+        ).update({"revoked_at": now, "replaced_by_id": new_entry.id}, synchronize_session=False)
+        if claimed:
+            db.commit()
+            return user, new_token
+        # Rotated or revoked by a concurrent request since we read it
+        db.rollback()
+        db.refresh(entry)
+        if not _reuse_allowed(db, entry, get_ist_now()):
+            raise RefreshTokenError("Refresh token has been revoked")
+
+    # Rotated moments ago by the same client: another token in the family, nothing revoked
+    new_token, _ = issue_refresh_token(db, user.id, entry.family_id)
+    db.commit()
+    return user, new_token
+
+
+def revoke_refresh_token(db: Session, token: str):
+    """Logout: revoke the token's whole family; the caller commits"""
+    entry = db.query(RefreshToken).filter(RefreshToken.token_hash == _token_hash(token)).first()
+    if entry is not None:
+        revoke_refresh_family(db, entry.family_id)
+
+
+def revoke_refresh_family(db: Session, family_id: str):
+    db.query(RefreshToken).filter(
+        RefreshToken.family_id == family_id,
+        RefreshToken.revoked_at.is_(None)
+    ).update({"revoked_at": get_ist_now()}, synchronize_session=False)
+
+
+def revoke_user_refresh_tokens(db: Session, user_id: int):
+    """Revoke every refresh token of a user (deactivated, password changed); the caller commits"""
+    db.query(RefreshToken).filter(
+        RefreshToken.user_id == user_id,
+        RefreshToken.revoked_at.is_(None)
+    ).update({"revoked_at": get_ist_now()}, synchronize_session=False)
+
+
+def purge_expired_refresh_tokens(db: Session) -> int:
+    """Delete tokens that expired more than a day ago; the caller commits"""
+    cutoff = get_ist_now() - timedelta(days=1)
+    return db.query(RefreshToken).filter(RefreshToken.expires_at < cutoff).delete(synchronize_session=False)
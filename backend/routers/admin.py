@@ -1,11 +1,24 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session, contains_eager
 from sqlalchemy import func, desc
 from typing import List, Optional
 from datetime import datetime, date, timedelta
 from pydantic import BaseModel
 from database import get_db, User, Room, Patient, Queue, PatientStatus, OPD, PatientFlow, UserRole, get_ist_now, UserOPDAccess, get_user_opd_access
 from auth import get_current_active_user, require_role, UserCreate, UserUpdate, UserResponse
+from display_cache import display_cache
+from status_counters import status_counters
+from password_pool import password_pool
+from principal_cache import principal_cache
+from opd_access import opd_access_map
+from refresh_tokens import revoke_user_refresh_tokens
+from websocket_manager import broadcast_dispatcher
+from change_feed import change_feed
+from display_waiters import display_waiters
+from exports import EXPORT_FORMATS, export_patients, export_patient_flows
+from patient_search import patient_list_filters
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, NEXT_CURSOR_HEADER, InvalidCursor, after_position, decode_cursor, encode_cursor
 
 router = APIRouter()
 
@@ -36,6 +49,8 @@ class DashboardStats(BaseModel):
     total_patients_dilated: int
     total_patients_completed: int
     avg_waiting_time: Optional[float]
+    p50_waiting_time: Optional[float] = None
+    p90_waiting_time: Optional[float] = None
     opd_stats: List[dict]
 
 class PatientFlowResponse(BaseModel):
@@ -129,8 +144,7 @@ async def create_user(
     if db.query(User).filter(User.email == user_data.email).first():
         raise HTTPException(status_code=400, detail="Email already exists")
     
-    from auth import get_password_hash
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await password_pool.hash(user_data.password)
     
     db_user = User(
         username=user_data.username,
@@ -180,8 +194,9 @@ async def update_user(
     
     # Update password if provided
     if user_data.password is not None and user_data.password.strip():
-        from auth import get_password_hash
-        user.hashed_password = get_password_hash(user_data.password)
+        user.hashed_password = await password_pool.hash(user_data.password)
+        # Sessions started with the old password have to log in again
+        revoke_user_refresh_tokens(db, user.id)
     
     # Update role if provided
     if user_data.role is not None:
@@ -189,6 +204,7 @@ async def update_user(
     
     db.commit()
     db.refresh(user)
+    principal_cache.invalidate_user(user.id)
     
     return user
 
@@ -206,7 +222,9 @@ async def deactivate_user(
         raise HTTPException(status_code=400, detail="Cannot deactivate yourself")
     
     user.is_active = False
+    revoke_user_refresh_tokens(db, user.id)
     db.commit()
+    principal_cache.invalidate_user(user.id)
     
     return {"message": "User deactivated successfully"}
 
@@ -275,6 +293,7 @@ async def assign_opd_access(
         db.add(access_entry)
     
     db.commit()
+    opd_access_map.invalidate(user_id)
     
     return {
         "message": f"OPD access updated for user '{user.username}'",
@@ -308,6 +327,7 @@ async def remove_opd_access(
     
     db.delete(access_entry)
     db.commit()
+    opd_access_map.invalidate(user_id)
     
     return {
         "message": f"Access to OPD '{opd_code}' removed for user '{user.username}'"
@@ -345,87 +365,98 @@ async def get_dashboard_stats(
     db: Session = Depends(get_db),
     current_user: User = Depends(require_role(UserRole.ADMIN))
 ):
-    today = get_ist_now().date()
-    
-    # Get today's patient statistics
-    total_patients_today = db.query(Patient).filter(
-        func.date(Patient.registration_time) == today
-    ).count()
-    
-    total_patients_pending = db.query(Patient).filter(
-        Patient.current_status == PatientStatus.PENDING
-    ).count()
-    
-    total_patients_in_opd = db.query(Patient).filter(
-        Patient.current_status == PatientStatus.IN_OPD
-    ).count()
-    
-    total_patients_dilated = db.query(Patient).filter(
-        Patient.current_status == PatientStatus.DILATED
-    ).count()
-    
-    total_patients_completed = db.query(Patient).filter(
-        Patient.current_status == PatientStatus.COMPLETED,
-        func.date(Patient.completed_at) == today
-    ).count()
-    
-    # Calculate average waiting time
-    completed_patients = db.query(Patient).filter(
-        Patient.current_status == PatientStatus.COMPLETED,
-        func.date(Patient.completed_at) == today
-    ).all()
-    
-    avg_waiting_time = None
-    if completed_patients:
-        total_waiting_time = 0
-        for patient in completed_patients:
-            if patient.completed_at:
-                waiting_time = (patient.completed_at - patient.registration_time).total_seconds() / 60
-                total_waiting_time += waiting_time
-        avg_waiting_time = total_waiting_time / len(completed_patients)
+    summary = status_counters.get_summary(db)
     
     # Get OPD-wise statistics
-    opd_stats = []
-    # Get all active OPDs from database
     active_opds = db.query(OPD).filter(OPD.is_active == True).all()
+    counts = status_counters.get_opd_counts(db, [opd.opd_code for opd in active_opds], include_allocated=True)
+    opd_stats = []
     for opd in active_opds:
-        opd_type = opd.opd_code
-        opd_patients = db.query(Patient).filter(Patient.allocated_opd == opd_type).count()
-        opd_pending = db.query(Queue).filter(
-            Queue.opd_type == opd_type,
-            Queue.status == PatientStatus.PENDING
-        ).count()
-        opd_in_progress = db.query(Queue).filter(
-            Queue.opd_type == opd_type,
-            Queue.status == PatientStatus.IN_OPD
-        ).count()
-        opd_completed = db.query(Patient).filter(
-            Patient.current_status == PatientStatus.COMPLETED,
-            func.date(Patient.completed_at) == today
-        ).count()
-        
+        opd_counts = counts[opd.opd_code]
         opd_stats.append({
-            "opd_type": opd_type,
-            "total_patients": opd_patients,
-            "pending": opd_pending,
-            "in_progress": opd_in_progress,
-            "completed_today": opd_completed
+            "opd_type": opd.opd_code,
+            "total_patients": opd_counts.allocated_patients,
+            "pending": opd_counts.pending,
+            "in_progress": opd_counts.in_opd,
+            "completed_today": summary.completed_today
         })
     
     return DashboardStats(
-        total_patients_today=total_patients_today,
-        total_patients_pending=total_patients_pending,
-        total_patients_in_opd=total_patients_in_opd,
-        total_patients_dilated=total_patients_dilated,
-        total_patients_completed=total_patients_completed,
-        avg_waiting_time=avg_waiting_time,
+        total_patients_today=summary.total_patients_today,
+        total_patients_pending=summary.pending,
+        total_patients_in_opd=summary.in_opd,
+        total_patients_dilated=summary.dilated,
+        total_patients_completed=summary.completed_today,
+        avg_waiting_time=summary.avg_turnaround_minutes,
+        p50_waiting_time=summary.p50_turnaround_minutes,
+        p90_waiting_time=summary.p90_turnaround_minutes,
         opd_stats=opd_stats
     )
 
+@router.get("/stats/counters")
+async def get_status_counters(
+    reconcile: bool = False,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(require_role(UserRole.ADMIN))
+):
+    """In-memory status counters, optionally checked against a full recount first"""
+    if reconcile:
+        status_counters.reconcile(db)
+    status_counters.get_summary(db)  # Make sure the counters are loaded
+    return {
+        "counters": status_counters.snapshot(),
+        "rebuilds": status_counters.rebuilds,
+        "last_reconciliation": status_counters.last_reconciliation
+    }
+
+@router.get("/stats/password-pool")
+async def get_password_pool_metrics(
+    current_user: User = Depends(require_role(UserRole.ADMIN))
+):
+    """Load of the bcrypt worker pool used for sign-ins and password changes"""
+    return password_pool.metrics()
+
+@router.get("/stats/principal-cache")
+async def get_principal_cache_metrics(
+    current_user: User = Depends(require_role(UserRole.ADMIN))
+):
+    """Hit/miss counters of the authenticated-user cache"""
+    return principal_cache.metrics()
+
+@router.get("/stats/opd-access")
+async def get_opd_access_map_metrics(
+    current_user: User = Depends(require_role(UserRole.ADMIN))
+):
+    """Counters of the in-process OPD access map"""
+    return opd_access_map.metrics()
+
+@router.get("/stats/broadcasts")
+async def get_broadcast_metrics(
+    current_user: User = Depends(require_role(UserRole.ADMIN))
+):
+    """Socket.IO changes received versus broadcasts emitted, per room"""
+    return broadcast_dispatcher.metrics()
+
+@router.get("/stats/change-feed")
+async def get_change_feed_metrics(
+    current_user: User = Depends(require_role(UserRole.ADMIN))
+):
+    """Changes seen on the database change feed and how many came from other processes"""
+    return change_feed.metrics()
+
+@router.get("/stats/display-waiters")
+async def get_display_waiter_metrics(
+    current_user: User = Depends(require_role(UserRole.ADMIN))
+):
+    """Display long polls currently parked, woken by a change, or timed out"""
+    return display_waiters.metrics()
+
 @router.get("/patient-flows", response_model=List[PatientFlowResponse])
 async def get_patient_flows(
-    skip: int = 0,
-    limit: int = 100,
+    response: Response,
+    skip: Optional[int] = Query(None, ge=0),  # Offset paging, kept for compatibility; cursor paging when omitted
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1),  # At most MAX_PAGE_SIZE with cursor paging
+    cursor: Optional[str] = Query(None),  # X-Next-Cursor of the previous page
     patient_id: Optional[int] = None,
     opd_type: Optional[str] = None,
     start_date: Optional[date] = None,
@@ -433,7 +464,7 @@ async def get_patient_flows(
     db: Session = Depends(get_db),
     current_user: User = Depends(require_role(UserRole.ADMIN))
 ):
-    query = db.query(PatientFlow).join(Patient)
+    query = db.query(PatientFlow).join(Patient).options(contains_eager(PatientFlow.patient))
     
     if patient_id:
         query = query.filter(PatientFlow.patient_id == patient_id)
@@ -447,7 +478,20 @@ async def get_patient_flows(
     if end_date:
         query = query.filter(func.date(PatientFlow.timestamp) <= end_date)
     
-    flows = query.order_by(desc(PatientFlow.timestamp)).offset(skip).limit(limit).all()
+    if skip is not None:
+        flows = query.order_by(desc(PatientFlow.timestamp)).offset(skip).limit(limit).all()
+    else:
+        # Cursor pagination: the page after the last (timestamp, id) handed out
+        limit = min(limit, MAX_PAGE_SIZE)
+        if cursor:
+            try:
+                timestamp, flow_id = decode_cursor("patient_flows", cursor)
+            except InvalidCursor as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            query = query.filter(after_position(PatientFlow.timestamp, PatientFlow.id, timestamp, flow_id))
+        flows = query.order_by(desc(PatientFlow.timestamp), desc(PatientFlow.id)).limit(limit).all()
+        if len(flows) == limit:
+            response.headers[NEXT_CURSOR_HEADER] = encode_cursor("patient_flows", flows[-1].timestamp, flows[-1].id)
     
     flow_data = []
     for flow in flows:
@@ -465,6 +509,40 @@ async def get_patient_flows(
     
     return flow_data
 
+def export_response(rows, name: str, export_format: str) -> StreamingResponse:
+    filename = f"{name}-{get_ist_now():%Y%m%d-%H%M}.{export_format}"
+    return StreamingResponse(
+        rows,
+        media_type=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@router.get("/export/patients")
+async def export_patients_stream(
+    export_format: str = Query("csv", alias="format", pattern="^(csv|ndjson)$"),
+    status: Optional[PatientStatus] = None,
+    search: Optional[str] = Query(None),
+    date_from: Optional[str] = Query(None),  # Registration date range (YYYY-MM-DD), as in the patient list
+    date_to: Optional[str] = Query(None),
+    current_user: User = Depends(require_role(UserRole.ADMIN))
+):
+    """Stream every patient matching the patient list filters as CSV or NDJSON"""
+    conditions = patient_list_filters(status, search, date_from, date_to)
+    return export_response(export_patients(conditions, export_format), "patients", export_format)
+
+@router.get("/export/patient-flows")
+async def export_patient_flows_stream(
+    export_format: str = Query("csv", alias="format", pattern="^(csv|ndjson)$"),
+    status: Optional[PatientStatus] = None,
+    search: Optional[str] = Query(None),
+    date_from: Optional[str] = Query(None),
+    date_to: Optional[str] = Query(None),
+    current_user: User = Depends(require_role(UserRole.ADMIN))
+):
+    """Stream the flows of every patient matching the patient list filters as CSV or NDJSON"""
+    conditions = patient_list_filters(status, search, date_from, date_to)
+    return export_response(export_patient_flows(conditions, export_format), "patient-flows", export_format)
+
 @router.delete("/patients/{patient_id}")
 async def delete_patient(
     patient_id: int,
@@ -485,11 +563,13 @@ async def delete_patient(
     db.query(PatientFlow).filter(PatientFlow.patient_id == patient_id).delete()
     
     # Delete queue entries
+    affected_opds = {opd_type for (opd_type,) in db.query(Queue.opd_type).filter(Queue.patient_id == patient_id).all()}
     db.query(Queue).filter(Queue.patient_id == patient_id).delete()
     
     # Delete the patient
     db.delete(patient)
     db.commit()
+    display_cache.invalidate(*affected_opds)
     
     return {
         "message": f"Patient {patient.name} (Token: {patient.token_number}) deleted successfully",
@@ -1,11 +1,15 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import timedelta
-from typing import List
+from typing import List, Optional
 from pydantic import BaseModel
-from database import get_db, User, UserRole, get_user_opd_access
+from database import get_db, get_async_db, User, UserRole, get_user_opd_access
+from password_pool import password_pool
+from opd_access import opd_access_map
+from refresh_tokens import RefreshTokenError, issue_refresh_token, rotate_refresh_token, revoke_refresh_token
 from auth import (
-    authenticate_user, create_access_token, get_password_hash,
+    authenticate_user_async, create_access_token,
     get_current_active_user, UserLogin, UserCreate, UserResponse, Token, ACCESS_TOKEN_EXPIRE_MINUTES
 )
 
@@ -17,32 +21,73 @@ class LoginResponse(BaseModel):
     token_type: str
     user: UserResponse
     allowed_opds: List[str]  # OPD codes user has access to
+    refresh_token: Optional[str] = None  # Trade for a new access token at /refresh instead of logging in again
+
+class RefreshTokenRequest(BaseModel):
+    refresh_token: str
 
 @router.post("/login", response_model=LoginResponse)
-async def login(user_credentials: UserLogin, db: Session = Depends(get_db)):
-    user = authenticate_user(db, user_credentials.username, user_credentials.password)
+async def login(user_credentials: UserLogin, db: AsyncSession = Depends(get_async_db)):
+    user = await authenticate_user_async(db, user_credentials.username, user_credentials.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
-    )
+    refresh_token, _ = await db.run_sync(lambda session: issue_refresh_token(session, user.id))
+    await db.commit()
+    
+    response = await build_login_response(user, db)
+    response["refresh_token"] = refresh_token
+    return response
+
+@router.post("/refresh", response_model=LoginResponse)
+async def refresh(payload: RefreshTokenRequest, db: AsyncSession = Depends(get_async_db)):
+    """Rotate a refresh token and issue a new access token, without a password check"""
+    try:
+        user, refresh_token = await db.run_sync(lambda session: rotate_refresh_token(session, payload.refresh_token))
+    except RefreshTokenError as e:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail=str(e),
+            headers={"WWW-Authenticate": "Bearer"},
+        )
     
+    response = await build_login_response(user, db)
+    response["refresh_token"] = refresh_token
+    return response
+
+@router.post("/logout")
+async def logout(payload: RefreshTokenRequest, db: AsyncSession = Depends(get_async_db)):
+    """Revoke the refresh token (and its earlier rotations)"""
+    await db.run_sync(lambda session: revoke_refresh_token(session, payload.refresh_token))
+    await db.commit()
+    return {"message": "Logged out"}
+
+async def build_login_response(user: User, db: AsyncSession) -> dict:
+    """Access token, user and allowed OPDs, as returned by login and refresh"""
     # Get user's allowed OPDs (only for nursing staff)
     allowed_opds = []
+    token_data = {"sub": user.username}
     if user.role == UserRole.NURSING:
-        allowed_opds = get_user_opd_access(db, user.id)
+        # Stamped before the read: access changed meanwhile makes the claims stale, not current
+        access_version = opd_access_map.version_stamp(user.id)
+        allowed_opds = await db.run_sync(lambda session: get_user_opd_access(session, user.id))
+        # Signed into the token so OPD access checks don't need the database
+        token_data.update(opd_access_map.token_claims(user.id, allowed_opds, access_version))
     elif user.role == UserRole.ADMIN:
         # Admin has access to all OPDs
         from database import OPD
-        all_opds = db.query(OPD).filter(OPD.is_active == True).all()
+        all_opds = await db.run_sync(lambda session: session.query(OPD).filter(OPD.is_active == True).all())
         allowed_opds = [opd.opd_code for opd in all_opds]
     # Registration staff doesn't need OPD access (allowed_opds remains empty)
     
+    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    access_token = create_access_token(
+        data=token_data, expires_delta=access_token_expires
+    )
+    
     return {
         "access_token": access_token,
         "token_type": "bearer",
@@ -71,7 +116,7 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
         )
     
     # Create new user
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await password_pool.hash(user_data.password)
     db_user = User(
         username=user_data.username,
         email=user_data.email,
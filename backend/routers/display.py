@@ -1,16 +1,23 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from sqlalchemy import func
+import asyncio
+from fastapi import APIRouter, Depends, HTTPException, Query, status, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
 from datetime import datetime, timedelta
 from pydantic import BaseModel
-from database import get_db, Patient, Queue, PatientStatus, OPD, get_ist_now
+from database import get_async_db, AsyncSessionLocal, PatientStatus, get_ist_now
 from auth import get_current_active_user, User
-from .opd import get_opd_queue, get_queue_data
+from display_cache import display_cache, etag_matches, waiting_minutes
+from display_waiters import display_waiters
+from status_counters import status_counters
+import os
 import pytz
 ist = pytz.timezone('Asia/Kolkata')
 router = APIRouter()
 
+# How long a /changes long poll is held open when nothing changes (and the most a client may ask for)
+DISPLAY_LONG_POLL_SECONDS = float(os.getenv("DISPLAY_LONG_POLL_SECONDS", "25"))
+DISPLAY_LONG_POLL_MAX_SECONDS = 60
+
 # Pydantic models
 class DisplayQueueItem(BaseModel):
     position: int
@@ -34,17 +41,59 @@ class AllOPDsDisplayData(BaseModel):
     opds: List[DisplayData]
     last_updated: datetime
 
+class DisplayChanges(BaseModel):
+    version: str  # Pass back as ?since= on the next call
+    data: DisplayData
+
 @router.get("/opd/{opd_type}", response_model=DisplayData)
 async def get_opd_display_data(
     opd_type: str,
-    db: Session = Depends(get_db)
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_async_db)
 ):
     # Normalize OPD code to lowercase for database lookup
     opd_type = opd_type.lower()
-    unformatted_opd_data = get_queue_data(opd_type, db, None)
-    formatted_opd_data = format_opd_data(opd_type, unformatted_opd_data)
     
-    return formatted_opd_data
+    # Unchanged since the client's last poll - skip the database and serialization
+    etag = display_cache.etag([opd_type], scope="display")
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    
+    snapshot = await db.run_sync(lambda session: display_cache.get_snapshot(opd_type, session))
+    response.headers["ETag"] = display_cache.snapshot_etag([snapshot], scope="display")
+    response.headers["Cache-Control"] = "no-cache"
+    
+    return snapshot.display
+
+@router.get("/opd/{opd_type}/changes", response_model=DisplayChanges)
+async def get_opd_display_changes(
+    opd_type: str,
+    since: Optional[str] = None,
+    timeout: Optional[float] = Query(None, gt=0, le=DISPLAY_LONG_POLL_MAX_SECONDS)
+):
+    """
+    Long poll for screens without a Socket.IO connection. Answers with the display
+    data as soon as the OPD's queue differs from the one `since` was issued for
+    (straight away without `since`), or with 204 once the timeout passes without a
+    change. The version is a token of the queue contents, so it means the same on
+    every API worker. The wait holds no database connection.
+    """
+    opd_type = opd_type.lower()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + (timeout or DISPLAY_LONG_POLL_SECONDS)
+    while True:
+        async with AsyncSessionLocal() as db:
+            snapshot = await db.run_sync(lambda session: display_cache.get_snapshot(opd_type, session))
+        if snapshot.content_token != since:
+            return {
+                "version": snapshot.content_token,
+                "data": snapshot.display
+            }
+        # Invalidated, but rebuilt to the queue the client already has: keep waiting
+        remaining = deadline - loop.time()
+        if remaining <= 0 or not await display_waiters.wait(opd_type, snapshot.version, remaining):
+            return Response(status_code=204, headers={"Cache-Control": "no-cache"})
 
 def format_opd_data(opd_type, opd_data):
     if len(opd_data) < 1:
@@ -55,9 +104,9 @@ def format_opd_data(opd_type, opd_data):
             total_patients = 0,
             estimated_wait_time = 0
         )
+    now = get_ist_now()
     curr = opd_data[0]
-    if curr.registration_time:
-        waiting_time = int((get_ist_now() - curr.registration_time).total_seconds() / 60)
+    waiting_time = waiting_minutes(curr.registration_time, now)
     
     current_patient = DisplayQueueItem(position=curr.position,
                                        token_number=curr.token_number,
@@ -68,9 +117,7 @@ def format_opd_data(opd_type, opd_data):
 
     next_patients = []
     for entry in opd_data[1:]:
-        waiting_time = None
-        if entry.registration_time:
-            waiting_time = int((get_ist_now() - entry.registration_time).total_seconds() / 60)
+        waiting_time = waiting_minutes(entry.registration_time, now)
         
         next_patients.append(DisplayQueueItem(
             position=entry.position,
@@ -95,25 +142,22 @@ def format_opd_data(opd_type, opd_data):
 
 @router.get("/all", response_model=AllOPDsDisplayData)
 async def get_all_opds_display_data(
-    db: Session = Depends(get_db)
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get display data for all OPDs - used by display screens"""
     try:
-        opds_data = []
+        active_opds = await db.run_sync(display_cache.get_active_opds)
+        etag = display_cache.etag(active_opds, scope="all")
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
         
-        # Get all active OPDs from database
-        active_opds = db.query(OPD).filter(OPD.is_active == True).all()
-        for opd in active_opds:
-            unformatted_opd_data = get_queue_data(opd.opd_code, db, None)
-            opd_data = format_opd_data(opd.opd_code, unformatted_opd_data)
-            #opd_data = await get_opd_display_data(opd.opd_code, db)
-            #print("********************")
-            #print(opd_data)
-            
-            if opd_data is not None:
-                opds_data.append(opd_data)
-        
-
+        # Served from the shared per-OPD snapshots, only stale OPDs hit the database
+        snapshots = await db.run_sync(display_cache.get_all_snapshots)
+        opds_data = [snapshot.display for snapshot in snapshots]
+        response.headers["ETag"] = display_cache.snapshot_etag(snapshots, scope="all")
+        response.headers["Cache-Control"] = "no-cache"
 
         return AllOPDsDisplayData(
             opds=opds_data,
@@ -127,50 +171,28 @@ async def get_all_opds_display_data(
 
 @router.get("/")
 async def get_display_home(
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Main display route - shows all OPDs with current status"""
     today = get_ist_now().date()
     
     # Get today's summary statistics
-    total_patients_today = db.query(Patient).filter(
-        func.date(Patient.registration_time) == today
-    ).count()
-    
-    total_pending = db.query(Patient).filter(
-        Patient.current_status == PatientStatus.PENDING
-    ).count()
-    
-    total_in_opd = db.query(Patient).filter(
-        Patient.current_status == PatientStatus.IN_OPD
-    ).count()
-    
-    total_dilated = db.query(Patient).filter(
-        Patient.current_status == PatientStatus.DILATED
-    ).count()
-    
-    total_completed = db.query(Patient).filter(
-        Patient.current_status == PatientStatus.COMPLETED,
-        func.date(Patient.completed_at) == today
-    ).count()
+    summary = await db.run_sync(status_counters.get_summary)
     
     # Get OPD-wise data
-    opds_data = []
-    active_opds = db.query(OPD).filter(OPD.is_active == True).all()
-    for opd in active_opds:
-        opd_data = await get_opd_display_data(opd.opd_code, db)
-        opds_data.append(opd_data)
+    snapshots = await db.run_sync(display_cache.get_all_snapshots)
+    opds_data = [snapshot.display for snapshot in snapshots]
     
     return {
         "hospital_name": "Eye Hospital",
         "date": today.isoformat(),
         "time": get_ist_now().strftime("%H:%M:%S"),
         "summary": {
-            "total_patients_today": total_patients_today,
-            "total_pending": total_pending,
-            "total_in_opd": total_in_opd,
-            "total_dilated": total_dilated,
-            "total_completed": total_completed
+            "total_patients_today": summary.total_patients_today,
+            "total_pending": summary.pending,
+            "total_in_opd": summary.in_opd,
+            "total_dilated": summary.dilated,
+            "total_completed": summary.completed_today
         },
         "opds": opds_data,
         "last_updated": get_ist_now().isoformat()
@@ -180,23 +202,19 @@ async def get_display_home(
 async def get_waiting_list(
     opd_type: str,
     limit: int = 10,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    unformatted_opd_data = get_queue_data(opd_type, db, None)
-    print("******************************** ->>>>> ", len(unformatted_opd_data))
+    snapshot = await db.run_sync(lambda session: display_cache.get_snapshot(opd_type.lower(), session))
+    now = get_ist_now()
     waiting_list = []
-    for entry in unformatted_opd_data:
-        waiting_time = None
-        if entry.registration_time:
-            waiting_time = int((get_ist_now() - entry.registration_time).total_seconds() / 60)
-        
+    for entry in snapshot.queue:
         waiting_list.append({
             "position": entry.position,
             "token_number": entry.token_number,
             "patient_name": entry.patient_name,
             "age": entry.age,
             "status": entry.status,
-            "waiting_time_minutes": waiting_time,
+            "waiting_time_minutes": waiting_minutes(entry.registration_time, now),
             "is_dilated": entry.is_dilated,
             "registration_time": entry.registration_time.isoformat()
         })
@@ -209,68 +227,36 @@ async def get_waiting_list(
 
 @router.get("/stats/overview")
 async def get_display_overview(
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get overview statistics for display screens"""
     today = get_ist_now().date()
     
-    # Get today's statistics
-    total_patients_today = db.query(Patient).filter(
-        func.date(Patient.registration_time) == today
-    ).count()
-    
-    total_pending = db.query(Patient).filter(
-        Patient.current_status == PatientStatus.PENDING
-    ).count()
-    
-    total_in_opd = db.query(Patient).filter(
-        Patient.current_status == PatientStatus.IN_OPD
-    ).count()
-    
-    total_dilated = db.query(Patient).filter(
-        Patient.current_status == PatientStatus.DILATED
-    ).count()
-    
-    total_completed = db.query(Patient).filter(
-        Patient.current_status == PatientStatus.COMPLETED,
-        func.date(Patient.completed_at) == today
-    ).count()
+    summary = await db.run_sync(status_counters.get_summary)
     
     # Get OPD-wise counts
+    active_opds = await db.run_sync(display_cache.get_active_opds)
+    counts = await db.run_sync(lambda session: status_counters.get_opd_counts(session, active_opds))
     opd_counts = {}
-    active_opds = db.query(OPD).filter(OPD.is_active == True).all()
-    for opd in active_opds:
-        opd_type = opd.opd_code
-        opd_pending = db.query(Queue).filter(
-            Queue.opd_type == opd_type,
-            Queue.status == PatientStatus.PENDING
-        ).count()
-        
-        opd_in_progress = db.query(Queue).filter(
-            Queue.opd_type == opd_type,
-            Queue.status == PatientStatus.IN_OPD
-        ).count()
-        
-        opd_dilated = db.query(Queue).filter(
-            Queue.opd_type == opd_type,
-            Queue.status == PatientStatus.DILATED
-        ).count()
-        
+    for opd_type in active_opds:
         opd_counts[opd_type] = {
-            "pending": opd_pending,
-            "in_progress": opd_in_progress,
-            "dilated": opd_dilated,
-            "total": opd_pending + opd_in_progress + opd_dilated
+            "pending": counts[opd_type].pending,
+            "in_progress": counts[opd_type].in_opd,
+            "dilated": counts[opd_type].dilated,
+            "total": counts[opd_type].pending + counts[opd_type].in_opd + counts[opd_type].dilated
         }
     
     return {
         "date": today.isoformat(),
         "summary": {
-            "total_patients_today": total_patients_today,
-            "total_pending": total_pending,
-            "total_in_opd": total_in_opd,
-            "total_dilated": total_dilated,
-            "total_completed": total_completed
+            "total_patients_today": summary.total_patients_today,
+            "total_pending": summary.pending,
+            "total_in_opd": summary.in_opd,
+            "total_dilated": summary.dilated,
+            "total_completed": summary.completed_today,
+            "avg_turnaround_minutes": summary.avg_turnaround_minutes,
+            "p50_turnaround_minutes": summary.p50_turnaround_minutes,
+            "p90_turnaround_minutes": summary.p90_turnaround_minutes
         },
         "opd_counts": opd_counts,
         "last_updated": get_ist_now().isoformat()
@@ -1,12 +1,15 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from sqlalchemy import func
+from fastapi import APIRouter, Depends, HTTPException, status, Request, Response
+from sqlalchemy.orm import contains_eager
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
 from typing import List, Optional
 from datetime import datetime, timedelta
 from pydantic import BaseModel
-from database import get_db, Patient, Queue, PatientStatus, OPD, PatientFlow, get_ist_now
-from auth import get_current_active_user, User, require_role, check_opd_access, UserRole
-from websocket_manager import broadcast_queue_update, broadcast_patient_status_update, broadcast_display_update
+from database import get_async_db, Patient, Queue, PatientStatus, OPD, PatientFlow, get_ist_now
+from auth import get_current_active_user, User, require_role, check_opd_access_async, UserRole
+from websocket_manager import broadcast_dispatcher
+from display_cache import display_cache, etag_matches
+from status_counters import status_counters
 import pytz
 ist = pytz.timezone('Asia/Kolkata')
 router = APIRouter()
@@ -41,6 +44,8 @@ class OPDStats(BaseModel):
     referred_patients: int
     completed_today: int
     avg_waiting_time: Optional[float]
+    p50_waiting_time: Optional[float] = None
+    p90_waiting_time: Optional[float] = None
     
 class DilatePatientRequest(BaseModel):
     remarks: Optional[str] = None
@@ -48,144 +53,160 @@ class DilatePatientRequest(BaseModel):
 @router.get("/{opd_type}/queue", response_model=List[QueueResponse])
 async def get_opd_queue(
     opd_type: str,
-    db: Session = Depends(get_db),
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_active_user)
 ):
     # Convert to lowercase to match database
     opd_type = opd_type.lower()
     
     # Check OPD access
-    check_opd_access(current_user, opd_type, db)
+    await check_opd_access_async(current_user, opd_type, db)
     
-    queue_data = get_queue_data(opd_type, db, current_user)
+    # Queue unchanged since the client's last poll
+    etag = display_cache.etag([opd_type], scope="queue")
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    
+    # Same pre-built queue the display screens use, invalidated on every mutation
+    snapshot = await db.run_sync(lambda session: display_cache.get_snapshot(opd_type, session))
+    queue_data = snapshot.queue
+    response.headers["ETag"] = display_cache.snapshot_etag([snapshot], scope="queue")
+    response.headers["Cache-Control"] = "no-cache"
     
     return queue_data
 
+# Only the columns needed to build a QueueResponse, selected directly so no
+# Queue/Patient ORM objects are hydrated and no lazy relationship loads happen
+QUEUE_ROW_COLUMNS = (
+    Queue.id,
+    Queue.patient_id,
+    Queue.opd_type,
+    Queue.status,
+    Patient.token_number,
+    Patient.name,
+    Patient.registration_time,
+    Patient.is_dilated,
+    Patient.dilation_time,
+    Patient.age,
+    Patient.phone,
+    Patient.current_status,
+    Patient.referred_from,
+    Patient.dilation_flag,
+)
+
+ACTIVE_QUEUE_STATUSES = [PatientStatus.PENDING, PatientStatus.IN_OPD, PatientStatus.DILATED, PatientStatus.REFERRED]
+
 def get_queue_data(opd_type, db, current_user):
-    #print(f"\n{'='*60}")
-    #print(f"=== GET QUEUE FOR OPD: {opd_type} ===")
-    #print(f"!!! CODE VERSION: 2024-11-14-v3 !!!")
-    #print(f"{'='*60}")
-    
-    # Validate OPD exists and is active
-    opd = db.query(OPD).filter(OPD.opd_code == opd_type, OPD.is_active == True).first()
-    if not opd:
-        print(f"ERROR: OPD {opd_type} not found or inactive")
+    # Validate OPD exists and is active (cached list, no query in steady state)
+    if opd_type not in display_cache.get_active_opds(db):
         raise HTTPException(status_code=404, detail="OPD not found or inactive")
-    #print(f"✓ OPD found: {opd.opd_code} - {opd.opd_name}")
     
-    # First, let's see ALL queue entries for this OPD
-    #all_queue_entries = db.query(Queue).filter(Queue.opd_type == opd_type).all()
-    #print(f"✓ Total queue entries for {opd_type}: {len(all_queue_entries)}")
-    # for entry in all_queue_entries:
-    #     print(f"  - Patient ID: {entry.patient_id}, Status: {entry.status}, Position: {entry.position}")
+    return get_queue_data_for_opds([opd_type], db)[opd_type]
+
+def get_queue_data_for_opds(opd_codes, db):
+    """
+    Load the active queues of several OPDs with one query.
+    Returns {opd_code: List[QueueResponse]}, with the same ordering as get_queue_data.
+    """
+    queues_by_opd = {opd_code: [] for opd_code in opd_codes}
+    if not queues_by_opd:
+        return queues_by_opd
     
     try:
-        # Check what statuses we're looking for
-        #print(f"Looking for statuses: {[PatientStatus.PENDING, PatientStatus.IN_OPD, PatientStatus.DILATED, PatientStatus.REFERRED]}")
-        
-        queue_entries = db.query(Queue).join(Patient).filter(
-            Queue.opd_type == opd_type,
-            Queue.status.in_([PatientStatus.PENDING, PatientStatus.IN_OPD, PatientStatus.DILATED, PatientStatus.REFERRED])
+        rows = db.query(*QUEUE_ROW_COLUMNS).join(Patient, Queue.patient_id == Patient.id).filter(
+            Queue.opd_type.in_(list(queues_by_opd)),
+            Queue.status.in_(ACTIVE_QUEUE_STATUSES)
         ).filter(
         # Only exclude patients who were referred FROM this OPD to a DIFFERENT OPD
         # Allow: fresh patients (no referral), patients referred TO this OPD, patients referred FROM this OPD back to this OPD
         ~(
-            (Patient.referred_from == opd_type) & 
-            (Patient.referred_to != opd_type) & 
+            (Patient.referred_from == Queue.opd_type) & 
+            (Patient.referred_to != Queue.opd_type) & 
             (Patient.referred_to.isnot(None))
         )
         ).order_by(Patient.registration_time.asc()).all()
-        
-        print(f"Found {len(queue_entries)} queue entries after filtering")
-        for entry in queue_entries:
-            print(f"  Matched: Patient {entry.patient_id} - {entry.patient.name}, Status: {entry.status}, Registration Time: {entry.patient.registration_time}")
     except Exception as e:
         print(f"ERROR querying queue entries: {e}")
         import traceback
         traceback.print_exc()
-        return []
+        return queues_by_opd
+    
+    # Partition by OPD, rows keep their registration_time order
+    rows_by_opd = {opd_code: [] for opd_code in queues_by_opd}
+    for row in rows:
+        rows_by_opd[row.opd_type].append(row)
     
+    return {opd_code: build_queue_response(opd_rows) for opd_code, opd_rows in rows_by_opd.items()}
+
+def build_queue_response(rows):
+    """Order queue rows for display and build the QueueResponse list"""
     # Sort queue: IN_OPD first, then other patients by position, then referred by waiting time
     # Separate into 3 categories
     # 1. IN_OPD: Anyone currently being served (Queue.status = IN_OPD) - ALWAYS show at top
-    in_opd_patients = [e for e in queue_entries if e.status == PatientStatus.IN_OPD]
+    in_opd_patients = [r for r in rows if r.status == PatientStatus.IN_OPD]
     
     # 2. REFERRED: Patients waiting to be called who were referred (Patient.current_status = REFERRED and NOT in OPD)
-    referred_patients = [e for e in queue_entries if e.patient.current_status == PatientStatus.REFERRED and e.status != PatientStatus.IN_OPD]
+    referred_patients = [r for r in rows if r.current_status == PatientStatus.REFERRED and r.status != PatientStatus.IN_OPD]
     
     # 3. OTHER: Regular waiting patients (PENDING, DILATED, etc.)
-    other_patients = [e for e in queue_entries if e.status != PatientStatus.IN_OPD and e.patient.current_status != PatientStatus.REFERRED]
+    other_patients = [r for r in rows if r.status != PatientStatus.IN_OPD and r.current_status != PatientStatus.REFERRED]
     
     # Sort referred patients by registration time (oldest first = longest waiting)
-    referred_patients.sort(key=lambda x: x.patient.registration_time)
+    referred_patients.sort(key=lambda r: r.registration_time)
     
     # Combine: IN_OPD first (current patient), then other patients, then referred patients
-    queue_entries = in_opd_patients + other_patients + referred_patients
+    ordered_rows = in_opd_patients + other_patients + referred_patients
     
-    #print(f"Queue order: {len(in_opd_patients)} IN_OPD + {len(other_patients)} other + {len(referred_patients)} referred")
-
-    #print("**** Building queue response ****")
+    # Values come straight from typed columns, so skip per-row Pydantic validation
     queue_data = []
-    for index in range(len(queue_entries)):
-        try:
-            #print(f"Processing: {entry.patient.name}, Status: {entry.status}")
-            entry = queue_entries[index]
-            # Convert status for referred patients
-            display_status = entry.status
-            if entry.status == PatientStatus.REFERRED:
-                display_status = PatientStatus.PENDING
-            
-            queue_item = QueueResponse(
-                id=entry.id,
-                patient_id=entry.patient_id,
-                token_number=entry.patient.token_number,
-                patient_name=entry.patient.name,
-                position=index+1,
-                status=display_status,
-                registration_time=entry.patient.registration_time,
-                is_dilated=entry.patient.is_dilated if entry.patient.is_dilated is not None else False,
-                dilation_time=entry.patient.dilation_time,
-                age=entry.patient.age,
-                phone=entry.patient.phone,
-                is_referred=(entry.patient.current_status == PatientStatus.REFERRED),
-                referred_from=entry.patient.referred_from,
-                dilation_flag=entry.patient.dilation_flag
-            )
-            queue_data.append(queue_item)
-            #print(f"  ✓ Added to queue response")
-        except Exception as e:
-            print(f"  ✗ ERROR creating response for {entry.patient.name}: {e}")
-            import traceback
-            traceback.print_exc()
-    
-    #print(f"Returning {len(queue_data)} patients in queue")
+    for index, row in enumerate(ordered_rows):
+        # Referred patients are shown as waiting
+        display_status = PatientStatus.PENDING if row.status == PatientStatus.REFERRED else row.status
+        queue_data.append(QueueResponse.model_construct(
+            id=row.id,
+            patient_id=row.patient_id,
+            token_number=row.token_number,
+            patient_name=row.name,
+            position=index + 1,
+            status=display_status,
+            registration_time=row.registration_time,
+            is_dilated=bool(row.is_dilated),
+            dilation_time=row.dilation_time,
+            age=row.age,
+            phone=row.phone,
+            is_referred=(row.current_status == PatientStatus.REFERRED),
+            referred_from=row.referred_from,
+            dilation_flag=bool(row.dilation_flag)
+        ))
+    
     return queue_data
 
 @router.post("/{opd_type}/call-next")
 async def call_next_patient(
     opd_type: str,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_active_user)
 ):
     opd_type = opd_type.lower()
     
     # Check OPD access
-    check_opd_access(current_user, opd_type, db)
+    await check_opd_access_async(current_user, opd_type, db)
     
     # Validate OPD exists and is active
-    opd = db.query(OPD).filter(OPD.opd_code == opd_type, OPD.is_active == True).first()
+    opd = (await db.execute(select(OPD).where(OPD.opd_code == opd_type, OPD.is_active == True))).scalars().first()
     if not opd:
         raise HTTPException(status_code=404, detail="OPD not found or inactive")
     
     # CRITICAL: Check if there's already a patient IN_OPD
     # Exclude patients who were referred out of this OPD or have REFERRED status
-    existing_in_opd = db.query(Queue).join(Patient).filter(
+    existing_in_opd = (await db.execute(select(Queue).join(Queue.patient).options(contains_eager(Queue.patient)).where(
         Queue.opd_type == opd_type,
         Queue.status == PatientStatus.IN_OPD,
         # IMPORTANT: Exclude patients with REFERRED status (they're no longer in this OPD)
         Patient.current_status != PatientStatus.REFERRED
-    ).filter(
+    ).where(
         # Also exclude patients who were referred FROM this OPD to a DIFFERENT OPD
         # This is a backup check in case Patient.current_status wasn't updated
         ~(
@@ -193,7 +214,7 @@ async def call_next_patient(
             (Patient.referred_to != opd_type) & 
             (Patient.referred_to.isnot(None))
         )
-    ).first()
+    ).limit(1))).scalars().first()
     
     if existing_in_opd:
         raise HTTPException(
@@ -202,17 +223,17 @@ async def call_next_patient(
         )
     
     # Get all pending patients (including referred patients who can be called)
-    pending_patients = db.query(Queue).join(Patient).filter(
+    pending_patients = (await db.execute(select(Queue).join(Queue.patient).options(contains_eager(Queue.patient)).where(
         Queue.opd_type == opd_type,
         Queue.status.in_([PatientStatus.PENDING, PatientStatus.REFERRED])
-    ).filter(
+    ).where(
         # Apply the same exclusion filter as in get_opd_queue
         ~(
             (Patient.referred_from == opd_type) & 
             (Patient.referred_to != opd_type) & 
             (Patient.referred_to.isnot(None))
         )
-    ).order_by(Queue.position).all()
+    ).order_by(Queue.position))).scalars().all()
     
     if not pending_patients:
         raise HTTPException(status_code=404, detail="No patients in queue")
@@ -251,12 +272,13 @@ async def call_next_patient(
         status=PatientStatus.IN_OPD
     )
     db.add(flow_entry)
-    db.commit()
+    await db.commit()
+    display_cache.invalidate(opd_type)
     
     # Broadcast updates
-    await broadcast_queue_update(opd_type, db)
-    await broadcast_patient_status_update(next_patient.patient_id, PatientStatus.IN_OPD, db)
-    await broadcast_display_update()
+    broadcast_dispatcher.queue_changed(opd_type)
+    broadcast_dispatcher.patient_status_changed(next_patient.patient_id, PatientStatus.IN_OPD)
+    broadcast_dispatcher.display_changed()
     
     return {
         "message": f"Patient {next_patient.patient.token_number} called",
@@ -273,7 +295,7 @@ async def dilate_patient(
     opd_type: str,
     patient_id: int,
     payload: DilatePatientRequest,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_active_user)
 ):
     opd_type = opd_type.lower()
@@ -281,9 +303,9 @@ async def dilate_patient(
     print("dilate patient: {remarks}")
     
     # Check OPD access
-    check_opd_access(current_user, opd_type, db)
+    await check_opd_access_async(current_user, opd_type, db)
     
-    patient = db.query(Patient).filter(Patient.id == patient_id).first()
+    patient = await db.get(Patient, patient_id)
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
     
@@ -297,10 +319,10 @@ async def dilate_patient(
     patient.dilation_flag = True
     
     # Update queue status
-    queue_entry = db.query(Queue).filter(
+    queue_entry = (await db.execute(select(Queue).where(
         Queue.patient_id == patient_id,
         Queue.opd_type == opd_type
-    ).first()
+    ))).scalars().first()
     
     if queue_entry:
         queue_entry.status = PatientStatus.DILATED
@@ -315,12 +337,13 @@ async def dilate_patient(
         notes=remarks
     )
     db.add(flow_entry)
-    db.commit()
+    await db.commit()
+    display_cache.invalidate(opd_type)
     
     # Broadcast updates
-    await broadcast_queue_update(opd_type, db)
-    await broadcast_patient_status_update(patient_id, PatientStatus.DILATED, db)
-    await broadcast_display_update()
+    broadcast_dispatcher.queue_changed(opd_type)
+    broadcast_dispatcher.patient_status_changed(patient_id, PatientStatus.DILATED)
+    broadcast_dispatcher.display_changed()
     
     return {"message": f"Patient {patient.token_number} marked for dilation"}
 
@@ -328,15 +351,15 @@ async def dilate_patient(
 async def return_dilated_patient(
     opd_type: str,
     patient_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_active_user)
 ):
     opd_type = opd_type.lower()
     
     # Check OPD access
-    check_opd_access(current_user, opd_type, db)
+    await check_opd_access_async(current_user, opd_type, db)
     
-    patient = db.query(Patient).filter(Patient.id == patient_id).first()
+    patient = await db.get(Patient, patient_id)
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
     
@@ -349,10 +372,10 @@ async def return_dilated_patient(
     patient.current_room = f"opd_{opd_type}"
     
     # Update queue status
-    queue_entry = db.query(Queue).filter(
+    queue_entry = (await db.execute(select(Queue).where(
         Queue.patient_id == patient_id,
         Queue.opd_type == opd_type
-    ).first()
+    ))).scalars().first()
     
     if queue_entry:
         queue_entry.status = PatientStatus.PENDING
@@ -369,12 +392,13 @@ async def return_dilated_patient(
     patient.is_dilated = False
     patient.dilation_time = None
     db.add(flow_entry)
-    db.commit()
+    await db.commit()
+    display_cache.invalidate(opd_type)
     
     # Broadcast updates
-    await broadcast_queue_update(opd_type, db)
-    await broadcast_patient_status_update(patient_id, PatientStatus.IN_OPD, db)
-    await broadcast_display_update()
+    broadcast_dispatcher.queue_changed(opd_type)
+    broadcast_dispatcher.patient_status_changed(patient_id, PatientStatus.IN_OPD)
+    broadcast_dispatcher.display_changed()
     
     return {"message": f"Patient {patient.token_number} returned from dilation"}
 
@@ -382,30 +406,30 @@ async def return_dilated_patient(
 async def send_back_to_queue(
     opd_type: str,
     patient_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_active_user)
 ):
     opd_type = opd_type.lower()
     
     # Check OPD access
-    check_opd_access(current_user, opd_type, db)
+    await check_opd_access_async(current_user, opd_type, db)
     
     """Send a patient who was accidentally called back to the queue"""
     # Validate OPD exists and is active
-    opd = db.query(OPD).filter(OPD.opd_code == opd_type, OPD.is_active == True).first()
+    opd = (await db.execute(select(OPD).where(OPD.opd_code == opd_type, OPD.is_active == True))).scalars().first()
     if not opd:
         raise HTTPException(status_code=404, detail="OPD not found or inactive")
     
     # Get the patient
-    patient = db.query(Patient).filter(Patient.id == patient_id).first()
+    patient = await db.get(Patient, patient_id)
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
     
     # Get the queue entry
-    queue_entry = db.query(Queue).filter(
+    queue_entry = (await db.execute(select(Queue).where(
         Queue.patient_id == patient_id,
         Queue.opd_type == opd_type
-    ).first()
+    ))).scalars().first()
     
     if not queue_entry:
         raise HTTPException(status_code=404, detail="Patient not in this OPD queue")
@@ -431,12 +455,13 @@ async def send_back_to_queue(
         notes="Patient accidentally called - sent back to queue"
     )
     db.add(flow_entry)
-    db.commit()
+    await db.commit()
+    display_cache.invalidate(opd_type)
     
     # Broadcast updates
-    await broadcast_queue_update(opd_type, db)
-    await broadcast_patient_status_update(patient_id, PatientStatus.PENDING, db)
-    await broadcast_display_update()
+    broadcast_dispatcher.queue_changed(opd_type)
+    broadcast_dispatcher.patient_status_changed(patient_id, PatientStatus.PENDING)
+    broadcast_dispatcher.display_changed()
     
     return {
         "message": f"Patient {patient.token_number} sent back to queue",
@@ -451,30 +476,30 @@ async def send_back_to_queue(
 async def call_out_of_order(
     opd_type: str,
     patient_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_active_user)
 ):
     opd_type = opd_type.lower()
     
     # Check OPD access
-    check_opd_access(current_user, opd_type, db)
+    await check_opd_access_async(current_user, opd_type, db)
     
     """Call a specific patient out of order (emergency or special case)"""
     # Validate OPD exists and is active
-    opd = db.query(OPD).filter(OPD.opd_code == opd_type, OPD.is_active == True).first()
+    opd = (await db.execute(select(OPD).where(OPD.opd_code == opd_type, OPD.is_active == True))).scalars().first()
     if not opd:
         raise HTTPException(status_code=404, detail="OPD not found or inactive")
     
     # Get the patient
-    patient = db.query(Patient).filter(Patient.id == patient_id).first()
+    patient = await db.get(Patient, patient_id)
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
     
     # Get the queue entry
-    queue_entry = db.query(Queue).filter(
+    queue_entry = (await db.execute(select(Queue).where(
         Queue.patient_id == patient_id,
         Queue.opd_type == opd_type
-    ).first()
+    ))).scalars().first()
     
     if not queue_entry:
         raise HTTPException(status_code=404, detail="Patient not in this OPD queue")
@@ -484,19 +509,19 @@ async def call_out_of_order(
         raise HTTPException(status_code=400, detail=f"Patient cannot be called (status: {queue_entry.status})")
     
     # Check if there's already a patient in OPD (with same exclusions as call_next)
-    current_in_opd = db.query(Queue).join(Patient).filter(
+    current_in_opd = (await db.execute(select(Queue).join(Queue.patient).options(contains_eager(Queue.patient)).where(
         Queue.opd_type == opd_type,
         Queue.status == PatientStatus.IN_OPD,
         # IMPORTANT: Exclude patients with REFERRED status
         Patient.current_status != PatientStatus.REFERRED
-    ).filter(
+    ).where(
         # Also exclude patients who were referred out
         ~(
             (Patient.referred_from == opd_type) & 
             (Patient.referred_to != opd_type) & 
             (Patient.referred_to.isnot(None))
         )
-    ).first()
+    ).limit(1))).scalars().first()
     
     if current_in_opd:
         raise HTTPException(
@@ -533,12 +558,13 @@ async def call_out_of_order(
         notes="Patient called out of order"
     )
     db.add(flow_entry)
-    db.commit()
+    await db.commit()
+    display_cache.invalidate(opd_type)
     
     # Broadcast updates
-    await broadcast_queue_update(opd_type, db)
-    await broadcast_patient_status_update(patient_id, PatientStatus.IN_OPD, db)
-    await broadcast_display_update()
+    broadcast_dispatcher.queue_changed(opd_type)
+    broadcast_dispatcher.patient_status_changed(patient_id, PatientStatus.IN_OPD)
+    broadcast_dispatcher.display_changed()
     
     return {
         "message": f"Patient {patient.token_number} called out of order",
@@ -553,88 +579,62 @@ async def call_out_of_order(
 @router.get("/{opd_type}/stats", response_model=OPDStats)
 async def get_opd_stats(
     opd_type: str,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_active_user)
 ):
     opd_type = opd_type.lower()
     
     # Check OPD access
-    check_opd_access(current_user, opd_type, db)
+    await check_opd_access_async(current_user, opd_type, db)
     
     # Validate OPD exists and is active
-    opd = db.query(OPD).filter(OPD.opd_code == opd_type, OPD.is_active == True).first()
+    opd = (await db.execute(select(OPD).where(OPD.opd_code == opd_type, OPD.is_active == True))).scalars().first()
     if not opd:
         raise HTTPException(status_code=404, detail="OPD not found or inactive")
     
-    today = get_ist_now().date()
+    stats = await db.run_sync(lambda session: build_opd_stats([opd], session))
+    return stats[0]
+
+def build_opd_stats(opds, db):
+    """Build OPDStats for several OPDs from the shared aggregation queries"""
+    summary = status_counters.get_summary(db)
+    counts = status_counters.get_opd_counts(db, [opd.opd_code for opd in opds])
     
-    # Get queue statistics
-    total_patients = db.query(Queue).filter(Queue.opd_type == opd_type).count()
-    pending_patients = db.query(Queue).filter(
-        Queue.opd_type == opd_type,
-        Queue.status == PatientStatus.PENDING
-    ).count()
-    in_opd_patients = db.query(Queue).filter(
-        Queue.opd_type == opd_type,
-        Queue.status == PatientStatus.IN_OPD
-    ).count()
-    dilated_patients = db.query(Queue).filter(
-        Queue.opd_type == opd_type,
-        Queue.status == PatientStatus.DILATED
-    ).count()
-    referred_patients = db.query(Queue).filter(
-        Queue.opd_type == opd_type,
-        Queue.status == PatientStatus.REFERRED
-    ).count()
-    
-    # Get completed patients today
-    completed_today = db.query(Patient).filter(
-        Patient.current_status == PatientStatus.COMPLETED,
-        func.date(Patient.completed_at) == today
-    ).count()
-    
-    # Calculate average waiting time (simplified)
-    avg_waiting_time = None
-    completed_patients = db.query(Patient).filter(
-        Patient.current_status == PatientStatus.COMPLETED,
-        func.date(Patient.completed_at) == today
-    ).all()
-    
-    if completed_patients:
-        total_waiting_time = 0
-        for patient in completed_patients:
-            if patient.completed_at:
-                waiting_time = (patient.completed_at - patient.registration_time).total_seconds() / 60
-                total_waiting_time += waiting_time
-        avg_waiting_time = total_waiting_time / len(completed_patients)
-    
-    return OPDStats(
-        opd_type=opd_type,
-        opd_name=opd.opd_name,
-        total_patients=total_patients,
-        pending_patients=pending_patients,
-        in_opd_patients=in_opd_patients,
-        dilated_patients=dilated_patients,
-        referred_patients=referred_patients,
-        completed_today=completed_today,
-        avg_waiting_time=avg_waiting_time
-    )
+    stats = []
+    for opd in opds:
+        opd_counts = counts[opd.opd_code]
+        stats.append(OPDStats(
+            opd_type=opd.opd_code,
+            opd_name=opd.opd_name,
+            total_patients=opd_counts.total,
+            pending_patients=opd_counts.pending,
+            in_opd_patients=opd_counts.in_opd,
+            dilated_patients=opd_counts.dilated,
+            referred_patients=opd_counts.referred,
+            # Completion is tracked hospital-wide (patients leave their OPD on completion)
+            completed_today=summary.completed_today,
+            avg_waiting_time=summary.avg_turnaround_minutes,
+            p50_waiting_time=summary.p50_turnaround_minutes,
+            p90_waiting_time=summary.p90_turnaround_minutes
+        ))
+    
+    return stats
 
 @router.get("/stats/all", response_model=List[OPDStats])
 async def get_all_opd_stats(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    stats = []
     # Get all active OPDs
-    active_opds = db.query(OPD).filter(OPD.is_active == True).all()
+    active_opds = (await db.execute(select(OPD).where(OPD.is_active == True))).scalars().all()
     
+    # Skip OPDs the user has no access to
+    accessible_opds = []
     for opd in active_opds:
         try:
-            opd_stats = await get_opd_stats(opd.opd_code, db, current_user)
-            stats.append(opd_stats)
+            await check_opd_access_async(current_user, opd.opd_code, db)
+            accessible_opds.append(opd)
         except HTTPException:
-            # Skip OPDs that have no data or are inactive
             continue
     
-    return stats
+    return await db.run_sync(lambda session: build_opd_stats(accessible_opds, session))
@@ -5,6 +5,7 @@ from datetime import datetime
 from pydantic import BaseModel
 from database import get_db, OPD, get_ist_now
 from auth import get_current_active_user, User, require_role, UserRole
+from display_cache import display_cache
 import pytz
 ist = pytz.timezone('Asia/Kolkata')
 router = APIRouter()
@@ -92,6 +93,7 @@ async def create_opd(
     
     db.add(opd)
     db.commit()
+    display_cache.invalidate_opd_list()
     db.refresh(opd)
     
     return opd
@@ -119,6 +121,8 @@ async def update_opd(
     opd.updated_at = get_ist_now()
     
     db.commit()
+    display_cache.invalidate_opd_list()
+    display_cache.invalidate(opd.opd_code)
     db.refresh(opd)
     
     return opd
@@ -139,6 +143,8 @@ async def delete_opd(
     opd.updated_at = get_ist_now()
     
     db.commit()
+    display_cache.invalidate_opd_list()
+    display_cache.invalidate(opd.opd_code)
     
     return {"message": f"OPD {opd.opd_name} has been deactivated"}
 
@@ -157,5 +163,7 @@ async def activate_opd(
     opd.updated_at = get_ist_now()
     
     db.commit()
+    display_cache.invalidate_opd_list()
+    display_cache.invalidate(opd.opd_code)
     
     return {"message": f"OPD {opd.opd_name} has been activated"}
@@ -1,12 +1,17 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query
-from sqlalchemy.orm import Session
-from sqlalchemy import func
-from typing import List, Optional
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func, select, delete
+from typing import List, Optional, Union
 from datetime import datetime, timedelta
 from pydantic import BaseModel
-from database import get_db, Patient, Queue, PatientStatus, OPD, PatientFlow, get_ist_now
+from database import get_async_db, Patient, Queue, PatientStatus, OPD, PatientFlow, get_ist_now
 from auth import get_current_active_user, User, require_role, UserRole
-from websocket_manager import broadcast_queue_update, broadcast_patient_status_update, broadcast_display_update
+from websocket_manager import broadcast_dispatcher
+from display_cache import display_cache
+from tokens import next_token_number
+from patient_search import patient_search, patient_list_filters
+from bulk_registration import BulkRegistrationResult, parse_csv, parse_json, register_patients
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, NEXT_CURSOR_HEADER, InvalidCursor, after_position, decode_cursor, encode_cursor
 import asyncio
 import pytz
 ist = pytz.timezone('Asia/Kolkata')
@@ -50,6 +55,9 @@ class PatientResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class PatientSearchResult(PatientResponse):
+    score: float  # Relevance, higher is better; exact token/registration matches come first
+
 class QueueResponse(BaseModel):
     id: int
     patient_id: int
@@ -83,26 +91,19 @@ class ReferredPatientResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class ReferredPatientsForOPD(BaseModel):
+    inbound: List[ReferredPatientResponse]  # Referred from elsewhere to the OPD
+    outbound: List[ReferredPatientResponse]  # Referred from the OPD to elsewhere
+
 
 # Helper function to generate token number
-def generate_token_number(db: Session) -> str:
-    today = get_ist_now().strftime("%Y%m%d")
-    last_token = db.query(Patient).filter(
-        Patient.token_number.like(f"{today}%")
-    ).order_by(Patient.id.desc()).first()
-    
-    if last_token:
-        last_number = int(last_token.token_number.split('-')[-1])
-        new_number = last_number + 1
-    else:
-        new_number = 1001
-    
-    return f"{today}-{new_number:04d}"
+async def generate_token_number(db: AsyncSession) -> str:
+    return await db.run_sync(next_token_number)
 
 @router.post("/register", response_model=PatientResponse)
 async def register_patient(
     patient_data: PatientCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_active_user)
 ):
     try:
@@ -111,7 +112,7 @@ async def register_patient(
         print(f"Data: {patient_data}")
         
         # Generate unique token number
-        token_number = generate_token_number(db)
+        token_number = await generate_token_number(db)
         print(f"Generated token: {token_number}")
         
         # Create patient
@@ -125,8 +126,8 @@ async def register_patient(
         )
         
         db.add(db_patient)
-        db.commit()
-        db.refresh(db_patient)
+        await db.commit()
+        await db.refresh(db_patient)
         print(f"Patient created: {db_patient.id} - {db_patient.name}")
         
         # Log patient flow
@@ -136,7 +137,7 @@ async def register_patient(
             status=PatientStatus.PENDING
         )
         db.add(flow_entry)
-        db.commit()
+        await db.commit()
         
         print(f"=== REGISTRATION SUCCESS ===")
         return db_patient
@@ -145,75 +146,104 @@ async def register_patient(
         print(f"Error: {str(e)}")
         import traceback
         traceback.print_exc()
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=f"Registration failed: {str(e)}")
 
+@router.post("/bulk-register", response_model=BulkRegistrationResult)
+async def bulk_register_patients(
+    request: Request,
+    dry_run: bool = Query(False),  # Only validate the rows
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(require_role(UserRole.REGISTRATION))
+):
+    """
+    Register a batch of patients in one transaction. The body is a JSON list of
+    {registration_number, name, age, phone}, or CSV with that header row when
+    sent as text/csv. Invalid rows are reported and skipped.
+    """
+    content = (await request.body()).decode("utf-8-sig")
+    try:
+        if "csv" in request.headers.get("content-type", ""):
+            rows = parse_csv(content)
+        else:
+            rows = parse_json(content)
+        result = await db.run_sync(lambda session: register_patients(session, rows, dry_run=dry_run))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    await db.commit()
+    print(f"Bulk registration by {current_user.username}: {result.registered} registered, {result.failed} failed")
+    return result
+
+async def load_referred_patients(db: AsyncSession, *conditions) -> List[ReferredPatientResponse]:
+    """Referred patients matching conditions, each with its queue status in the destination OPD, in one query"""
+    rows = (await db.execute(
+        select(Patient, Queue.status)
+        .outerjoin(Queue, (Queue.patient_id == Patient.id) & (Queue.opd_type == Patient.referred_to))
+        .where(Patient.current_status == PatientStatus.REFERRED, *conditions)
+        .order_by(Patient.registration_time.asc(), Patient.id, Queue.id)
+    )).all()
+
+    result = []
+    seen = set()
+    for p, queue_status in rows:
+        if p.id in seen:
+            continue  # Only the first queue entry in the destination OPD counts
+        seen.add(p.id)
+        result.append(ReferredPatientResponse(
+            id=p.id,
+            token_number=p.token_number,
+            name=p.name,
+            age=p.age,
+            registration_time=p.registration_time,
+            from_opd=p.referred_from,
+            to_opd=p.referred_to,
+            status=p.current_status.value if p.current_status else "unknown",
+            current_queue_status=queue_status.value if queue_status else None
+        ))
+    return result
+
 # Place static route BEFORE any dynamic /{patient_id} routes to avoid conflicts
-@router.get("/referred", response_model=List[ReferredPatientResponse])
+@router.get("/referred", response_model=Union[ReferredPatientsForOPD, List[ReferredPatientResponse]])
 async def list_referred_patients(
     from_opd: Optional[str] = Query(default=None, alias="from_opd"),
     to_opd: Optional[str] = Query(default=None, alias="to_opd"),
-    db: Session = Depends(get_db),
+    opd: Optional[str] = Query(default=None),  # Both directions for one OPD, in one response
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    query = db.query(Patient).filter(Patient.current_status == PatientStatus.REFERRED)
-    
+    if opd:
+        referred = await load_referred_patients(db, (Patient.referred_from == opd) | (Patient.referred_to == opd))
+        return ReferredPatientsForOPD(
+            inbound=[p for p in referred if p.to_opd == opd],
+            outbound=[p for p in referred if p.from_opd == opd and p.to_opd != opd]
+        )
+
+    conditions = []
     # Get valid OPD codes from database
-    valid_opds = {opd.opd_code for opd in db.query(OPD).filter(OPD.is_active == True).all()}
+    valid_opds = set((await db.execute(select(OPD.opd_code).where(OPD.is_active == True))).scalars().all())
     if from_opd and from_opd in valid_opds:
-        query = query.filter(Patient.referred_from == from_opd)
+        conditions.append(Patient.referred_from == from_opd)
     if to_opd and to_opd in valid_opds:
-        query = query.filter(Patient.referred_to == to_opd)
+        conditions.append(Patient.referred_to == to_opd)
 
-    patients = query.order_by(Patient.registration_time.asc()).all()
-
-    result = []
-    for p in patients:
-        try:
-            # Get current queue status in the destination OPD
-            current_queue_status = None
-            if p.referred_to:
-                queue_entry = db.query(Queue).filter(
-                    Queue.patient_id == p.id,
-                    Queue.opd_type == p.referred_to
-                ).first()
-                if queue_entry:
-                    current_queue_status = queue_entry.status.value if queue_entry.status else None
-
-            result.append(ReferredPatientResponse(
-                id=p.id,
-                token_number=p.token_number,
-                name=p.name,
-                age=p.age,
-                registration_time=p.registration_time,
-                from_opd=p.referred_from,
-                to_opd=p.referred_to,
-                status=p.current_status.value if p.current_status else "unknown",
-                current_queue_status=current_queue_status
-            ))
-        except Exception as e:
-            print(f"Error creating ReferredPatientResponse for patient {p.id}: {e}")
-            import traceback
-            traceback.print_exc()
-    
-    return result
+    return await load_referred_patients(db, *conditions)
 
 @router.post("/{patient_id}/allocate-opd")
 async def allocate_opd(
     patient_id: int,
     payload: AllocateOPDRequest,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_active_user)
 ):
     print("patients.py: allocate_opd")
     opd_type = payload.opd_type
     
     # Validate OPD exists and is active
-    opd = db.query(OPD).filter(OPD.opd_code == opd_type, OPD.is_active == True).first()
+    opd = (await db.execute(select(OPD).where(OPD.opd_code == opd_type, OPD.is_active == True))).scalars().first()
     if not opd:
         raise HTTPException(status_code=404, detail="OPD not found or inactive")
     
-    patient = db.query(Patient).filter(Patient.id == patient_id).first()
+    patient = await db.get(Patient, patient_id)
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
     
@@ -222,9 +252,9 @@ async def allocate_opd(
     patient.current_room = f"opd_{opd_type}"
     
     # Add to OPD queue
-    max_position = db.query(func.max(Queue.position)).filter(
+    max_position = await db.scalar(select(func.max(Queue.position)).where(
         Queue.opd_type == opd_type
-    ).scalar() or 0
+    )) or 0
     
     queue_entry = Queue(
         opd_type=opd_type,
@@ -234,7 +264,7 @@ async def allocate_opd(
     )
     
     db.add(queue_entry)
-    db.commit()
+    await db.commit()
     
     # Log patient flow
     flow_entry = PatientFlow(
@@ -244,21 +274,37 @@ async def allocate_opd(
         status=PatientStatus.PENDING
     )
     db.add(flow_entry)
-    db.commit()
+    await db.commit()
+    display_cache.invalidate(opd_type)
     
     # Broadcast updates
-    await broadcast_queue_update(opd_type, db)
-    await broadcast_display_update()
+    broadcast_dispatcher.queue_changed(opd_type)
+    broadcast_dispatcher.display_changed()
     
     return {"message": f"Patient allocated to {opd_type}", "queue_position": max_position + 1}
 
+@router.get("/search", response_model=List[PatientSearchResult])
+async def search_patients(
+    q: str = Query(..., min_length=1),  # Any part of the name, registration number or token number
+    limit: int = Query(20, ge=1, le=100),
+    status: Optional[PatientStatus] = None,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Patients matching q, best match first"""
+    results = await patient_search.search(db, q.strip(), limit, status)
+    return [
+        PatientSearchResult(**PatientResponse.model_validate(patient).model_dump(), score=score)
+        for patient, score in results
+    ]
+
 @router.get("/{patient_id}", response_model=PatientResponse)
 async def get_patient(
     patient_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    patient = db.query(Patient).filter(Patient.id == patient_id).first()
+    patient = await db.get(Patient, patient_id)
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
     return patient
@@ -268,10 +314,10 @@ async def update_patient_status(
     patient_id: int,
     status: PatientStatus,
     notes: Optional[str] = None,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(require_role(UserRole.NURSING))
 ):
-    patient = db.query(Patient).filter(Patient.id == patient_id).first()
+    patient = await db.get(Patient, patient_id)
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
     
@@ -285,16 +331,16 @@ async def update_patient_status(
     elif status == PatientStatus.COMPLETED:
         patient.completed_at = get_ist_now()
         # Remove from queue
-        db.query(Queue).filter(
+        await db.execute(delete(Queue).where(
             Queue.patient_id == patient_id,
             Queue.opd_type == patient.allocated_opd
-        ).delete()
+        ))
     
     # Update queue status
-    queue_entry = db.query(Queue).filter(
+    queue_entry = (await db.execute(select(Queue).where(
         Queue.patient_id == patient_id,
         Queue.opd_type == patient.allocated_opd
-    ).first()
+    ))).scalars().first()
     
     if queue_entry:
         queue_entry.status = status
@@ -308,13 +354,14 @@ async def update_patient_status(
         notes=notes
     )
     db.add(flow_entry)
-    db.commit()
+    await db.commit()
+    display_cache.invalidate(patient.allocated_opd)
     
     # Broadcast updates
     if patient.allocated_opd:
-        await broadcast_queue_update(patient.allocated_opd, db)
-    await broadcast_patient_status_update(patient_id, status, db)
-    await broadcast_display_update()
+        broadcast_dispatcher.queue_changed(patient.allocated_opd)
+    broadcast_dispatcher.patient_status_changed(patient_id, status)
+    broadcast_dispatcher.display_changed()
     
     return {"message": f"Patient status updated to {status}"}
 
@@ -322,7 +369,7 @@ async def update_patient_status(
 async def refer_patient(
     patient_id: int,
     payload: ReferPatientRequest,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(require_role(UserRole.NURSING))
 ):
     print(f"\n=== REFER PATIENT {patient_id} ===")
@@ -335,12 +382,12 @@ async def refer_patient(
         raise HTTPException(status_code=400, detail="Target OPD is required")
     
     # Validate target OPD exists and is active
-    target_opd = db.query(OPD).filter(OPD.opd_code == to_opd, OPD.is_active == True).first()
+    target_opd = (await db.execute(select(OPD).where(OPD.opd_code == to_opd, OPD.is_active == True))).scalars().first()
     if not target_opd:
         print(f"ERROR: Target OPD '{to_opd}' not found or inactive")
         raise HTTPException(status_code=404, detail=f"Target OPD '{to_opd}' not found or inactive")
     
-    patient = db.query(Patient).filter(Patient.id == patient_id).first()
+    patient = await db.get(Patient, patient_id)
     if not patient:
         print(f"ERROR: Patient {patient_id} not found")
         raise HTTPException(status_code=404, detail="Patient not found")
@@ -354,23 +401,23 @@ async def refer_patient(
 
     # Keep patient in current OPD queue but mark their queue status as REFERRED
     if from_opd:
-        queue_entry = db.query(Queue).filter(
+        queue_entry = (await db.execute(select(Queue).where(
             Queue.patient_id == patient_id,
             Queue.opd_type == from_opd
-        ).first()
+        ))).scalars().first()
         if queue_entry:
             queue_entry.status = PatientStatus.REFERRED
 
     # Ensure patient is ALSO present in the destination OPD queue with REFERRED status
     # Create only if not already present
-    to_queue_entry = db.query(Queue).filter(
+    to_queue_entry = (await db.execute(select(Queue).where(
         Queue.patient_id == patient_id,
         Queue.opd_type == to_opd
-    ).first()
+    ))).scalars().first()
     if not to_queue_entry:
-        max_position_to = db.query(func.max(Queue.position)).filter(
+        max_position_to = await db.scalar(select(func.max(Queue.position)).where(
             Queue.opd_type == to_opd
-        ).scalar() or 0
+        )) or 0
         to_queue_entry = Queue(
             opd_type=to_opd,
             patient_id=patient_id,
@@ -391,14 +438,15 @@ async def refer_patient(
         notes=remarks
     )
     db.add(flow_entry)
-    db.commit()
+    await db.commit()
+    display_cache.invalidate(from_opd, to_opd)
 
     # Broadcast updates (update both OPD queues and global display)
     if from_opd:
-        await broadcast_queue_update(from_opd, db)
-    await broadcast_queue_update(to_opd, db)
-    await broadcast_patient_status_update(patient_id, PatientStatus.REFERRED, db)
-    await broadcast_display_update()
+        broadcast_dispatcher.queue_changed(from_opd)
+    broadcast_dispatcher.queue_changed(to_opd)
+    broadcast_dispatcher.patient_status_changed(patient_id, PatientStatus.REFERRED)
+    broadcast_dispatcher.display_changed()
 
     return {"message": f"Patient referred to {to_opd} and present in both queues as referred"}
 
@@ -411,13 +459,13 @@ class ReturnReferredPatientRequest(BaseModel):
 async def return_referred_patient(
     patient_id: int,
     payload: ReturnReferredPatientRequest,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(require_role(UserRole.NURSING))
 ):
     opd_code_from_payload = payload.opd_code # This is the OPD the patient was referred TO, and is now returning FROM
     remarks = payload.remarks
 
-    patient = db.query(Patient).filter(Patient.id == patient_id).first()
+    patient = await db.get(Patient, patient_id)
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
 
@@ -440,17 +488,17 @@ async def return_referred_patient(
     # Dilation status (is_dilated, dilation_time) is preserved as it's independent of referral status.
     
     # 2. Update Queue entry for the original OPD (where patient is returning TO)
-    original_opd_queue_entry = db.query(Queue).filter(
+    original_opd_queue_entry = (await db.execute(select(Queue).where(
         Queue.patient_id == patient_id,
         Queue.opd_type == original_opd_code
-    ).first()
+    ))).scalars().first()
 
     if not original_opd_queue_entry:
         # This case should ideally not happen if the patient was properly referred and had an entry in their original OPD.
         # If it does, we'll create a new entry to ensure they are in the queue.
-        max_position_original = db.query(func.max(Queue.position)).filter(
+        max_position_original = await db.scalar(select(func.max(Queue.position)).where(
             Queue.opd_type == original_opd_code
-        ).scalar() or 0
+        )) or 0
         original_opd_queue_entry = Queue(
             opd_type=original_opd_code,
             patient_id=patient_id,
@@ -463,10 +511,10 @@ async def return_referred_patient(
         original_opd_queue_entry.updated_at = get_ist_now()
 
     # 3. Update Queue entry for the OPD the patient was referred TO (where patient is returning FROM)
-    referred_to_opd_queue_entry = db.query(Queue).filter(
+    referred_to_opd_queue_entry = (await db.execute(select(Queue).where(
         Queue.patient_id == patient_id,
         Queue.opd_type == opd_code_from_payload
-    ).first()
+    ))).scalars().first()
 
     if referred_to_opd_queue_entry:
         # Mark as completed for this queue, as the patient is no longer being managed here.
@@ -483,14 +531,15 @@ async def return_referred_patient(
         notes=remarks
     )
     db.add(flow_entry)
-    db.commit()
-    db.refresh(patient) # Refresh patient to get updated fields
+    await db.commit()
+    display_cache.invalidate(original_opd_code, opd_code_from_payload)
+    await db.refresh(patient) # Refresh patient to get updated fields
 
     # 5. Broadcast updates
-    await broadcast_queue_update(original_opd_code, db)
-    await broadcast_queue_update(opd_code_from_payload, db) # Update the queue they left
-    await broadcast_patient_status_update(patient_id, PatientStatus.PENDING, db)
-    await broadcast_display_update()
+    broadcast_dispatcher.queue_changed(original_opd_code)
+    broadcast_dispatcher.queue_changed(opd_code_from_payload) # Update the queue they left
+    broadcast_dispatcher.patient_status_changed(patient_id, PatientStatus.PENDING)
+    broadcast_dispatcher.display_changed()
 
     return {"message": f"Patient {patient.name} ({patient.token_number}) returned to original OPD: {original_opd_code}"}
 
@@ -537,62 +586,53 @@ async def list_referred_patients(
 
 @router.get("", response_model=List[PatientResponse])
 async def get_patients(
-    skip: int = 0,
-    limit: int = 1000,  # Increased limit for All Patients table
+    response: Response,
+    skip: Optional[int] = Query(None, ge=0),  # Offset paging, kept for compatibility; cursor paging when omitted
+    limit: Optional[int] = Query(None, ge=1),  # Defaults to DEFAULT_PAGE_SIZE (at most MAX_PAGE_SIZE), or 1000 with skip
+    cursor: Optional[str] = Query(None),  # X-Next-Cursor of the previous page
     status: Optional[PatientStatus] = None,
     latest: Optional[bool] = Query(False),
     search: Optional[str] = Query(None),  # Search by registration_number or name
     date_from: Optional[str] = Query(None),  # Filter by date range - start date (YYYY-MM-DD)
     date_to: Optional[str] = Query(None),  # Filter by date range - end date (YYYY-MM-DD)
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_active_user)
 ):
     print("get_patients")
-    query = db.query(Patient)
+    query = select(Patient)
     print("status", status)
     print("latest", latest)
     print("search", search)
     print("date_from", date_from, "date_to", date_to)
     
-    if status:
-        query = query.filter(Patient.current_status == status)
-    
-    # Search by registration number or name
-    if search:
-        search_term = f"%{search}%"
-        query = query.filter(
-            (Patient.registration_number.ilike(search_term)) |
-            (Patient.name.ilike(search_term)) |
-            (Patient.token_number.ilike(search_term))
-        )
-    
-    # Filter by date range
-    if date_from:
-        try:
-            from_date = datetime.strptime(date_from, "%Y-%m-%d")
-            query = query.filter(Patient.registration_time >= from_date)
-        except ValueError:
-            pass  # Invalid date format, ignore filter
-    
-    if date_to:
-        try:
-            to_date = datetime.strptime(date_to, "%Y-%m-%d")
-            # Add 1 day and use < to include the entire end date
-            to_date_end = to_date + timedelta(days=1)
-            query = query.filter(Patient.registration_time < to_date_end)
-        except ValueError:
-            pass  # Invalid date format, ignore filter
+    query = query.where(*patient_list_filters(status, search, date_from, date_to))
     
     if latest:
         # If 'latest' is true, order by registration time descending and limit to 5
-        patients = query.order_by(Patient.registration_time.desc()).limit(5).all()
+        patients = (await db.execute(query.order_by(Patient.registration_time.desc()).limit(5))).scalars().all()
         print("Fetching latest 5 patients.")
         for patient in patients:
             print(patient.name, "\t", patient.registration_time, "\t", patient.current_status, "\t", patient.allocated_opd)
-    else:
-        # Otherwise, apply skip and limit for general pagination
-        patients = query.order_by(Patient.registration_time.desc()).offset(skip).limit(limit).all()
+    elif skip is not None:
+        # Offset pagination
+        limit = limit or 1000
+        patients = (await db.execute(query.order_by(Patient.registration_time.desc()).offset(skip).limit(limit))).scalars().all()
         print(f"Fetching patients with skip={skip}, limit={limit}.")
+    else:
+        # Cursor pagination: the page after the last (registration_time, id) handed out
+        limit = min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        if cursor:
+            try:
+                registration_time, patient_id = decode_cursor("patients", cursor)
+            except InvalidCursor as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            query = query.where(after_position(Patient.registration_time, Patient.id, registration_time, patient_id))
+        patients = (await db.execute(
+            query.order_by(Patient.registration_time.desc(), Patient.id.desc()).limit(limit)
+        )).scalars().all()
+        if len(patients) == limit:
+            response.headers[NEXT_CURSOR_HEADER] = encode_cursor("patients", patients[-1].registration_time, patients[-1].id)
+        print(f"Fetching {len(patients)} patients after cursor={cursor}.")
     
     
     return patients
@@ -602,10 +642,10 @@ async def get_patients(
 @router.post("/{patient_id}/endvisit")
 async def end_patient_visit(
     patient_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(require_role(UserRole.NURSING))
 ):
-    patient = db.query(Patient).filter(Patient.id == patient_id).first()
+    patient = await db.get(Patient, patient_id)
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
 
@@ -625,10 +665,11 @@ async def end_patient_visit(
     patient.referred_to = None # Clear referral status
 
     # Remove patient from ALL queue entries (they should not appear in any queue after completion)
-    queue_entries = db.query(Queue).filter(Queue.patient_id == patient_id).all()
+    queue_entries = (await db.execute(select(Queue).where(Queue.patient_id == patient_id))).scalars().all()
     print("queue_entries to remove", queue_entries)
+    affected_opds = {queue_entry.opd_type for queue_entry in queue_entries}
     for queue_entry in queue_entries:
-        db.delete(queue_entry)
+        await db.delete(queue_entry)
 
     # Log patient flow
     flow_entry = PatientFlow(
@@ -639,44 +680,47 @@ async def end_patient_visit(
         notes="Patient visit completed"
     )
     db.add(flow_entry)
-    db.commit()
+    await db.commit()
     print("committed")
-    db.refresh(patient) # Refresh patient object to reflect latest DB state
+    display_cache.invalidate(opd_to_update, *affected_opds)
+    await db.refresh(patient) # Refresh patient object to reflect latest DB state
 
     # Broadcast updates
     
     if opd_to_update:
-        await broadcast_queue_update(opd_to_update, db) # Update the queue they just left
-    await broadcast_patient_status_update(patient_id, PatientStatus.COMPLETED, db)
-    await broadcast_display_update()
+        broadcast_dispatcher.queue_changed(opd_to_update) # Update the queue they just left
+    broadcast_dispatcher.patient_status_changed(patient_id, PatientStatus.COMPLETED)
+    broadcast_dispatcher.display_changed()
 
     return {"message": f"Patient {patient.token_number} visit completed."}
 
 @router.post("/{patient_id}/delete")
 async def delete_patient(
     patient_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(require_role(UserRole.ADMIN))
 ):
-    patient = db.query(Patient).filter(Patient.id == patient_id).first()
+    patient = await db.get(Patient, patient_id)
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
 
     opd_to_update = patient.allocated_opd # Store for broadcasting before deletion
 
     # Delete associated queue entries
-    db.query(Queue).filter(Queue.patient_id == patient_id).delete(synchronize_session=False)
+    affected_opds = set((await db.execute(select(Queue.opd_type).where(Queue.patient_id == patient_id))).scalars().all())
+    await db.execute(delete(Queue).where(Queue.patient_id == patient_id).execution_options(synchronize_session=False))
 
     # Delete associated patient flow entries
-    db.query(PatientFlow).filter(PatientFlow.patient_id == patient_id).delete(synchronize_session=False)
+    await db.execute(delete(PatientFlow).where(PatientFlow.patient_id == patient_id).execution_options(synchronize_session=False))
 
     # Delete the patient record
-    db.delete(patient)
-    db.commit()
+    await db.delete(patient)
+    await db.commit()
+    display_cache.invalidate(opd_to_update, *affected_opds)
 
     # Broadcast updates if the patient was in an active OPD queue
     if opd_to_update:
-        await broadcast_queue_update(opd_to_update, db)
-    await broadcast_display_update() # General display update
+        broadcast_dispatcher.queue_changed(opd_to_update)
+    broadcast_dispatcher.display_changed() # General display update
 
     return {"message": f"Patient {patient.token_number} and all associated records deleted successfully."}
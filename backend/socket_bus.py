@@ -0,0 +1,155 @@
+"""
+Message bus behind the Socket.IO server.
+
+With the default local manager every room lives in the memory of one process,
+so a queue update emitted by one uvicorn/gunicorn worker never reaches clients
+connected to another. Selecting a pub/sub manager with SOCKETIO_MANAGER makes
+every emit go through a shared channel, and each worker delivers it to its own
+clients in the room:
+
+- local     rooms in process memory only (single worker, the default)
+- postgres  Postgres LISTEN/NOTIFY on the application database
+- redis     a Redis-compatible server at SOCKETIO_BUS_URL (needs the redis package)
+- inprocess an in-process channel shared by every server in the process, to
+            exercise the pub/sub path without a database or Redis
+"""
+
+import asyncio
+import json
+import os
+import uuid
+from typing import Dict, List, Optional
+import socketio
+from socketio.async_pubsub_manager import AsyncPubSubManager
+
+SOCKETIO_MANAGER = os.getenv("SOCKETIO_MANAGER", "local").lower()
+SOCKETIO_CHANNEL = os.getenv("SOCKETIO_CHANNEL", "eye_hospital_socketio")
+
+# NOTIFY payloads must stay under 8000 bytes; longer messages are sent in chunks
+NOTIFY_CHUNK_SIZE = 7000
+
+
+def get_plain_postgres_url() -> str:
+    """The application database as a plain libpq URL (no SQLAlchemy driver suffix), for asyncpg"""
+    from database import DATABASE_URL
+    scheme, rest = DATABASE_URL.split("://", 1)
+    return f"{scheme.split('+')[0]}://{rest}"
+
+
+def get_bus_url() -> Optional[str]:
+    """SOCKETIO_BUS_URL, or for Postgres the application database"""
+    url = os.getenv("SOCKETIO_BUS_URL")
+    if url or SOCKETIO_MANAGER != "postgres":
+        return url
+    return get_plain_postgres_url()
+
+
+class AsyncPostgresManager(AsyncPubSubManager):
+    """Socket.IO client manager that shares emits between processes over Postgres LISTEN/NOTIFY"""
+
+    name = "asyncpostgres"
+
+    def __init__(self, url: str, channel: str = "socketio", write_only: bool = False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.url = url
+        self._publish_conn = None
+        self._publish_lock = asyncio.Lock()
+        self._partial: Dict[str, List[Optional[str]]] = {}  # message id -> chunks received so far
+
+    async def _publish(self, data):
+        message = json.dumps(data)  # ASCII only, so characters and bytes line up for chunking
+        if len(message) <= NOTIFY_CHUNK_SIZE:
+            payloads = [message]
+        else:
+            message_id = uuid.uuid4().hex
+            parts = [message[i:i + NOTIFY_CHUNK_SIZE] for i in range(0, len(message), NOTIFY_CHUNK_SIZE)]
+            payloads = [f"#{message_id}:{index}:{len(parts)}:{part}" for index, part in enumerate(parts)]
+
+        async with self._publish_lock:
+            for attempt in range(2):
+                try:
+                    if self._publish_conn is None or self._publish_conn.is_closed():
+                        import asyncpg
+                        self._publish_conn = await asyncpg.connect(self.url)
+                    # Notifications of one transaction are delivered together and in order
+                    async with self._publish_conn.transaction():
+                        for payload in payloads:
+                            await self._publish_conn.execute("SELECT pg_notify($1, $2)", self.channel, payload)
+                    return
+                except Exception:
+                    self._publish_conn = None
+                    if attempt:
+                        raise
+
+    def _reassemble(self, payload: str) -> Optional[str]:
+        if not payload.startswith("#"):
+            return payload
+        message_id, index, total, part = payload[1:].split(":", 3)
+        chunks = self._partial.setdefault(message_id, [None] * int(total))
+        chunks[int(index)] = part
+        if any(chunk is None for chunk in chunks):
+            return None
+        del self._partial[message_id]
+        return "".join(chunks)
+
+    async def _listen(self):
+        import asyncpg
+        messages: asyncio.Queue = asyncio.Queue()
+        while True:
+            try:
+                conn = await asyncpg.connect(self.url)
+                await conn.add_listener(self.channel, lambda _conn, _pid, _channel, payload: messages.put_nowait(payload))
+            except Exception as e:
+                print(f"Socket.IO bus: could not listen on Postgres, retrying: {e}")
+                await asyncio.sleep(5)
+                continue
+            try:
+                while not conn.is_closed():
+                    try:
+                        payload = await asyncio.wait_for(messages.get(), timeout=5)
+                    except asyncio.TimeoutError:
+                        continue  # Re-check the connection
+                    message = self._reassemble(payload)
+                    if message is not None:
+                        yield message
+            finally:
+                self._partial.clear()
+                if not conn.is_closed():
+                    await conn.close()
+            print("Socket.IO bus: Postgres listener connection lost, reconnecting")
+
+
+class InProcessPubSubManager(AsyncPubSubManager):
+    """Pub/sub manager whose channel is shared by every server in this process"""
+
+    name = "inprocess"
+    _subscribers: Dict[str, List[asyncio.Queue]] = {}
+
+    async def _publish(self, data):
+        for queue in list(self._subscribers.get(self.channel, [])):
+            queue.put_nowait(data)
+
+    async def _listen(self):
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers.setdefault(self.channel, []).append(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._subscribers[self.channel].remove(queue)
+
+
+def create_client_manager() -> Optional[socketio.AsyncManager]:
+    """Client manager for SOCKETIO_MANAGER, or None for Socket.IO's own in-memory manager"""
+    if SOCKETIO_MANAGER == "local":
+        return None
+    if SOCKETIO_MANAGER == "postgres":
+        url = get_bus_url()
+        if not url.startswith("postgresql"):
+            raise ValueError("SOCKETIO_MANAGER=postgres needs a PostgreSQL DATABASE_URL or SOCKETIO_BUS_URL")
+        return AsyncPostgresManager(url, channel=SOCKETIO_CHANNEL)
+    if SOCKETIO_MANAGER == "redis":
+        return socketio.AsyncRedisManager(get_bus_url() or "redis://localhost:6379/0", channel=SOCKETIO_CHANNEL)
+    if SOCKETIO_MANAGER == "inprocess":
+        return InProcessPubSubManager(channel=SOCKETIO_CHANNEL)
+    raise ValueError(f"Unknown SOCKETIO_MANAGER: {SOCKETIO_MANAGER}")
@@ -0,0 +1,148 @@
+"""
+Shared statistics queries for the OPD, dashboard and display endpoints.
+
+All hospital-wide counters come from one conditional-aggregation statement over
+`patients`, and all per-OPD counters from one grouped statement over `queues`,
+instead of a separate COUNT query per status and per OPD.
+"""
+
+from datetime import datetime, time, timedelta
+from typing import Dict, List, Optional
+from pydantic import BaseModel
+from sqlalchemy import func, case
+from sqlalchemy.orm import Session
+from database import Patient, Queue, PatientStatus, get_ist_now
+
+
+class HospitalSummary(BaseModel):
+    total_patients_today: int
+    pending: int
+    in_opd: int
+    dilated: int
+    referred: int
+    completed_today: int
+    # Turnaround = registration to completion, in minutes, for patients completed today
+    avg_turnaround_minutes: Optional[float] = None
+    p50_turnaround_minutes: Optional[float] = None
+    p90_turnaround_minutes: Optional[float] = None
+
+
+class OPDCounts(BaseModel):
+    opd_code: str
+    total: int = 0
+    pending: int = 0
+    in_opd: int = 0
+    dilated: int = 0
+    referred: int = 0
+    allocated_patients: int = 0
+
+
+def _count_if(condition):
+    return func.sum(case((condition, 1), else_=0))
+
+
+def _turnaround_seconds(db: Session):
+    """Seconds between registration and completion, in the current database's dialect"""
+    if db.bind.dialect.name == "postgresql":
+        return func.extract("epoch", Patient.completed_at - Patient.registration_time)
+    return (func.julianday(Patient.completed_at) - func.julianday(Patient.registration_time)) * 86400.0
+
+
+def _percentile(sorted_values: List[float], fraction: float) -> Optional[float]:
+    """Linear-interpolated percentile, same definition as Postgres percentile_cont"""
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def _minutes(seconds) -> Optional[float]:
+    return float(seconds) / 60 if seconds is not None else None
+
+
+def get_hospital_summary(db: Session) -> HospitalSummary:
+    """Status counts and today's turnaround statistics for the whole hospital"""
+    day_start = datetime.combine(get_ist_now().date(), time.min)
+    day_end = day_start + timedelta(days=1)
+
+    completed_today = (
+        (Patient.current_status == PatientStatus.COMPLETED) &
+        (Patient.completed_at >= day_start) &
+        (Patient.completed_at < day_end)
+    )
+    # NULL for everyone except patients completed today, aggregates skip NULLs
+    turnaround = case((completed_today, _turnaround_seconds(db)), else_=None)
+    is_postgres = db.bind.dialect.name == "postgresql"
+
+    columns = [
+        _count_if((Patient.registration_time >= day_start) & (Patient.registration_time < day_end)),
+        _count_if(Patient.current_status == PatientStatus.PENDING),
+        _count_if(Patient.current_status == PatientStatus.IN_OPD),
+        _count_if(Patient.current_status == PatientStatus.DILATED),
+        _count_if(Patient.current_status == PatientStatus.REFERRED),
+        _count_if(completed_today),
+        func.avg(turnaround),
+    ]
+    if is_postgres:
+        columns.append(func.percentile_cont(0.5).within_group(turnaround))
+        columns.append(func.percentile_cont(0.9).within_group(turnaround))
+
+    row = db.query(*columns).one()
+    total_today, pending, in_opd, dilated, referred, completed, avg_seconds = row[:7]
+
+    if is_postgres:
+        p50_seconds, p90_seconds = row[7], row[8]
+    else:
+        # SQLite has no percentile aggregate, sort today's (small) list of turnarounds here
+        durations = sorted(
+            value for (value,) in db.query(_turnaround_seconds(db)).filter(completed_today).all()
+            if value is not None
+        )
+        p50_seconds, p90_seconds = _percentile(durations, 0.5), _percentile(durations, 0.9)
+
+    return HospitalSummary(
+        total_patients_today=total_today or 0,
+        pending=pending or 0,
+        in_opd=in_opd or 0,
+        dilated=dilated or 0,
+        referred=referred or 0,
+        completed_today=completed or 0,
+        avg_turnaround_minutes=_minutes(avg_seconds),
+        p50_turnaround_minutes=_minutes(p50_seconds),
+        p90_turnaround_minutes=_minutes(p90_seconds),
+    )
+
+
+def get_opd_counts(db: Session, opd_codes: List[str], include_allocated: bool = False) -> Dict[str, OPDCounts]:
+    """Queue status counts for several OPDs, optionally with the number of patients allocated to each"""
+    counts = {opd_code: OPDCounts(opd_code=opd_code) for opd_code in opd_codes}
+    if not counts:
+        return counts
+
+    rows = db.query(
+        Queue.opd_type,
+        func.count(Queue.id),
+        _count_if(Queue.status == PatientStatus.PENDING),
+        _count_if(Queue.status == PatientStatus.IN_OPD),
+        _count_if(Queue.status == PatientStatus.DILATED),
+        _count_if(Queue.status == PatientStatus.REFERRED),
+    ).filter(Queue.opd_type.in_(opd_codes)).group_by(Queue.opd_type).all()
+
+    for opd_code, total, pending, in_opd, dilated, referred in rows:
+        opd_counts = counts[opd_code]
+        opd_counts.total = total or 0
+        opd_counts.pending = pending or 0
+        opd_counts.in_opd = in_opd or 0
+        opd_counts.dilated = dilated or 0
+        opd_counts.referred = referred or 0
+
+    if include_allocated:
+        allocated = db.query(Patient.allocated_opd, func.count(Patient.id)).filter(
+            Patient.allocated_opd.in_(opd_codes)
+        ).group_by(Patient.allocated_opd).all()
+        for opd_code, count in allocated:
+            counts[opd_code].allocated_patients = count
+
+    return counts
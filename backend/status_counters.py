@@ -0,0 +1,318 @@
+"""
+Incrementally maintained per-OPD status counters.
+
+Instead of counting rows on every stats request, the counts are kept in memory
+and adjusted from the Queue/Patient changes of every committed session
+(call-next, dilate, return-dilated, refer, end visit, ...). They are rebuilt
+from the database at startup, when the IST day changes and whenever a bulk
+delete makes them unreliable, and a periodic reconciliation compares them
+with a full recount.
+"""
+
+import asyncio
+import threading
+from collections import defaultdict
+from typing import Dict, List, Optional
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+from database import SessionLocal, Patient, Queue, PatientStatus, get_ist_now
+from stats import HospitalSummary, OPDCounts, get_hospital_summary
+
+
+class CounterState:
+    """One consistent set of counts"""
+
+    def __init__(self):
+        self.queue: Dict[tuple, int] = defaultdict(int)  # (opd_code, status) -> queue entries
+        self.patients: Dict[PatientStatus, int] = defaultdict(int)  # current_status -> patients
+        self.allocated: Dict[str, int] = defaultdict(int)  # allocated_opd -> patients
+        self.registered_today = 0
+        self.completed_today = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "queue": {f"{opd_code}:{_status_value(status)}": count for (opd_code, status), count in self.queue.items() if count},
+            "patients": {_status_value(status): count for status, count in self.patients.items() if count},
+            "allocated": {opd_code: count for opd_code, count in self.allocated.items() if count},
+            "registered_today": self.registered_today,
+            "completed_today": self.completed_today,
+        }
+
+
+def _status_value(status) -> str:
+    return status.value if isinstance(status, PatientStatus) else str(status)
+
+
+class StatusCounters:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state: Optional[CounterState] = None
+        self._day = None
+        self._turnaround: Optional[HospitalSummary] = None
+        # Bumped by every apply()/mark_stale(), so a recount can tell it raced with a commit
+        self._generation = 0
+        self.last_reconciliation: Optional[dict] = None
+        self.rebuilds = 0
+
+    # Reads
+
+    def get_summary(self, db: Session) -> HospitalSummary:
+        """Same numbers as stats.get_hospital_summary, served from the counters"""
+        state = self._ensure_fresh(db)
+        turnaround = self._turnaround
+        if turnaround is None:
+            # Only recomputed after a completion changed it
+            turnaround = get_hospital_summary(db)
+            self._turnaround = turnaround
+        return HospitalSummary(
+            total_patients_today=state.registered_today,
+            pending=state.patients[PatientStatus.PENDING],
+            in_opd=state.patients[PatientStatus.IN_OPD],
+            dilated=state.patients[PatientStatus.DILATED],
+            referred=state.patients[PatientStatus.REFERRED],
+            completed_today=state.completed_today,
+            avg_turnaround_minutes=turnaround.avg_turnaround_minutes,
+            p50_turnaround_minutes=turnaround.p50_turnaround_minutes,
+            p90_turnaround_minutes=turnaround.p90_turnaround_minutes,
+        )
+
+    def get_opd_counts(self, db: Session, opd_codes: List[str], include_allocated: bool = False) -> Dict[str, OPDCounts]:
+        """Same numbers as stats.get_opd_counts, served from the counters"""
+        state = self._ensure_fresh(db)
+        counts = {}
+        for opd_code in opd_codes:
+            by_status = {status: state.queue.get((opd_code, status), 0) for status in PatientStatus}
+            counts[opd_code] = OPDCounts(
+                opd_code=opd_code,
+                total=sum(by_status.values()),
+                pending=by_status[PatientStatus.PENDING],
+                in_opd=by_status[PatientStatus.IN_OPD],
+                dilated=by_status[PatientStatus.DILATED],
+                referred=by_status[PatientStatus.REFERRED],
+                allocated_patients=state.allocated.get(opd_code, 0) if include_allocated else 0,
+            )
+        return counts
+
+    def snapshot(self) -> Optional[dict]:
+        state = self._state
+        return state.as_dict() if state is not None else None
+
+    # Maintenance
+
+    def mark_stale(self):
+        """Forget the counters, the next read recounts from the database"""
+        with self._lock:
+            self._generation += 1
+            self._state = None
+            self._turnaround = None
+
+    def rebuild(self, db: Session) -> CounterState:
+        with self._lock:
+            generation = self._generation
+        state = self._count(db)
+        with self._lock:
+            # A change applied while we counted may be missing from the count: leave the
+            # counters stale (the next read recounts) rather than keep a wrong state
+            if self._generation == generation:
+                self._state = state
+                self._day = get_ist_now().date()
+                self._turnaround = None
+        self.rebuilds += 1
+        return state
+
+    def reconcile(self, db: Session) -> dict:
+        """Compare the counters with a full recount, then replace them with the recount"""
+        with self._lock:
+            current = self._state
+            generation = self._generation
+        recount = self._count(db)
+        # Counters changed while we counted: they can't be compared with the recount
+        superseded = self._generation != generation
+        mismatches = {}
+        if current is not None and not superseded and self._day == get_ist_now().date():
+            current_counts, recount_counts = current.as_dict(), recount.as_dict()
+            for section in ("queue", "patients", "allocated"):
+                for key in set(current_counts[section]) | set(recount_counts[section]):
+                    counted, expected = current_counts[section].get(key, 0), recount_counts[section].get(key, 0)
+                    if counted != expected:
+                        mismatches[f"{section}.{key}"] = {"counter": counted, "recount": expected}
+            for key in ("registered_today", "completed_today"):
+                if current_counts[key] != recount_counts[key]:
+                    mismatches[key] = {"counter": current_counts[key], "recount": recount_counts[key]}
+
+        with self._lock:
+            if self._generation == generation:
+                self._state = recount
+                self._day = get_ist_now().date()
+                self._turnaround = None
+        self.rebuilds += 1
+        self.last_reconciliation = {
+            "checked_at": get_ist_now().isoformat(),
+            "compared": current is not None and not superseded,
+            "consistent": not mismatches,
+            "mismatches": mismatches,
+        }
+        return self.last_reconciliation
+
+    async def run_reconciliation_loop(self, interval_seconds: int):
+        """Background task: periodic reconciliation, which also rolls the counters over at IST midnight"""
+        while True:
+            await asyncio.sleep(interval_seconds)
+            db = SessionLocal()
+            try:
+                self.reconcile(db)
+            except Exception as e:
+                print(f"Status counter reconciliation failed: {e}")
+            finally:
+                db.close()
+
+    def apply(self, changes: List[tuple]):
+        """Apply the (kind, key, delta) changes of a committed session"""
+        with self._lock:
+            self._generation += 1
+            state = self._state
+            if state is None or self._day != get_ist_now().date():
+                return  # Will be rebuilt on the next read anyway
+            for kind, key, delta in changes:
+                if kind == "queue":
+                    state.queue[key] += delta
+                elif kind == "patient":
+                    state.patients[key] += delta
+                elif kind == "allocated":
+                    state.allocated[key] += delta
+                elif kind == "registered_today":
+                    state.registered_today += delta
+                elif kind == "completed_today":
+                    state.completed_today += delta
+                    self._turnaround = None
+
+    def _ensure_fresh(self, db: Session) -> CounterState:
+        state = self._state
+        if state is None or self._day != get_ist_now().date():
+            state = self.rebuild(db)
+        return state
+
+    def _count(self, db: Session) -> CounterState:
+        state = CounterState()
+        for opd_code, status, count in db.query(Queue.opd_type, Queue.status, func.count(Queue.id)).group_by(
+            Queue.opd_type, Queue.status
+        ).all():
+            state.queue[(opd_code, status)] = count
+        for status, allocated_opd, count in db.query(Patient.current_status, Patient.allocated_opd, func.count(Patient.id)).group_by(
+            Patient.current_status, Patient.allocated_opd
+        ).all():
+            state.patients[status] += count
+            if allocated_opd:
+                state.allocated[allocated_opd] += count
+        summary = get_hospital_summary(db)
+        state.registered_today = summary.total_patients_today
+        state.completed_today = summary.completed_today
+        return state
+
+
+status_counters = StatusCounters()
+
+
+# Session hooks: collect counter changes during flush, apply them only after commit
+
+class _UnknownPreviousValue(Exception):
+    """An attribute was overwritten before its old value was ever loaded"""
+
+
+def _before_after(obj, attr):
+    history = get_history(obj, attr)
+    if history.has_changes():
+        if not history.deleted and inspect(obj).persistent:
+            raise _UnknownPreviousValue(attr)
+        before = history.deleted[0] if history.deleted else None
+        after = history.added[0] if history.added else None
+        return before, after
+    value = getattr(obj, attr)
+    return value, value
+
+
+def _is_today(value) -> bool:
+    return value is not None and value.date() == get_ist_now().date()
+
+
+def _patient_changes(sign: int, status, allocated_opd, registration_time, completed_at) -> List[tuple]:
+    changes = [("patient", status, sign)]
+    if allocated_opd:
+        changes.append(("allocated", allocated_opd, sign))
+    if _is_today(registration_time):
+        changes.append(("registered_today", None, sign))
+    if status == PatientStatus.COMPLETED and _is_today(completed_at):
+        changes.append(("completed_today", None, sign))
+    return changes
+
+
+def _load_previous_value(target, value, oldvalue, initiator):
+    return value
+
+
+# active_history makes SQLAlchemy load the old value before an unloaded attribute is overwritten
+for _attribute in (Queue.opd_type, Queue.status, Patient.current_status, Patient.allocated_opd,
+                   Patient.registration_time, Patient.completed_at):
+    event.listen(_attribute, "set", _load_previous_value, active_history=True, retval=True)
+
+
+@event.listens_for(SessionLocal, "before_flush")
+def _collect_counter_changes(session, flush_context, instances):
+    changes = session.info.setdefault("status_counter_changes", [])
+
+    for obj in session.new:
+        if isinstance(obj, Queue):
+            changes.append(("queue", (obj.opd_type, obj.status or PatientStatus.PENDING), 1))
+        elif isinstance(obj, Patient):
+            changes.extend(_patient_changes(
+                1, obj.current_status or PatientStatus.PENDING, obj.allocated_opd,
+                obj.registration_time or get_ist_now(), obj.completed_at
+            ))
+
+    for obj in session.dirty:
+        try:
+            if isinstance(obj, Queue):
+                opd_before, opd_after = _before_after(obj, "opd_type")
+                status_before, status_after = _before_after(obj, "status")
+                if (opd_before, status_before) != (opd_after, status_after):
+                    changes.append(("queue", (opd_before, status_before), -1))
+                    changes.append(("queue", (opd_after, status_after), 1))
+            elif isinstance(obj, Patient):
+                values = [_before_after(obj, attr) for attr in ("current_status", "allocated_opd", "registration_time", "completed_at")]
+                before = [value[0] for value in values]
+                after = [value[1] for value in values]
+                if before != after:
+                    changes.extend(_patient_changes(-1, *before))
+                    changes.extend(_patient_changes(1, *after))
+        except _UnknownPreviousValue:
+            session.info["status_counters_stale"] = True
+
+    for obj in session.deleted:
+        if isinstance(obj, Queue):
+            changes.append(("queue", (obj.opd_type, obj.status), -1))
+        elif isinstance(obj, Patient):
+            changes.extend(_patient_changes(-1, obj.current_status, obj.allocated_opd, obj.registration_time, obj.completed_at))
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _apply_counter_changes(session):
+    changes = session.info.pop("status_counter_changes", None)
+    if session.info.pop("status_counters_stale", False):
+        status_counters.mark_stale()
+    elif changes:
+        status_counters.apply(changes)
+
+
+@event.listens_for(SessionLocal, "after_soft_rollback")
+def _discard_counter_changes(session, previous_transaction):
+    session.info.pop("status_counter_changes", None)
+    session.info.pop("status_counters_stale", None)
+
+
+@event.listens_for(SessionLocal, "do_orm_execute")
+def _bulk_change_invalidates_counters(orm_execute_state):
+    # Statement-level inserts/deletes/updates don't tell us which statuses were touched
+    if orm_execute_state.is_insert or orm_execute_state.is_delete or orm_execute_state.is_update:
+        if any(mapper.class_ in (Queue, Patient) for mapper in orm_execute_state.all_mappers):
+            orm_execute_state.session.info["status_counters_stale"] = True
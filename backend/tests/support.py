@@ -0,0 +1,57 @@
+"""
+Shared setup for the backend tests.
+
+Points DATABASE_URL at a throwaway SQLite file before anything imports
+`database`, so the tests never touch a real database. Run from backend/:
+
+    python -m unittest discover tests
+"""
+
+import contextlib
+import os
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+TEST_DB_PATH = os.path.join(tempfile.mkdtemp(prefix="eye_hospital_tests_"), "test.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{TEST_DB_PATH}"
+
+from sqlalchemy import event
+from database import Base, engine, SessionLocal, OPD
+
+
+def reset_database(opd_codes=("opd1", "opd2")):
+    """Empty schema with the given active OPDs, and fresh in-process caches"""
+    from display_cache import display_cache
+    from status_counters import status_counters
+
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        db.add_all([OPD(opd_code=code, opd_name=code.upper()) for code in opd_codes])
+        db.commit()
+    finally:
+        db.close()
+    display_cache.invalidate_opd_list()
+    display_cache.invalidate(*opd_codes)
+    status_counters.mark_stale()
+
+
+@contextlib.contextmanager
+def count_statements(bind=None):
+    """Collect the SQL statements run inside the block, on the sync engine unless bind is given"""
+    bind = bind or engine
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(bind, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(bind, "before_cursor_execute", record)
@@ -0,0 +1,122 @@
+import threading
+import unittest
+
+from tests.support import reset_database
+from tests.test_tokens import register_in_parallel
+from database import SessionLocal, EventOutbox, Patient, PatientFlow, PatientStatus, get_ist_now
+from bulk_registration import parse_csv, register_patients
+from status_counters import status_counters
+from tokens import FIRST_TOKEN_NUMBER, format_token
+
+BULK_ROWS = 300
+PARALLEL_REGISTRATIONS = 20
+
+
+def bulk_register(rows, dry_run=False):
+    db = SessionLocal()
+    try:
+        result = register_patients(db, rows, dry_run=dry_run)
+        db.commit()
+        return result
+    finally:
+        db.close()
+
+
+class BulkRegistrationTest(unittest.TestCase):
+    def setUp(self):
+        reset_database()
+        self.day = get_ist_now().strftime("%Y%m%d")
+
+    def test_invalid_rows_are_reported_by_row_number(self):
+        rows = [
+            {"name": "Asha Rao", "age": "41", "phone": "98450 12345"},
+            {"name": "  ", "age": "30"},
+            {"registration_number": "R-7"},
+            {"name": "Vikram Shah", "age": "forty"},
+            "not an object",
+            {"name": "Meena Iyer", "registration_number": "R-9", "age": ""},
+        ]
+        result = bulk_register(rows)
+
+        self.assertEqual([(error.row, error.error.split(":")[0]) for error in result.errors],
+                         [(2, "name"), (3, "name"), (4, "age"), (5, "Expected an object")])
+        self.assertEqual([patient.row for patient in result.patients], [1, 6])
+        db = SessionLocal()
+        try:
+            # Ids returned by the multi-row INSERT ... RETURNING belong to the rows they are reported for
+            names = {patient.row: db.get(Patient, patient.id).name for patient in result.patients}
+            meena = db.get(Patient, result.patients[1].id)
+        finally:
+            db.close()
+        self.assertEqual(names, {1: "Asha Rao", 6: "Meena Iyer"})
+        self.assertEqual((meena.registration_number, meena.age), ("R-9", None))
+
+    def test_dry_run_registers_nothing(self):
+        result = bulk_register([{"name": "Asha Rao"}, {"age": 3}], dry_run=True)
+        self.assertEqual((result.registered, result.failed), (0, 1))
+        db = SessionLocal()
+        try:
+            self.assertEqual(db.query(Patient).count(), 0)
+        finally:
+            db.close()
+
+    def test_csv_header_and_byte_order_mark(self):
+        rows = parse_csv("﻿Registration_Number,Name,Age,Phone\nR-1,Asha Rao,41,\nR-2,Vikram Shah,,98450\n")
+        self.assertEqual(rows[0], {"registration_number": "R-1", "name": "Asha Rao", "age": "41", "phone": ""})
+        self.assertEqual(bulk_register(rows).registered, 2)
+
+    def test_tokens_are_contiguous_next_to_single_registrations(self):
+        rows = [{"name": f"Camp patient {index}"} for index in range(BULK_ROWS)]
+        results = []
+        bulk = threading.Thread(target=lambda: results.append(bulk_register(rows)))
+        bulk.start()
+        single_tokens, errors = register_in_parallel(PARALLEL_REGISTRATIONS)
+        bulk.join()
+
+        self.assertEqual(errors, [])
+        bulk_tokens = [patient.token_number for patient in results[0].patients]
+        numbers = [int(token.split("-")[-1]) for token in bulk_tokens]
+        self.assertEqual(numbers, list(range(numbers[0], numbers[0] + BULK_ROWS)))
+        # Together the bulk block and the single tokens use every number once
+        all_tokens = bulk_tokens + single_tokens
+        self.assertEqual(len(set(all_tokens)), len(all_tokens))
+        self.assertEqual(sorted(all_tokens), [
+            format_token(self.day, number)
+            for number in range(FIRST_TOKEN_NUMBER, FIRST_TOKEN_NUMBER + BULK_ROWS + PARALLEL_REGISTRATIONS)
+        ])
+
+    def test_flows_and_outbox_events_are_written(self):
+        result = bulk_register([{"name": f"Camp patient {index}"} for index in range(5)])
+        db = SessionLocal()
+        try:
+            flows = db.query(PatientFlow).order_by(PatientFlow.patient_id).all()
+            events = db.query(EventOutbox).order_by(EventOutbox.seq).all()
+        finally:
+            db.close()
+
+        registered = [(patient.id, patient.token_number) for patient in result.patients]
+        self.assertEqual([(flow.patient_id, flow.to_room, flow.status) for flow in flows],
+                         [(patient_id, "registration", PatientStatus.PENDING) for patient_id, _ in registered])
+        self.assertEqual([(event.patient_id, event.token_number, event.status, event.to_room) for event in events],
+                         [(patient_id, token, PatientStatus.PENDING.value, "registration") for patient_id, token in registered])
+
+    def test_status_counters_are_marked_stale(self):
+        db = SessionLocal()
+        try:
+            status_counters.rebuild(db)
+        finally:
+            db.close()
+        self.assertIsNotNone(status_counters.snapshot())
+
+        bulk_register([{"name": "Asha Rao"}, {"name": "Vikram Shah"}])
+
+        self.assertIsNone(status_counters.snapshot())
+        db = SessionLocal()
+        try:
+            self.assertEqual(status_counters.get_summary(db).total_patients_today, 2)
+        finally:
+            db.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+import asyncio
+import json
+import unittest
+from unittest import mock
+
+from sqlalchemy import text
+from tests.support import reset_database
+from database import engine, SessionLocal, Patient, Queue, PatientStatus
+from display_cache import display_cache
+from status_counters import status_counters
+import change_feed
+from change_feed import ChangeFeed
+
+POLL_SECONDS = 0.2
+
+
+def queue_patient(token_number, opd_code="opd1"):
+    db = SessionLocal()
+    try:
+        patient = Patient(token_number=token_number, name=f"Patient {token_number}", allocated_opd=opd_code)
+        db.add(patient)
+        db.flush()
+        db.add(Queue(opd_type=opd_code, patient_id=patient.id, position=1, status=PatientStatus.PENDING))
+        db.commit()
+    finally:
+        db.close()
+
+
+class NotificationTest(unittest.TestCase):
+    """Notifications carry the net counter change of a statement, applied without a recount"""
+
+    def setUp(self):
+        reset_database()
+        queue_patient("0001")
+        self.feed = ChangeFeed()
+        db = SessionLocal()
+        try:
+            status_counters.rebuild(db)
+        finally:
+            db.close()
+
+    def notify(self, change):
+        with mock.patch.object(change_feed, "broadcast_dispatcher"):
+            self.feed._on_notification(pid=-1, payload=json.dumps(change))
+
+    def test_counter_changes_are_applied(self):
+        # A peer worker's bulk import of 3 patients, one of them queued in opd2
+        self.notify({
+            "opds": ["opd2"],
+            "counts": [["patient", "PENDING", 3], ["allocated", "opd2", 3], ["registered_today", None, 3]],
+            "app": True,
+        })
+        self.notify({"opds": ["opd2"], "counts": [["queue", ["opd2", "PENDING"], 1]], "app": True})
+
+        counts = status_counters.snapshot()
+        self.assertIsNotNone(counts)
+        self.assertEqual(counts["patients"]["pending"], 4)
+        self.assertEqual(counts["allocated"], {"opd1": 1, "opd2": 3})
+        self.assertEqual(counts["queue"]["opd2:pending"], 1)
+        self.assertEqual(counts["registered_today"], 4)
+
+    def test_unreadable_or_oversized_changes_recount(self):
+        self.notify({"opds": ["opd1"], "counts": [["patient", "NOT_A_STATUS", 1]]})
+        self.assertIsNone(status_counters.snapshot())
+
+        db = SessionLocal()
+        try:
+            status_counters.rebuild(db)
+        finally:
+            db.close()
+        self.notify({"stale": True})
+        self.assertIsNone(status_counters.snapshot())
+
+
+class PollTest(unittest.TestCase):
+    """SQLite polling must see a change made elsewhere even next to a write of our own"""
+
+    def setUp(self):
+        reset_database()
+        queue_patient("0001")
+        self.feed = ChangeFeed()
+        self.applied = []
+        self.feed.apply = lambda opd_codes, *args, **kwargs: self.applied.append(set(opd_codes))
+
+    def run_polling(self, scenario):
+        async def run():
+            with mock.patch.object(change_feed, "CHANGE_FEED_POLL_SECONDS", POLL_SECONDS):
+                task = asyncio.create_task(self.feed._poll())
+                try:
+                    while self.feed._fingerprints is None:
+                        await asyncio.sleep(0.01)
+                    await scenario()
+                    await asyncio.sleep(POLL_SECONDS * 2.5)
+                finally:
+                    task.cancel()
+        asyncio.run(run())
+
+    async def own_write(self):
+        queue_patient("0002")
+        display_cache.invalidate("opd1")
+        # Let the fingerprint after our write be taken
+        await asyncio.sleep(0.05)
+
+    def test_own_write_is_not_reported(self):
+        self.run_polling(self.own_write)
+        self.assertEqual(self.applied, [])
+
+    def test_external_change_next_to_own_write_is_reported(self):
+        async def scenario():
+            await self.own_write()
+            with engine.begin() as conn:
+                conn.execute(text("UPDATE queues SET position = 7 WHERE opd_type = 'opd1'"))
+        self.run_polling(scenario)
+        self.assertEqual(self.applied, [{"opd1"}])
+
+    def test_first_snapshot_build_is_not_a_write(self):
+        async def scenario():
+            db = SessionLocal()
+            try:
+                display_cache.invalidate_opd_list()
+                display_cache.get_all_snapshots(db)
+            finally:
+                db.close()
+            with engine.begin() as conn:
+                conn.execute(text("UPDATE queues SET position = 3 WHERE opd_type = 'opd1'"))
+        self.run_polling(scenario)
+        self.assertEqual(self.applied, [{"opd1"}])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import asyncio
+import unittest
+
+from tests.support import reset_database
+from database import SessionLocal, Patient, Queue, PatientStatus
+from display_cache import DisplaySnapshotCache, display_cache
+from routers.display import get_opd_display_changes
+
+
+def queue_patient(token_number):
+    db = SessionLocal()
+    try:
+        patient = Patient(token_number=token_number, name=f"Patient {token_number}", allocated_opd="opd1")
+        db.add(patient)
+        db.flush()
+        db.add(Queue(opd_type="opd1", patient_id=patient.id, position=1, status=PatientStatus.PENDING))
+        db.commit()
+    finally:
+        db.close()
+
+
+def changes(since, timeout=0.2):
+    return asyncio.run(get_opd_display_changes("opd1", since=since, timeout=timeout))
+
+
+class DisplayChangesTest(unittest.TestCase):
+    """Long-poll versions must mean the same on every API worker"""
+
+    def setUp(self):
+        reset_database()
+        queue_patient("0001")
+
+    def test_workers_agree_on_the_version(self):
+        db = SessionLocal()
+        try:
+            # A second cache stands in for another worker, whose local counters differ
+            other_worker = DisplaySnapshotCache()
+            other_worker.invalidate("opd1", "opd1", "opd1")
+            ours = display_cache.get_snapshot("opd1", db)
+            theirs = other_worker.get_snapshot("opd1", db)
+        finally:
+            db.close()
+        self.assertNotEqual(ours.version, theirs.version)
+        self.assertEqual(ours.content_token, theirs.content_token)
+
+    def test_unchanged_queue_waits_for_the_timeout(self):
+        version = changes(None)["version"]
+        # Invalidated, but the queue is the same: still nothing new for the client
+        display_cache.invalidate("opd1")
+        self.assertEqual(changes(version).status_code, 204)
+
+    def test_changed_queue_answers_with_the_new_version(self):
+        version = changes(None)["version"]
+        queue_patient("0002")
+        display_cache.invalidate("opd1")
+        result = changes(version)
+        self.assertNotEqual(result["version"], version)
+        self.assertEqual(len(result["data"].next_patients), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+import csv
+import io
+import json
+import unittest
+from datetime import timedelta
+from unittest import mock
+
+from tests.support import reset_database
+from tests.test_pagination import list_flows, list_patients
+from database import SessionLocal, Patient, PatientFlow, PatientStatus, get_ist_now
+from patient_search import patient_list_filters
+import exports
+from exports import export_patients, export_patient_flows
+
+STATUSES = [PatientStatus.PENDING, PatientStatus.IN_OPD, PatientStatus.COMPLETED]
+# Small enough that every export spans several cursor partitions, some of them split mid-day
+BATCH_SIZE = 4
+
+
+def exported(stream, export_format):
+    """Chunks of an export, and its rows as dicts of the values written"""
+    chunks = list(stream)
+    text = "".join(chunks)
+    if export_format == "csv":
+        rows = list(csv.DictReader(io.StringIO(text)))
+    else:
+        rows = [json.loads(line) for line in text.splitlines()]
+    return chunks, rows
+
+
+def as_written(value, export_format):
+    value = exports._plain(value)
+    if export_format == "csv":
+        return "" if value is None else str(value)
+    return value
+
+
+def walk(fetch):
+    """Every id of a cursor-paged list, newest first"""
+    ids, cursor = fetch(cursor=None)
+    while cursor:
+        page, cursor = fetch(cursor=cursor)
+        ids += page
+    return ids
+
+
+class ExportTest(unittest.TestCase):
+    """The exports must hold exactly the rows the filtered lists page through"""
+
+    def setUp(self):
+        reset_database()
+        now = get_ist_now().replace(hour=12, minute=0, second=0, microsecond=0)
+        self.days = [(now - timedelta(days=days)).strftime("%Y-%m-%d") for days in (2, 1, 0)]
+        db = SessionLocal()
+        try:
+            patients = []
+            for day in range(3):
+                for i in range(5):
+                    # Two patients of each day share a registration time, so order ties break on id
+                    registered = now - timedelta(days=2 - day, minutes=10 * min(i, 3))
+                    patients.append(Patient(
+                        token_number=f"{self.days[day]}-{day * 5 + i + 1001}", name=f"Patient {day}-{i}",
+                        age=30 + i if i % 2 else None, phone=None, registration_time=registered,
+                        current_status=STATUSES[(day + i) % 3], allocated_opd="opd1" if i % 2 else "opd2",
+                    ))
+            db.add_all(patients)
+            db.flush()
+            for index, patient in enumerate(patients):
+                for step in range(index % 3 + 1):
+                    db.add(PatientFlow(
+                        patient_id=patient.id, from_room=None if step == 0 else "registration",
+                        to_room="registration" if step == 0 else patient.allocated_opd,
+                        status=PatientStatus.PENDING if step == 0 else patient.current_status,
+                        timestamp=patient.registration_time + timedelta(minutes=step), notes=f"step {step}",
+                    ))
+            db.commit()
+        finally:
+            db.close()
+
+    def expected_patients(self, export_format, **filters):
+        ids = walk(lambda cursor: list_patients(limit=3, cursor=cursor, **filters))
+        db = SessionLocal()
+        try:
+            patients = [db.get(Patient, patient_id) for patient_id in reversed(ids)]
+            return [{column.key: as_written(getattr(patient, column.key), export_format)
+                     for column in exports.PATIENT_COLUMNS} for patient in patients]
+        finally:
+            db.close()
+
+    def expected_flows(self, export_format, **filters):
+        patient_ids = walk(lambda cursor: list_patients(limit=3, cursor=cursor, **filters))
+        flow_ids = []
+        for patient_id in patient_ids:
+            flow_ids += walk(lambda cursor: list_flows(cursor=cursor, patient_id=patient_id))
+        db = SessionLocal()
+        try:
+            flows = sorted((db.get(PatientFlow, flow_id) for flow_id in flow_ids), key=lambda f: (f.timestamp, f.id))
+            return [{
+                "id": as_written(flow.id, export_format), "patient_id": as_written(flow.patient_id, export_format),
+                "token_number": as_written(flow.patient.token_number, export_format),
+                "patient_name": as_written(flow.patient.name, export_format),
+                "from_room": as_written(flow.from_room, export_format),
+                "to_room": as_written(flow.to_room, export_format),
+                "status": as_written(flow.status, export_format),
+                "timestamp": as_written(flow.timestamp, export_format),
+                "notes": as_written(flow.notes, export_format),
+            } for flow in flows]
+        finally:
+            db.close()
+
+    def filter_cases(self):
+        return [
+            {},
+            {"status": PatientStatus.PENDING},
+            {"date_from": self.days[1]},
+            {"date_to": self.days[1]},
+            {"date_from": self.days[1], "date_to": self.days[1], "status": PatientStatus.COMPLETED},
+        ]
+
+    def test_patient_export_matches_the_patient_list(self):
+        for export_format in exports.EXPORT_FORMATS:
+            for filters in self.filter_cases():
+                with self.subTest(format=export_format, **filters), \
+                        mock.patch.object(exports, "EXPORT_BATCH_SIZE", BATCH_SIZE):
+                    conditions = patient_list_filters(**filters)
+                    chunks, rows = exported(export_patients(conditions, export_format), export_format)
+                    expected = self.expected_patients(export_format, **filters)
+                    self.assertTrue(expected)
+                    self.assertEqual(rows, expected)
+                    # One chunk per partition read from the cursor
+                    self.assertEqual(len(chunks), -(-len(expected) // BATCH_SIZE))
+
+    def test_flow_export_matches_the_flows_of_listed_patients(self):
+        for export_format in exports.EXPORT_FORMATS:
+            for filters in self.filter_cases():
+                with self.subTest(format=export_format, **filters), \
+                        mock.patch.object(exports, "EXPORT_BATCH_SIZE", BATCH_SIZE):
+                    conditions = patient_list_filters(**filters)
+                    chunks, rows = exported(export_patient_flows(conditions, export_format), export_format)
+                    expected = self.expected_flows(export_format, **filters)
+                    self.assertTrue(expected)
+                    self.assertEqual(rows, expected)
+                    self.assertEqual(len(chunks), -(-len(expected) // BATCH_SIZE))
+
+    def test_empty_export_still_has_a_csv_header(self):
+        conditions = patient_list_filters(date_from="1999-01-01", date_to="1999-01-02")
+        self.assertEqual("".join(export_patients(conditions, "csv")).splitlines(),
+                         [",".join(column.key for column in exports.PATIENT_COLUMNS)])
+        self.assertEqual("".join(export_patients(conditions, "ndjson")), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+import asyncio
+import base64
+import inspect
+import unittest
+from datetime import timedelta
+
+from annotated_types import Le
+from fastapi import HTTPException, Response
+from tests.support import reset_database
+from database import SessionLocal, AsyncSessionLocal, Patient, PatientFlow, PatientStatus, get_ist_now
+from pagination import NEXT_CURSOR_HEADER, InvalidCursor, decode_cursor, encode_cursor
+from routers.admin import get_patient_flows
+from routers.patients import get_patients
+
+PATIENTS = 10
+
+
+def list_patients(**params):
+    """One page of get_patients: (patient ids, next cursor)"""
+    arguments = dict(skip=None, limit=None, cursor=None, status=None, latest=False, search=None,
+                     date_from=None, date_to=None, current_user=None)
+    arguments.update(params)
+
+    async def fetch():
+        response = Response()
+        async with AsyncSessionLocal() as db:
+            patients = await get_patients(response=response, db=db, **arguments)
+            return [patient.id for patient in patients], response.headers.get(NEXT_CURSOR_HEADER)
+    return asyncio.run(fetch())
+
+
+def list_flows(**params):
+    arguments = dict(skip=None, limit=3, cursor=None, patient_id=None, opd_type=None, start_date=None,
+                     end_date=None, current_user=None)
+    arguments.update(params)
+
+    async def fetch():
+        response = Response()
+        db = SessionLocal()
+        try:
+            flows = await get_patient_flows(response=response, db=db, **arguments)
+            return [flow.id for flow in flows], response.headers.get(NEXT_CURSOR_HEADER)
+        finally:
+            db.close()
+    return asyncio.run(fetch())
+
+
+class CursorPagingTest(unittest.TestCase):
+    def setUp(self):
+        reset_database()
+        now = get_ist_now()
+        db = SessionLocal()
+        try:
+            # Three share one registration time, so pages have to break ties on id
+            times = [now - timedelta(minutes=minutes) for minutes in (0, 5, 5, 5, 9, 12, 12, 20, 30, 31)]
+            patients = [Patient(token_number=f"T-{i}", name=f"Patient {i}", registration_time=time)
+                        for i, time in enumerate(times)]
+            db.add_all(patients)
+            db.flush()
+            # Flows all written at the same instant
+            db.add_all([PatientFlow(patient_id=patient.id, to_room="registration", status=PatientStatus.PENDING, timestamp=now)
+                        for patient in patients])
+            db.commit()
+            self.expected = [patient.id for patient in sorted(patients, key=lambda p: (p.registration_time, p.id), reverse=True)]
+        finally:
+            db.close()
+
+    def walk(self, fetch):
+        ids, cursor = fetch(cursor=None)
+        pages = 1
+        while cursor:
+            page, cursor = fetch(cursor=cursor)
+            ids += page
+            pages += 1
+            self.assertLess(pages, 20)
+        return ids
+
+    def test_pages_cover_every_patient_once_in_order(self):
+        ids = self.walk(lambda cursor: list_patients(limit=3, cursor=cursor))
+        self.assertEqual(ids, self.expected)
+
+    def test_flows_with_equal_timestamps_page_by_id(self):
+        ids = self.walk(lambda cursor: list_flows(cursor=cursor))
+        self.assertEqual(len(ids), PATIENTS)
+        self.assertEqual(ids, sorted(ids, reverse=True))
+
+    def test_cursor_of_another_list_is_rejected(self):
+        _, cursor = list_flows()
+        with self.assertRaises(HTTPException) as raised:
+            list_patients(limit=3, cursor=cursor)
+        self.assertEqual(raised.exception.status_code, 400)
+
+    def test_tampered_cursor_is_rejected(self):
+        _, cursor = list_patients(limit=3)
+        for tampered in (cursor[:-4], "not-a-cursor", base64.urlsafe_b64encode(b'["patients","yesterday",1]').decode()):
+            with self.subTest(cursor=tampered):
+                with self.assertRaises(HTTPException) as raised:
+                    list_patients(limit=3, cursor=tampered)
+                self.assertEqual(raised.exception.status_code, 400)
+
+    def test_offset_paging_accepts_any_limit(self):
+        limit_query = inspect.signature(get_patients).parameters["limit"].default
+        self.assertFalse(any(isinstance(rule, Le) for rule in limit_query.metadata))
+        ids, cursor = list_patients(skip=0, limit=5000)
+        self.assertEqual(len(ids), PATIENTS)
+        self.assertIsNone(cursor)
+
+
+class CursorEncodingTest(unittest.TestCase):
+    def test_round_trip(self):
+        timestamp = get_ist_now()
+        self.assertEqual(decode_cursor("patients", encode_cursor("patients", timestamp, 42)), (timestamp, 42))
+
+    def test_wrong_kind(self):
+        with self.assertRaises(InvalidCursor):
+            decode_cursor("patients", encode_cursor("patient_flows", get_ist_now(), 1))
+
+    def test_malformed(self):
+        bad_payloads = [b"[]", b'{"a": 1}', b'["patients", "2024-01-01T00:00:00"]', b'["patients", "2024-01-01", "x"]']
+        for payload in bad_payloads:
+            with self.subTest(payload=payload):
+                with self.assertRaises(InvalidCursor):
+                    decode_cursor("patients", base64.urlsafe_b64encode(payload).decode())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import asyncio
+import unittest
+
+from sqlalchemy import select, text
+from tests.support import reset_database
+from database import engine, SessionLocal, AsyncSessionLocal, Patient
+from patient_search import ilike_condition, patient_search
+
+PATIENTS = [
+    ("REG-1001", "Ramesh Kumar", "0001"),
+    ("REG-1002", "Sita Ramesh", "0002"),
+    ("reg-2001", "Anita Sharma", "0003"),
+    (None, "Kumaran Pillai", "0004"),
+    ("REG-3001", "O'Brien \"Bob\"", "0015"),
+]
+
+TERMS = ["ramesh", "RAMESH", "kum", "reg-1", "2001", "000", "0015", "sharma", "'Bri", '"Bob"', "nobody", "ra"]
+
+
+class PatientSearchTest(unittest.TestCase):
+    """The indexed search must find exactly the rows the old ILIKE filter found"""
+
+    def setUp(self):
+        reset_database()
+        with engine.begin() as conn:
+            # drop_all leaves the FTS table behind, with the old patients in it
+            conn.execute(text("DROP TABLE IF EXISTS patients_fts"))
+        patient_search.install()
+        self.assertEqual(patient_search.backend, "fts5")
+        self.db = SessionLocal()
+        self.db.add_all([
+            Patient(registration_number=registration_number, name=name, token_number=token_number)
+            for registration_number, name, token_number in PATIENTS
+        ])
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+        with engine.begin() as conn:
+            conn.execute(text("DROP TABLE IF EXISTS patients_fts"))
+        # Other tests search without the index
+        patient_search.backend = None
+
+    def ids(self, condition):
+        return set(self.db.execute(select(Patient.id).where(condition)).scalars())
+
+    def ranked_ids(self, term):
+        async def search():
+            async with AsyncSessionLocal() as db:
+                return await patient_search.search(db, term, limit=100)
+        return {patient.id for patient, _ in asyncio.run(search())}
+
+    def assertSameRows(self):
+        for term in TERMS:
+            with self.subTest(term=term):
+                expected = self.ids(ilike_condition(term))
+                self.assertEqual(self.ids(patient_search.condition(term)), expected)
+                self.assertEqual(self.ranked_ids(term), expected)
+
+    def test_matches_ilike_filter(self):
+        self.assertSameRows()
+
+    def test_index_follows_updates_and_deletes(self):
+        ramesh = self.db.query(Patient).filter(Patient.token_number == "0001").one()
+        ramesh.name = "Mahesh Verma"
+        self.db.query(Patient).filter(Patient.token_number == "0003").delete()
+        self.db.commit()
+
+        self.assertSameRows()
+        self.assertEqual(self.ids(patient_search.condition("mahesh")), {ramesh.id})
+        self.assertEqual(self.ids(patient_search.condition("sharma")), set())
+
+    def test_exact_token_ranks_first(self):
+        async def search():
+            async with AsyncSessionLocal() as db:
+                return await patient_search.search(db, "0001", limit=10)
+        results = asyncio.run(search())
+        self.assertEqual(results[0][0].token_number, "0001")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import asyncio
+import unittest
+from datetime import timedelta
+from unittest import mock
+
+from tests.support import reset_database, count_statements
+from fastapi import HTTPException
+from database import SessionLocal, AsyncSessionLocal, Patient, Queue, PatientStatus, get_ist_now
+from routers.opd import get_queue_data
+from routers.display import get_waiting_list
+from display_cache import display_cache
+from websocket_manager import get_queue_payload
+
+
+def seed_queues():
+    """Four patients queued in opd1 (registered 30 to 27 minutes ago), one of them also in opd2"""
+    reset_database()
+    now = get_ist_now()
+    db = SessionLocal()
+    try:
+        patients = [
+            Patient(token_number=f"T-{i}", name=f"Patient {i}", registration_time=now - timedelta(minutes=30 - i),
+                    current_status=status, allocated_opd="opd1")
+            for i, status in enumerate([PatientStatus.IN_OPD, PatientStatus.PENDING, PatientStatus.DILATED, PatientStatus.PENDING])
+        ]
+        db.add_all(patients)
+        db.flush()
+        db.add_all([
+            Queue(opd_type="opd1", patient_id=patient.id, position=i + 1, status=patient.current_status)
+            for i, patient in enumerate(patients)
+        ])
+        db.add(Queue(opd_type="opd2", patient_id=patients[3].id, position=1, status=PatientStatus.PENDING))
+        db.commit()
+    finally:
+        db.close()
+
+
+class GetQueueDataTest(unittest.TestCase):
+    def setUp(self):
+        seed_queues()
+
+    def test_queue_is_loaded_with_one_query(self):
+        db = SessionLocal()
+        try:
+            get_queue_data("opd1", db, None)  # Loads the cached active OPD list
+            with count_statements() as statements:
+                queue = get_queue_data("opd1", db, None)
+        finally:
+            db.close()
+
+        self.assertEqual(len(statements), 1, statements)
+        self.assertEqual([entry.token_number for entry in queue], ["T-0", "T-1", "T-2", "T-3"])
+        self.assertEqual([entry.position for entry in queue], [1, 2, 3, 4])
+        self.assertEqual(queue[0].status, PatientStatus.IN_OPD)
+
+    def test_unknown_opd_is_404(self):
+        db = SessionLocal()
+        try:
+            with self.assertRaises(HTTPException) as raised:
+                get_queue_data("opd9", db, None)
+        finally:
+            db.close()
+        self.assertEqual(raised.exception.status_code, 404)
+
+    def test_socket_payload_reuses_the_snapshot(self):
+        db = SessionLocal()
+        try:
+            queue = display_cache.get_snapshot("opd1", db).queue
+            with count_statements() as statements:
+                payload = get_queue_payload("opd1", db)
+        finally:
+            db.close()
+
+        self.assertEqual(statements, [])
+        self.assertEqual([item["token_number"] for item in payload], [entry.token_number for entry in queue])
+        self.assertEqual(payload[0]["registration_time"], queue[0].registration_time.isoformat())
+
+
+class SnapshotWaitingTimeTest(unittest.TestCase):
+    """Cached snapshots must not freeze the waiting minutes they were built with"""
+
+    def setUp(self):
+        seed_queues()
+
+    def test_waiting_minutes_follow_the_clock(self):
+        db = SessionLocal()
+        try:
+            snapshot = display_cache.get_snapshot("opd1", db)
+        finally:
+            db.close()
+        built = snapshot.display
+        later = get_ist_now() + timedelta(minutes=10)
+        with mock.patch("display_cache.get_ist_now", return_value=later):
+            display = snapshot.display
+            payload = snapshot.payload
+
+        self.assertEqual(display.current_patient.waiting_time_minutes, built.current_patient.waiting_time_minutes + 10)
+        self.assertEqual(
+            [item.waiting_time_minutes for item in display.next_patients],
+            [item.waiting_time_minutes + 10 for item in built.next_patients]
+        )
+        self.assertEqual(payload["next_patients"][0]["waiting_time_minutes"], display.next_patients[0].waiting_time_minutes)
+
+    def test_waiting_list_counts_minutes_from_registration(self):
+        async def fetch():
+            async with AsyncSessionLocal() as db:
+                return await get_waiting_list("opd1", db=db)
+
+        later = get_ist_now() + timedelta(minutes=10)
+        with mock.patch("routers.display.get_ist_now", return_value=later):
+            waiting_list = asyncio.run(fetch())["waiting_list"]
+        # Registered 30 to 27 minutes ago
+        self.assertEqual(sorted(item["waiting_time_minutes"] for item in waiting_list), [37, 38, 39, 40])
+
+    def test_display_etag_changes_with_the_minute(self):
+        display_etag = display_cache.etag(["opd1"], scope="display")
+        queue_etag = display_cache.etag(["opd1"], scope="queue")
+        with mock.patch("display_cache.get_ist_now", return_value=get_ist_now() + timedelta(minutes=1)):
+            self.assertNotEqual(display_cache.etag(["opd1"], scope="display"), display_etag)
+            # Queue responses carry registration times, not waiting minutes
+            self.assertEqual(display_cache.etag(["opd1"], scope="queue"), queue_etag)
+
+
+if __name__ == "__main__":
+    unittest.main()
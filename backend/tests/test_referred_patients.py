@@ -0,0 +1,98 @@
+import asyncio
+import unittest
+from datetime import timedelta
+
+from tests.support import reset_database, count_statements
+from database import async_engine, SessionLocal, AsyncSessionLocal, Patient, Queue, PatientStatus, get_ist_now
+from routers.patients import list_referred_patients, load_referred_patients
+
+OPDS = ("opd1", "opd2", "opd3")
+
+
+def refer(token_number, from_opd, to_opd, queue_statuses=(), status=PatientStatus.REFERRED, minutes_ago=0):
+    db = SessionLocal()
+    try:
+        patient = Patient(token_number=token_number, name=f"Patient {token_number}", current_status=status,
+                          referred_from=from_opd, referred_to=to_opd, allocated_opd=to_opd,
+                          registration_time=get_ist_now() - timedelta(minutes=minutes_ago))
+        db.add(patient)
+        db.flush()
+        for position, queue_status in enumerate(queue_statuses, start=1):
+            db.add(Queue(opd_type=to_opd, patient_id=patient.id, position=position, status=queue_status))
+        db.commit()
+        return patient.id
+    finally:
+        db.close()
+
+
+def referred(**params):
+    arguments = dict(from_opd=None, to_opd=None, opd=None, current_user=None)
+    arguments.update(params)
+
+    async def fetch():
+        async with AsyncSessionLocal() as db:
+            return await list_referred_patients(db=db, **arguments)
+    return asyncio.run(fetch())
+
+
+class ReferredPatientsTest(unittest.TestCase):
+    def setUp(self):
+        reset_database(opd_codes=OPDS)
+
+    def test_one_query_for_any_number_of_patients(self):
+        for i in range(30):
+            refer(f"R-{i}", OPDS[i % 3], OPDS[(i + 1) % 3], queue_statuses=[PatientStatus.PENDING] * (i % 2))
+
+        async def load():
+            async with AsyncSessionLocal() as db:
+                with count_statements(async_engine.sync_engine) as statements:
+                    patients = await load_referred_patients(db)
+            return patients, statements
+        patients, statements = asyncio.run(load())
+
+        self.assertEqual(len(patients), 30)
+        self.assertEqual(len(statements), 1)
+
+    def test_queue_status_comes_from_the_destination_opd(self):
+        queued = refer("Q", "opd1", "opd2", queue_statuses=[PatientStatus.IN_OPD, PatientStatus.PENDING], minutes_ago=3)
+        not_queued = refer("N", "opd1", "opd2", minutes_ago=2)
+        other_opd = refer("O", "opd1", "opd3", minutes_ago=1)
+        # A queue row in an OPD other than the destination does not count
+        db = SessionLocal()
+        try:
+            db.add(Queue(opd_type="opd1", patient_id=other_opd, position=1, status=PatientStatus.IN_OPD))
+            db.commit()
+        finally:
+            db.close()
+
+        patients = referred()
+        self.assertEqual([(p.id, p.current_queue_status) for p in patients],
+                         [(queued, "in"), (not_queued, None), (other_opd, None)])
+
+    def test_only_referred_patients_are_listed(self):
+        refer("P", "opd1", "opd2", status=PatientStatus.PENDING)
+        referred_id = refer("R", "opd1", "opd2")
+        self.assertEqual([p.id for p in referred()], [referred_id])
+
+    def test_opd_view_splits_inbound_and_outbound(self):
+        outbound = refer("1-2", "opd1", "opd2", queue_statuses=[PatientStatus.PENDING], minutes_ago=5)
+        inbound = refer("2-1", "opd2", "opd1", queue_statuses=[PatientStatus.IN_OPD], minutes_ago=4)
+        unknown_origin = refer("?-1", None, "opd1", minutes_ago=3)
+        refer("2-3", "opd2", "opd3", minutes_ago=2)
+        # Referred back into the same OPD: inbound only
+        same_opd = refer("1-1", "opd1", "opd1", minutes_ago=1)
+
+        view = referred(opd="opd1")
+        self.assertEqual([p.id for p in view.inbound], [inbound, unknown_origin, same_opd])
+        self.assertEqual([p.id for p in view.outbound], [outbound])
+        self.assertEqual(view.inbound[0].current_queue_status, "in")
+        self.assertEqual(view.outbound[0].current_queue_status, "pending")
+
+        # The same patients as the from_opd / to_opd lists
+        self.assertEqual([p.id for p in referred(to_opd="opd1")], [p.id for p in view.inbound])
+        self.assertEqual([p.id for p in referred(from_opd="opd1") if p.to_opd != "opd1"],
+                         [p.id for p in view.outbound])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+from datetime import timedelta
+
+from tests.support import reset_database
+from database import SessionLocal, RefreshToken, User, UserRole
+from refresh_tokens import (
+    REFRESH_TOKEN_REUSE_GRACE_SECONDS, RefreshTokenError, issue_refresh_token,
+    revoke_refresh_token, rotate_refresh_token,
+)
+
+
+class RotateRefreshTokenTest(unittest.TestCase):
+    def setUp(self):
+        reset_database()
+        self.db = SessionLocal()
+        user = User(username="nurse", email="nurse@example.com", hashed_password="x", role=UserRole.NURSING)
+        self.db.add(user)
+        self.db.flush()
+        self.token, self.entry = issue_refresh_token(self.db, user.id)
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+
+    def live_tokens(self):
+        return self.db.query(RefreshToken).filter(RefreshToken.revoked_at.is_(None)).count()
+
+    def test_reuse_within_grace_window_keeps_the_login(self):
+        _, first = rotate_refresh_token(self.db, self.token)
+        _, second = rotate_refresh_token(self.db, self.token)
+
+        self.assertNotEqual(first, second)
+        # Both tabs can keep refreshing with the token they got
+        rotate_refresh_token(self.db, first)
+        rotate_refresh_token(self.db, second)
+        self.assertEqual(self.live_tokens(), 2)
+
+    def test_reuse_after_grace_window_revokes_the_family(self):
+        _, successor = rotate_refresh_token(self.db, self.token)
+        self.entry.revoked_at -= timedelta(seconds=REFRESH_TOKEN_REUSE_GRACE_SECONDS + 1)
+        self.db.commit()
+
+        with self.assertRaises(RefreshTokenError):
+            rotate_refresh_token(self.db, self.token)
+        with self.assertRaises(RefreshTokenError):
+            rotate_refresh_token(self.db, successor)
+        self.assertEqual(self.live_tokens(), 0)
+
+    def test_reuse_after_logout_is_rejected(self):
+        _, successor = rotate_refresh_token(self.db, self.token)
+        revoke_refresh_token(self.db, successor)
+        self.db.commit()
+
+        with self.assertRaises(RefreshTokenError):
+            rotate_refresh_token(self.db, self.token)
+        self.assertEqual(self.live_tokens(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
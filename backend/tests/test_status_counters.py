@@ -0,0 +1,65 @@
+import unittest
+
+from tests.support import reset_database
+from database import SessionLocal, Patient
+from status_counters import status_counters
+
+
+class RebuildRaceTest(unittest.TestCase):
+    """A registration committed while the counters are recounted must not be lost"""
+
+    def setUp(self):
+        reset_database()
+        self.db = SessionLocal()
+        self.db.add(Patient(token_number="0001", name="Before"))
+        self.db.commit()
+        status_counters.rebuild(self.db)
+
+    def tearDown(self):
+        status_counters.__dict__.pop("_count", None)
+        self.db.close()
+
+    def register_during_count(self):
+        count = type(status_counters)._count
+
+        def racing_count(db):
+            state = count(status_counters, db)
+            other = SessionLocal()
+            try:
+                other.add(Patient(token_number="0002", name="During"))
+                other.commit()
+            finally:
+                other.close()
+            return state
+
+        status_counters._count = racing_count
+
+    def test_rebuild_discards_a_count_that_raced_with_a_commit(self):
+        status_counters.mark_stale()
+        self.register_during_count()
+        status_counters.rebuild(self.db)
+        del status_counters._count
+
+        self.assertIsNone(status_counters.snapshot())
+        self.assertEqual(status_counters.get_summary(self.db).total_patients_today, 2)
+
+    def test_reconcile_keeps_the_counters_that_raced_with_a_commit(self):
+        self.register_during_count()
+        result = status_counters.reconcile(self.db)
+        del status_counters._count
+
+        self.assertFalse(result["compared"])
+        self.assertEqual(status_counters.get_summary(self.db).total_patients_today, 2)
+
+    def test_reconcile_reports_drift_through_last_reconciliation(self):
+        status_counters.apply([("registered_today", None, 1)])
+        result = status_counters.reconcile(self.db)
+
+        self.assertIs(status_counters.last_reconciliation, result)
+        self.assertFalse(result["consistent"])
+        self.assertEqual(result["mismatches"]["registered_today"], {"counter": 2, "recount": 1})
+        self.assertEqual(status_counters.get_summary(self.db).total_patients_today, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
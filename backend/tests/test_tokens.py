@@ -0,0 +1,84 @@
+import threading
+import unittest
+
+from tests.support import reset_database
+from database import SessionLocal, Patient, TokenCounter, get_ist_now
+from tokens import FIRST_TOKEN_NUMBER, format_token, next_token_number
+
+REGISTRATIONS = 40
+
+
+def register_in_parallel(count):
+    """Register `count` patients from as many threads at once; returns (tokens, errors)"""
+    tokens, errors = [], []
+    start = threading.Barrier(count)
+    lock = threading.Lock()
+
+    def register(index):
+        db = SessionLocal()
+        try:
+            start.wait()
+            token_number = next_token_number(db)
+            db.add(Patient(token_number=token_number, name=f"Parallel {index}"))
+            db.commit()
+            with lock:
+                tokens.append(token_number)
+        except Exception as e:
+            db.rollback()
+            with lock:
+                errors.append(e)
+        finally:
+            db.close()
+
+    threads = [threading.Thread(target=register, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return tokens, errors
+
+
+class ConcurrentRegistrationTest(unittest.TestCase):
+    def setUp(self):
+        reset_database()
+        self.day = get_ist_now().strftime("%Y%m%d")
+
+    def assertContiguous(self, tokens, first_number):
+        expected = [format_token(self.day, number) for number in range(first_number, first_number + REGISTRATIONS)]
+        self.assertEqual(len(set(tokens)), len(tokens), "duplicate token numbers")
+        self.assertEqual(sorted(tokens), expected)
+
+    def test_first_tokens_of_the_day(self):
+        tokens, errors = register_in_parallel(REGISTRATIONS)
+        self.assertEqual(errors, [])
+        self.assertContiguous(tokens, FIRST_TOKEN_NUMBER)
+
+    def test_day_started_before_the_counter_existed(self):
+        # Tokens handed out by the old allocator: the counter is seeded from these
+        db = SessionLocal()
+        try:
+            db.add_all([Patient(token_number=format_token(self.day, number), name="Earlier")
+                        for number in range(FIRST_TOKEN_NUMBER, FIRST_TOKEN_NUMBER + 5)])
+            db.commit()
+        finally:
+            db.close()
+
+        tokens, errors = register_in_parallel(REGISTRATIONS)
+        self.assertEqual(errors, [])
+        self.assertContiguous(tokens, FIRST_TOKEN_NUMBER + 5)
+
+    def test_existing_counter(self):
+        db = SessionLocal()
+        try:
+            db.add(TokenCounter(day=self.day, last_number=FIRST_TOKEN_NUMBER + 99))
+            db.commit()
+        finally:
+            db.close()
+
+        tokens, errors = register_in_parallel(REGISTRATIONS)
+        self.assertEqual(errors, [])
+        self.assertContiguous(tokens, FIRST_TOKEN_NUMBER + 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+"""
+Atomic per-day token number allocation.
+
+Token numbers look like YYYYMMDD-1001. Instead of scanning the day's patients
+for the highest token, a row per day in `token_counters` is bumped with a
+single upsert ... RETURNING statement. The row lock (Postgres) or write lock
+(SQLite) serializes concurrent registrations until their transaction commits,
+so two desks can never be handed the same token, and a rolled back
+registration gives its numbers back.
+"""
+
+from typing import List
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from database import Patient, TokenCounter, get_ist_now
+
+FIRST_TOKEN_NUMBER = 1001
+
+
+def format_token(day: str, number: int) -> str:
+    return f"{day}-{number:04d}"
+
+
+def _last_issued_number(db: Session, day: str) -> int:
+    """Highest token already used today, for days that started before the counter existed"""
+    numbers = db.query(Patient.token_number).filter(Patient.token_number.like(f"{day}-%")).all()
+    last_number = FIRST_TOKEN_NUMBER - 1
+    for (token_number,) in numbers:
+        try:
+            last_number = max(last_number, int(token_number.split('-')[-1]))
+        except ValueError:
+            continue
+    return last_number
+
+
+def _bump_counter(db: Session, day: str, count: int) -> int:
+    """Add `count` to the day's counter and return its new value, in one statement"""
+    dialect = db.bind.dialect.name
+    if dialect == "postgresql":
+        insert = postgresql.insert
+    elif dialect == "sqlite":
+        insert = sqlite.insert
+    else:
+        raise RuntimeError(f"Token counter does not support the {dialect} dialect")
+
+    # Fast path: the day's row already exists
+    last_number = db.execute(
+        TokenCounter.__table__.update()
+        .where(TokenCounter.day == day)
+        .values(last_number=TokenCounter.last_number + count)
+        .returning(TokenCounter.last_number)
+    ).scalar()
+    if last_number is not None:
+        return last_number
+
+    # First token of the day; the upsert still wins if another desk created the row meanwhile
+    start = _last_issued_number(db, day)
+    statement = insert(TokenCounter.__table__).values(day=day, last_number=start + count)
+    statement = statement.on_conflict_do_update(
+        index_elements=[TokenCounter.day],
+        set_={"last_number": TokenCounter.last_number + count},
+    ).returning(TokenCounter.last_number)
+    return db.execute(statement).scalar()
+
+
+def reserve_token_numbers(db: Session, count: int) -> List[str]:
+    """
+    Reserve a block of `count` consecutive tokens for today.
+    
+    The reservation belongs to the caller's transaction: it becomes permanent on
+    commit and is released on rollback.
+    """
+    if count < 1:
+        return []
+    day = get_ist_now().strftime("%Y%m%d")
+    last_number = _bump_counter(db, day, count)
+    return [format_token(day, number) for number in range(last_number - count + 1, last_number + 1)]
+
+
+def next_token_number(db: Session) -> str:
+    return reserve_token_numbers(db, 1)[0]
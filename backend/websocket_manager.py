@@ -1,11 +1,31 @@
 import socketio
 from fastapi import Depends
 from sqlalchemy.orm import Session
-from database import get_db, Queue, Patient, PatientStatus
-from typing import List, Dict
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_db, AsyncSessionLocal, Patient, PatientStatus
+from display_cache import display_cache
+from socket_bus import create_client_manager
+from event_outbox import latest_seq, events_since
+from typing import List, Dict, Optional, Tuple, Union
+import asyncio
 import json
+import os
+import time
 
-sio = socketio.AsyncServer(async_mode="asgi",cors_allowed_origins="*")
+# Rooms are shared between worker processes when SOCKETIO_MANAGER selects a message bus (see socket_bus)
+sio = socketio.AsyncServer(async_mode="asgi",cors_allowed_origins="*",client_manager=create_client_manager())
+
+# Push the full display payload with every display_update (set to "false" to only send refetch pings)
+DISPLAY_PUSH_PAYLOAD = os.getenv("DISPLAY_PUSH_PAYLOAD", "true").lower() == "true"
+
+# Changes to the same room within this many milliseconds are sent as one broadcast (0 = send each pass immediately)
+BROADCAST_COALESCE_MS = int(os.getenv("BROADCAST_COALESCE_MS", "150"))
+
+async def run_with_session(db: Union[Session, AsyncSession], fn):
+    """Call fn(session) with a synchronous Session, whichever kind of session the caller has"""
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(fn)
+    return fn(db)
 
 @sio.event
 async def connect(sid, environ):
@@ -31,37 +51,33 @@ async def leave_opd(sid, data):
         sio.leave_room(sid, f"opd_{opd_type}")
         print(f"Client {sid} left OPD {opd_type}")
 
-async def broadcast_queue_update(opd_type: str, db: Session):
-    """Broadcast queue update to all clients in the OPD room"""
-    # Get current queue for the OPD, excluding completed patients
-    queue_entries = db.query(Queue).join(Patient).filter(
-        Queue.opd_type == opd_type,
-        Queue.status.in_([PatientStatus.PENDING, PatientStatus.IN_OPD, PatientStatus.DILATED, PatientStatus.REFERRED]),
-        Patient.current_status != PatientStatus.COMPLETED  # Exclude completed patients
-    ).order_by(Patient.registration_time.asc()).all()
-    
-    queue_data = []
-    for entry in queue_entries:
-        print(f"entry - name: {entry.patient.name} \t status: {entry.status}")
-        queue_data.append({
-            "id": entry.id,
-            "patient_id": entry.patient_id,
-            "token_number": entry.patient.token_number,
-            "patient_name": entry.patient.name,
-            "position": entry.position,
-            "status": entry.status,
-            "registration_time": entry.patient.registration_time.isoformat(),
-            "is_dilated": entry.patient.is_dilated
-        })
+async def broadcast_queue_update(opd_type: str, db: Union[Session, AsyncSession], local_only: bool = False):
+    """Broadcast queue update to all clients in the OPD room (local_only: only this process's clients)"""
+    # Outbox position read first: the queue reflects at least every event up to it
+    seq, queue_data = await run_with_session(db, lambda session: (latest_seq(session), get_queue_payload(opd_type, session)))
     
     await sio.emit('queue_update', {
         'opd_type': opd_type,
-        'queue': queue_data
-    }, room=f"opd_{opd_type}")
+        'queue': queue_data,
+        'seq': seq
+    }, room=f"opd_{opd_type}", ignore_queue=local_only)
+
+def get_queue_payload(opd_type: str, db: Session) -> list:
+    """The OPD's active queue, in display order, from its display snapshot"""
+    return [{
+        "id": entry.id,
+        "patient_id": entry.patient_id,
+        "token_number": entry.token_number,
+        "patient_name": entry.patient_name,
+        "position": entry.position,
+        "status": entry.status,
+        "registration_time": entry.registration_time.isoformat(),
+        "is_dilated": entry.is_dilated
+    } for entry in display_cache.get_snapshot(opd_type, db).queue]
 
-async def broadcast_patient_status_update(patient_id: int, status: PatientStatus, db: Session):
+async def broadcast_patient_status_update(patient_id: int, status: PatientStatus, db: Union[Session, AsyncSession], local_only: bool = False):
     """Broadcast patient status update to all relevant OPDs"""
-    patient = db.query(Patient).filter(Patient.id == patient_id).first()
+    patient = await run_with_session(db, lambda session: session.query(Patient).filter(Patient.id == patient_id).first())
     if not patient:
         return
     
@@ -72,7 +88,7 @@ async def broadcast_patient_status_update(patient_id: int, status: PatientStatus
             'token_number': patient.token_number,
             'status': status,
             'opd_type': patient.allocated_opd
-        }, room=f"opd_{patient.allocated_opd}")
+        }, room=f"opd_{patient.allocated_opd}", ignore_queue=local_only)
     
     # If patient is being referred, also broadcast to target OPD
     if status == PatientStatus.REFERRED and patient.referred_to:
@@ -81,11 +97,29 @@ async def broadcast_patient_status_update(patient_id: int, status: PatientStatus
             'token_number': patient.token_number,
             'from_opd': patient.allocated_opd,
             'to_opd': patient.referred_to
-        }, room=f"opd_{patient.referred_to}")
+        }, room=f"opd_{patient.referred_to}", ignore_queue=local_only)
 
-async def broadcast_display_update():
-    """Broadcast update to all display screens"""
-    await sio.emit('display_update', {'message': 'Queue updated'}, room='displays')
+async def broadcast_display_update(db: Optional[Union[Session, AsyncSession]] = None, local_only: bool = False):
+    """
+    Broadcast update to all display screens.
+    
+    With DISPLAY_PUSH_PAYLOAD enabled the display data is built once here and sent
+    in the event itself, so screens render from the push instead of all refetching
+    over HTTP at the same moment.
+    """
+    if db is not None:
+        await broadcast_display_deltas(db)
+    
+    if DISPLAY_PUSH_PAYLOAD and db is not None:
+        try:
+            seq, payload = await run_with_session(db, lambda session: (latest_seq(session), display_cache.get_all_payload(session)))
+        except Exception as e:
+            print(f"Error building display payload, falling back to refetch ping: {e}")
+        else:
+            await sio.emit('display_update', {'message': 'Queue updated', 'seq': seq, **payload}, room='displays', ignore_queue=local_only)
+            return
+    
+    await sio.emit('display_update', {'message': 'Queue updated'}, room='displays', ignore_queue=local_only)
 
 @sio.event
 async def join_display(sid, data):
@@ -98,3 +132,250 @@ async def leave_display(sid, data):
     """Client leaves display room"""
     sio.leave_room(sid, 'displays')
     print(f"Display client {sid} disconnected")
+
+async def broadcast_display_deltas(db: Union[Session, AsyncSession]):
+    """
+    Send per-OPD delta events to single-OPD display rooms for every OPD that changed.
+    Delta sequence numbers are kept per process, so deltas never go over the shared
+    bus: every worker sends them to its own clients (changes made by other workers
+    arrive through the change feed).
+    """
+    try:
+        deltas = await run_with_session(db, display_cache.collect_deltas)
+    except Exception as e:
+        print(f"Error building display deltas: {e}")
+        return
+    
+    for delta in deltas:
+        await sio.emit('display_delta', delta, room=f"display_{delta['opd_type']}", ignore_queue=True)
+
+async def send_display_snapshot(sid, opd_type: str):
+    """Send the full display state and its sequence number to one client"""
+    try:
+        async with AsyncSessionLocal() as db:
+            # Flush pending deltas first so the snapshot's sequence number is current
+            await broadcast_display_deltas(db)
+            seq, payload = await db.run_sync(lambda session: display_cache.get_published(opd_type, session))
+    except Exception as e:
+        print(f"Error building display snapshot for {opd_type}: {e}")
+        return
+    
+    await sio.emit('display_snapshot', {
+        'opd_type': opd_type,
+        'seq': seq,
+        'data': payload
+    }, room=sid)
+
+@sio.event
+async def join_opd_display(sid, data):
+    """Single-OPD display joins its OPD's display room and receives a full snapshot"""
+    opd_type = (data or {}).get('opd_type')
+    if opd_type:
+        opd_type = opd_type.lower()
+        sio.enter_room(sid, f"display_{opd_type}")
+        print(f"Display client {sid} joined OPD display {opd_type}")
+        await send_display_snapshot(sid, opd_type)
+
+@sio.event
+async def leave_opd_display(sid, data):
+    """Single-OPD display leaves its OPD's display room"""
+    opd_type = (data or {}).get('opd_type')
+    if opd_type:
+        sio.leave_room(sid, f"display_{opd_type.lower()}")
+
+@sio.event
+async def display_resync(sid, data):
+    """Client detected a sequence gap and asks for a full snapshot"""
+    opd_type = (data or {}).get('opd_type')
+    if opd_type:
+        await send_display_snapshot(sid, opd_type.lower())
+
+def build_resume_result(db: Session, last_seq: Optional[int], opd_types: List[str], display: bool) -> dict:
+    """Events missed since last_seq for these rooms, or a snapshot of them if that can't be answered"""
+    seq = latest_seq(db)
+    events = events_since(db, last_seq, None if display else opd_types)
+    # Screens can't apply flow events themselves, so any missed event means a fresh display payload
+    if events is not None and not (display and events):
+        return {'seq': seq, 'events': events}
+    
+    snapshot = {'queues': {
+        opd_type: [entry.model_dump(mode="json") for entry in display_cache.get_snapshot(opd_type, db).queue]
+        for opd_type in opd_types
+    }}
+    if display:
+        snapshot['display'] = display_cache.get_all_payload(db)
+    return {'seq': seq, 'snapshot': snapshot}
+
+@sio.event
+async def resume(sid, data):
+    """
+    Reconnected client: rejoin its rooms and answer (as the ack) with what it missed
+    since last_seq. Snapshots come from the shared display cache, so a reconnect
+    storm costs one rebuild per OPD rather than a round of queue queries per client.
+    """
+    data = data or {}
+    opd_types = [opd_type for opd_type in (data.get('opd_types') or []) if opd_type]
+    display = bool(data.get('display'))
+    for opd_type in opd_types:
+        sio.enter_room(sid, f"opd_{opd_type}")
+    if display:
+        sio.enter_room(sid, 'displays')
+    
+    try:
+        async with AsyncSessionLocal() as db:
+            return await db.run_sync(lambda session: build_resume_result(session, data.get('last_seq'), opd_types, display))
+    except Exception as e:
+        print(f"Error resuming client {sid}: {e}")
+        return {'seq': None}
+
+class BroadcastDispatcher:
+    """
+    Runs queue, patient and display broadcasts in the background.
+
+    Mutating endpoints record what changed once they have committed and return
+    straight away, so their response time no longer includes rebuilding queues
+    and fanning events out. A single worker does the rebuilds and emits, using
+    its own database session.
+
+    Each room (an OPD queue, a patient's status, the displays) is sent at most
+    once per coalescing window: the first change opens the window, further
+    changes to that room within it are folded in, and when it closes the room
+    is rebuilt and emitted once with the latest state. A single referral, which
+    touches two queues, a status and the displays, then costs one emit per room
+    even in the middle of a burst.
+
+    Changes passed with local_only (seen on the change feed, where every worker
+    sees them) are only sent to this process's own clients, unless the room
+    also has a change of our own pending.
+    """
+
+    def __init__(self, window_seconds: float):
+        self.window_seconds = window_seconds
+        self._due: Dict[Tuple[str, object], float] = {}  # (kind, key) -> when its window closes
+        self._statuses: Dict[int, PatientStatus] = {}  # patient_id -> latest status
+        self._local_only: set = set()  # pending keys that only need our own clients
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        # Metrics, per room
+        self.received: Dict[str, int] = {}
+        self.emitted: Dict[str, int] = {}
+        self.coalesced = 0
+        self.errors = 0
+
+    def queue_changed(self, *opd_types: Optional[str], local_only: bool = False):
+        for opd_type in opd_types:
+            if opd_type:
+                self._add(("queue", opd_type), local_only)
+
+    def patient_status_changed(self, patient_id: int, status: PatientStatus, local_only: bool = False):
+        self._statuses[patient_id] = status
+        self._add(("patient", patient_id), local_only)
+
+    def display_changed(self, local_only: bool = False):
+        self._add(("display", None), local_only)
+
+    def display_deltas_changed(self):
+        """Only the per-OPD display deltas, for changes whose other broadcasts came over the bus"""
+        self._add(("deltas", None), local_only=True)
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except (asyncio.CancelledError, RuntimeError):
+            pass
+        self._task = None
+
+    @staticmethod
+    def _room(key: Tuple[str, object]) -> str:
+        kind, value = key
+        if kind == "queue":
+            return f"opd_{value}"
+        if kind == "patient":
+            return "patient_status"
+        if kind == "deltas":
+            return "display_deltas"
+        return "displays"
+
+    def _add(self, key: Tuple[str, object], local_only: bool = False):
+        room = self._room(key)
+        self.received[room] = self.received.get(room, 0) + 1
+        if key in self._due:
+            self.coalesced += 1
+            if not local_only:
+                self._local_only.discard(key)
+        else:
+            self._due[key] = time.monotonic() + self.window_seconds
+            if local_only:
+                self._local_only.add(key)
+        self.start()
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            if not self._due:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            # Windows all have the same length, so a later change never closes earlier
+            delay = min(self._due.values()) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            now = time.monotonic()
+            ready = [key for key, due in self._due.items() if due <= now]
+            for key in ready:
+                del self._due[key]
+            statuses = {key[1]: self._statuses.pop(key[1]) for key in ready if key[0] == "patient"}
+            local_only = self._local_only.intersection(ready)
+            self._local_only.difference_update(local_only)
+            await self._emit(ready, statuses, local_only)
+
+    async def _emit(self, ready: List[Tuple[str, object]], statuses: Dict[int, PatientStatus], local_only: set):
+        # Same order as the handlers used to broadcast in: queues, then statuses, then displays
+        order = {"queue": 0, "patient": 1, "display": 2, "deltas": 3}
+        async with AsyncSessionLocal() as db:
+            for key in sorted(ready, key=lambda key: order[key[0]]):
+                kind, value = key
+                try:
+                    if kind == "queue":
+                        await broadcast_queue_update(value, db, key in local_only)
+                    elif kind == "patient":
+                        await broadcast_patient_status_update(value, statuses[value], db, key in local_only)
+                    elif kind == "deltas":
+                        await broadcast_display_deltas(db)
+                    else:
+                        await broadcast_display_update(db, key in local_only)
+                except Exception as e:
+                    self.errors += 1
+                    print(f"Error broadcasting {kind} update ({value}): {e}")
+                    continue
+                room = self._room(key)
+                self.emitted[room] = self.emitted.get(room, 0) + 1
+
+    def metrics(self) -> dict:
+        received = sum(self.received.values())
+        emitted = sum(self.emitted.values())
+        return {
+            "window_ms": round(self.window_seconds * 1000),
+            "pending": len(self._due),
+            "received": received,
+            "emitted": emitted,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "rooms": {
+                room: {"received": count, "emitted": self.emitted.get(room, 0)}
+                for room, count in sorted(self.received.items())
+            },
+        }
+
+
+broadcast_dispatcher = BroadcastDispatcher(BROADCAST_COALESCE_MS / 1000)
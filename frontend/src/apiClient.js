@@ -30,6 +30,51 @@ apiClient.interceptors.request.use((config) => {
   return config;
 });
 
+// Renew an expired access token with the refresh token. Requests that fail
+// together share one refresh call, since every refresh rotates the token.
+let refreshPromise = null;
+
+const refreshAccessToken = () => {
+  if (!refreshPromise) {
+    const refreshToken = localStorage.getItem('refresh_token');
+    const request = refreshToken
+      ? axios.post(`${API_BASE_URL}/api/auth/refresh`, { refresh_token: refreshToken })
+      : Promise.reject(new Error('No refresh token'));
+    refreshPromise = request
+      .then((response) => {
+        const { access_token, refresh_token, allowed_opds } = response.data;
+        localStorage.setItem('token', access_token);
+        localStorage.setItem('refresh_token', refresh_token);
+        localStorage.setItem('allowed_opds', JSON.stringify(allowed_opds || []));
+        return access_token;
+      })
+      .finally(() => {
+        refreshPromise = null;
+      });
+  }
+  return refreshPromise;
+};
+
+apiClient.interceptors.response.use(
+  (response) => response,
+  async (error) => {
+    const original = error.config;
+    const isAuthCall = original?.url?.startsWith('/auth/login') || original?.url?.startsWith('/auth/refresh');
+    if (error.response?.status === 401 && original && !original._retried && !isAuthCall) {
+      original._retried = true;
+      try {
+        const token = await refreshAccessToken();
+        original.headers = original.headers || {};
+        original.headers.Authorization = `Bearer ${token}`;
+        return apiClient(original);
+      } catch (refreshError) {
+        localStorage.removeItem('refresh_token');
+      }
+    }
+    return Promise.reject(error);
+  }
+);
+
 export default apiClient;
 
 
@@ -26,12 +26,59 @@ import { useAuth } from '../contexts/AuthContext';
 import apiClient from '../apiClient';
 // Navbar removed - public display doesn't need authentication UI
 
+// Apply a display_delta event (changes keyed by token number) to the previous OPD payload
+const applyDisplayDelta = (previous, delta) => {
+  const items = {};
+  const previousNext = previous.next_patients || [];
+  if (previous.current_patient) {
+    items[previous.current_patient.token_number] = previous.current_patient;
+  }
+  previousNext.forEach((item) => {
+    items[item.token_number] = item;
+  });
+  (delta.removed || []).forEach((token) => {
+    delete items[token];
+  });
+  [...(delta.added || []), ...(delta.updated || [])].forEach((item) => {
+    items[item.token_number] = { ...items[item.token_number], ...item };
+  });
+
+  const currentToken = 'current_token' in delta
+    ? delta.current_token
+    : previous.current_patient?.token_number;
+  const nextOrder = delta.order || previousNext.map((item) => item.token_number);
+  const currentPatient = currentToken && items[currentToken] ? { ...items[currentToken], position: 1 } : null;
+  const nextPatients = nextOrder
+    .filter((token) => items[token])
+    .map((token, index) => ({ ...items[token], position: index + (currentPatient ? 2 : 1) }));
+
+  return {
+    ...previous,
+    current_patient: currentPatient,
+    next_patients: nextPatients,
+    total_patients: delta.total_patients ?? previous.total_patients,
+    estimated_wait_time: delta.estimated_wait_time ?? previous.estimated_wait_time,
+  };
+};
+
 const DisplayScreen = ({ opdCode = null }) => {
   const navigate = useNavigate();
   const theme = useTheme();
   const isMobile = useMediaQuery(theme.breakpoints.down('sm'));
   const isTablet = useMediaQuery(theme.breakpoints.between('sm', 'md'));
-  const { joinDisplay, leaveDisplay, onDisplayUpdate, removeAllListeners } = useSocket();
+  const {
+    connected,
+    joinDisplay,
+    leaveDisplay,
+    joinOPDDisplay,
+    leaveOPDDisplay,
+    requestDisplayResync,
+    onDisplayUpdate,
+    onDisplayDelta,
+    onDisplaySnapshot,
+    onResume,
+    removeAllListeners,
+  } = useSocket();
   const { allActiveOPDs, getOPDByCode, loading: opdsLoading } = useOPD();
   const { user, allowedOPDs, loading: authLoading } = useAuth();
   const [displayData, setDisplayData] = useState(null);
@@ -40,6 +87,10 @@ const DisplayScreen = ({ opdCode = null }) => {
   const [lastUpdated, setLastUpdated] = useState(null);
   const isMountedRef = React.useRef(true);
   const hasValidatedRef = React.useRef(false);
+  const connectedRef = React.useRef(connected);
+  // Single-OPD delta sync state: last applied sequence number (null = waiting for a snapshot)
+  const displaySeqRef = React.useRef(null);
+  const opdPayloadRef = React.useRef(null);
 
   // Reset validation when opdCode changes
   useEffect(() => {
@@ -121,6 +172,80 @@ const DisplayScreen = ({ opdCode = null }) => {
     }
   }, [opdCode]);
 
+  // Render straight from a pushed display_update payload (no HTTP round trip)
+  // Returns false if the event carried no data, so the caller can refetch instead
+  const applyPushedDisplayData = useCallback((data) => {
+    if (!data || !Array.isArray(data.opds)) {
+      return false;
+    }
+    const normalizedOpdCode = opdCode?.toLowerCase();
+    if (!isMountedRef.current) {
+      return true;
+    }
+    if (normalizedOpdCode) {
+      const opdData = data.opds.find((opd) => opd.opd_type === normalizedOpdCode);
+      if (!opdData) {
+        return false;
+      }
+      setDisplayData({ opds: [opdData], isSingleOPD: true });
+    } else {
+      setDisplayData({ ...data, isSingleOPD: false });
+    }
+    setLastUpdated(new Date());
+    setError(null);
+    setLoading(false);
+    return true;
+  }, [opdCode]);
+
+  // Single-OPD screens: full state from display_snapshot, then sequenced display_delta events
+  const applyDisplaySnapshot = useCallback((snapshot) => {
+    if (!snapshot || snapshot.opd_type !== opdCode?.toLowerCase() || !isMountedRef.current) {
+      return;
+    }
+    displaySeqRef.current = snapshot.seq;
+    opdPayloadRef.current = snapshot.data;
+    setDisplayData({ opds: [snapshot.data], isSingleOPD: true });
+    setLastUpdated(new Date());
+    setError(null);
+    setLoading(false);
+  }, [opdCode]);
+
+  const handleDisplayDelta = useCallback((delta) => {
+    const normalizedOpdCode = opdCode?.toLowerCase();
+    if (!delta || delta.opd_type !== normalizedOpdCode || !isMountedRef.current) {
+      return;
+    }
+    const currentSeq = displaySeqRef.current;
+    if (currentSeq === null || delta.seq <= currentSeq) {
+      return; // Waiting for a snapshot, or an old delta already included in it
+    }
+    if (delta.base_seq !== currentSeq || !opdPayloadRef.current) {
+      console.warn(`⚠️ Display delta gap for ${normalizedOpdCode} (have ${currentSeq}, got ${delta.seq}), resyncing`);
+      displaySeqRef.current = null;
+      requestDisplayResync(normalizedOpdCode);
+      return;
+    }
+    const updated = applyDisplayDelta(opdPayloadRef.current, delta);
+    displaySeqRef.current = delta.seq;
+    opdPayloadRef.current = updated;
+    setDisplayData({ opds: [updated], isSingleOPD: true });
+    setLastUpdated(new Date());
+  }, [opdCode, requestDisplayResync]);
+
+  // Rejoin the single-OPD display room whenever the socket (re)connects, since pushes sent
+  // while disconnected were missed; the room answers the join with a full snapshot.
+  // The all-OPDs room is rejoined by the socket's resume, answered in onResume below.
+  useEffect(() => {
+    connectedRef.current = connected;
+    if (connected && hasValidatedRef.current) {
+      const normalizedOpdCode = opdCode?.toLowerCase();
+      if (normalizedOpdCode) {
+        displaySeqRef.current = null;
+        joinOPDDisplay(normalizedOpdCode);
+      }
+    }
+  }, [connected, opdCode, joinOPDDisplay]);
+
   // Main effect: Validate, fetch data, and set up real-time updates
   useEffect(() => {
     // Wait for OPDs to load before proceeding
@@ -149,11 +274,28 @@ const DisplayScreen = ({ opdCode = null }) => {
     // Initial data fetch
     fetchDisplayData();
     
-    // Join display room for real-time updates
-    joinDisplay();
+    // Join display room for real-time updates (per-OPD room for single-OPD screens)
+    if (normalizedOpdCode) {
+      displaySeqRef.current = null;
+      joinOPDDisplay(normalizedOpdCode);
+      onDisplaySnapshot(applyDisplaySnapshot);
+      onDisplayDelta(handleDisplayDelta);
+    } else {
+      joinDisplay();
+      // After a reconnect: nothing missed, a fresh payload, or (no answer) refetch
+      onResume((result) => {
+        if (Array.isArray(result?.events) || applyPushedDisplayData(result?.snapshot?.display)) {
+          return;
+        }
+        fetchDisplayData();
+      });
+    }
     
     // Set up real-time updates
     onDisplayUpdate((data) => {
+      if (applyPushedDisplayData(data)) {
+        return;
+      }
       console.log('🔄 Display update triggered, fetching fresh data...', data);
       // If single OPD mode, only update if it's for this OPD or if opdCode not in event
       if (normalizedOpdCode && data?.opdCode) {
@@ -166,20 +308,69 @@ const DisplayScreen = ({ opdCode = null }) => {
       fetchDisplayData();
     });
 
-    // Auto-refresh every 5 seconds (reduced from 30s for better responsiveness)
-    const interval = setInterval(() => {
-      console.log('⏰ Auto-refresh triggered');
-      fetchDisplayData();
-    }, 5000);
+    // Fallback while the socket is down: single-OPD screens long-poll for changes
+    // (the server answers as soon as the OPD changes), the all-OPDs screen polls every 5 seconds
+    let stopped = false;
+    const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+    // Never ask more often than this, even if every answer comes back straight away
+    const MIN_LONG_POLL_INTERVAL_MS = 1000;
+    const longPoll = async () => {
+      let version = null;
+      while (!stopped) {
+        if (connectedRef.current) {
+          version = null;
+          await sleep(5000);
+          continue;
+        }
+        const startedAt = Date.now();
+        try {
+          const response = await apiClient.get(`/display/opd/${normalizedOpdCode}/changes`, {
+            params: version ? { since: version } : {},
+            timeout: 70000
+          });
+          // 204: nothing changed before the server's timeout, ask again
+          if (response.status === 200 && response.data && !stopped) {
+            version = response.data.version;
+            applyPushedDisplayData({ opds: [response.data.data] });
+          }
+        } catch (error) {
+          console.error('Display long poll failed:', error);
+          await sleep(5000);
+        }
+        const elapsed = Date.now() - startedAt;
+        if (elapsed < MIN_LONG_POLL_INTERVAL_MS) {
+          await sleep(MIN_LONG_POLL_INTERVAL_MS - elapsed);
+        }
+      }
+    };
+    let interval = null;
+    if (normalizedOpdCode) {
+      longPoll();
+    } else {
+      interval = setInterval(() => {
+        if (connectedRef.current) {
+          return;
+        }
+        console.log('⏰ Auto-refresh triggered');
+        fetchDisplayData();
+      }, 5000);
+    }
 
     // Cleanup
     return () => {
       console.log('🧹 Cleaning up display screen');
-      leaveDisplay();
+      if (normalizedOpdCode) {
+        leaveOPDDisplay(normalizedOpdCode);
+      } else {
+        leaveDisplay();
+      }
       removeAllListeners();
-      clearInterval(interval);
+      stopped = true;
+      if (interval) {
+        clearInterval(interval);
+      }
     };
-  }, [opdCode, opdsLoading, authLoading, allActiveOPDs.length, fetchDisplayData, joinDisplay, leaveDisplay, onDisplayUpdate, removeAllListeners, getOPDByCode]);
+  }, [opdCode, opdsLoading, authLoading, allActiveOPDs.length, fetchDisplayData, applyPushedDisplayData, applyDisplaySnapshot, handleDisplayDelta, joinDisplay, leaveDisplay, joinOPDDisplay, leaveOPDDisplay, onDisplayUpdate, onDisplayDelta, onDisplaySnapshot, onResume, removeAllListeners, getOPDByCode]);
 
   const getStatusColor = (status) => {
     const statusColors = {
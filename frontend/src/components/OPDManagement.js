@@ -46,7 +46,7 @@ import Navbar from './Navbar';
 
 const OPDManagement = () => {
   const navigate = useNavigate();
-  const { joinOPD, leaveOPD, onQueueUpdate, removeAllListeners } = useSocket();
+  const { joinOPD, leaveOPD, onQueueUpdate, onResume, removeAllListeners } = useSocket();
   const { showSuccess, showError } = useNotification();
   const { activeOPDs, allActiveOPDs, getOPDByCode } = useOPD();
   const [selectedOpd, setSelectedOpd] = useState('');
@@ -92,6 +92,20 @@ const OPDManagement = () => {
         }
       });
 
+      // After a reconnect, only refresh if something happened to this OPD meanwhile
+      onResume((result) => {
+        const snapshotQueue = result?.snapshot?.queues?.[selectedOpd];
+        if (snapshotQueue) {
+          setQueue(snapshotQueue);
+        } else if (Array.isArray(result?.events) && result.events.length === 0) {
+          return;
+        } else {
+          fetchQueueData();
+        }
+        fetchStats();
+        fetchReferred();
+      });
+
       return () => {
         leaveOPD(selectedOpd);
         removeAllListeners();
@@ -141,15 +155,12 @@ const OPDManagement = () => {
       return;
     }
     try {
-      //console.log(`\n\nFetching referred patients from ${selectedOpd}`);
-      //console.log(`\n\nFetching referred patients to ${selectedOpd}`);
-      const [fromResp, toResp] = await Promise.all([
-        apiClient.get(`/patients/referred`, { params: { from_opd: selectedOpd } }),
-        apiClient.get(`/patients/referred`, { params: { to_opd: selectedOpd } })
-      ]);
+      //console.log(`\n\nFetching referred patients from and to ${selectedOpd}`);
+      // Both directions in one request
+      const response = await apiClient.get(`/patients/referred`, { params: { opd: selectedOpd } });
       // Ensure data is an array
-      const fromData = Array.isArray(fromResp.data) ? fromResp.data : [];
-      const toData = Array.isArray(toResp.data) ? toResp.data : [];
+      const fromData = Array.isArray(response.data?.outbound) ? response.data.outbound : [];
+      const toData = Array.isArray(response.data?.inbound) ? response.data.inbound : [];
       //console.log('Referred FROM data:', fromData);
       //console.log('Referred TO data:', toData);
       setReferredFromHere(fromData);
@@ -43,6 +43,7 @@ const PatientRegistration = () => {
   });
   const [patients, setPatients] = useState([]);
   const [all_patients, setAllPatients] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null); // Position of the next page of all_patients, if any
   const [loading, setLoading] = useState(false);
   const [selectedPatient, setSelectedPatient] = useState(null);
   const [opdDialogOpen, setOpdDialogOpen] = useState(false);
@@ -66,15 +67,17 @@ const PatientRegistration = () => {
     }
   };
 
-  const fetchAllPatients = async () => {
+  const fetchAllPatients = async (cursor = null) => {
     try {
       const params = { latest: false };
       if (searchTerm) params.search = searchTerm;
       if (dateFrom) params.date_from = dateFrom;
       if (dateTo) params.date_to = dateTo;
+      if (cursor) params.cursor = cursor;
 
       const response = await apiClient.get('/patients', { params });
-      setAllPatients(response.data);
+      setAllPatients(prev => (cursor ? [...prev, ...response.data] : response.data));
+      setNextCursor(response.headers['x-next-cursor'] || null);
     } catch (error) {
       console.error('Failed to fetch all patients:', error);
     }
@@ -300,7 +303,7 @@ const PatientRegistration = () => {
             <Card>
               <CardContent>
                 <Typography variant="h6" gutterBottom>
-                  All Patients ({all_patients.length} found)
+                  All Patients ({all_patients.length}{nextCursor ? '+' : ''} found)
                 </Typography>
                 
                 {/* Search and Filter Controls */}
@@ -405,6 +408,13 @@ const PatientRegistration = () => {
                       </ListItem>
                     ))}
                   </List>
+                  {nextCursor && (
+                    <Box display="flex" justifyContent="center" sx={{ my: 1 }}>
+                      <Button size="small" onClick={() => fetchAllPatients(nextCursor)}>
+                        Load more
+                      </Button>
+                    </Box>
+                  )}
                 </Box>
               </CardContent>
             </Card>
@@ -49,11 +49,14 @@ export const AuthProvider = ({ children }) => {
         password,
       });
       
-      const { access_token, user: userData, allowed_opds } = response.data;
+      const { access_token, refresh_token, user: userData, allowed_opds } = response.data;
       
-      // Store token
+      // Store token (the refresh token renews it when it expires, see apiClient)
       setToken(access_token);
       localStorage.setItem('token', access_token);
+      if (refresh_token) {
+        localStorage.setItem('refresh_token', refresh_token);
+      }
       
       // Store user data
       setUser(userData);
@@ -77,6 +80,12 @@ export const AuthProvider = ({ children }) => {
   };
 
   const logout = () => {
+    const refreshToken = localStorage.getItem('refresh_token');
+    if (refreshToken) {
+      // Revoke server-side; the local session ends either way
+      apiClient.post('/auth/logout', { refresh_token: refreshToken }).catch(() => {});
+      localStorage.removeItem('refresh_token');
+    }
     setUser(null);
     setToken(null);
     setAllowedOPDs([]);
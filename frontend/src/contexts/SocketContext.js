@@ -18,8 +18,21 @@ export const SocketProvider = ({ children }) => {
     queue_update: [],
     patient_status_update: [],
     display_update: [],
-    patient_referral: []
+    display_delta: [],
+    display_snapshot: [],
+    patient_referral: [],
+    resume: []
   });
+  // Rooms to be in (rejoined on every reconnect) and the last event seq our data reflects
+  const joinedOPDsRef = useRef(new Set());
+  const displayJoinedRef = useRef(false);
+  const lastSeqRef = useRef(null);
+
+  const trackSeq = (data) => {
+    if (data && typeof data.seq === 'number' && (lastSeqRef.current === null || data.seq > lastSeqRef.current)) {
+      lastSeqRef.current = data.seq;
+    }
+  };
 
   useEffect(() => {
     // Connect to Socket.IO server
@@ -43,6 +56,21 @@ export const SocketProvider = ({ children }) => {
     socketInstance.on('connect', () => {
       console.log('✅ Socket.IO connected:', socketInstance.id);
       setConnected(true);
+
+      // Rejoin our rooms and get only what was missed while disconnected
+      // (or a snapshot, if the gap is too large or we never had a position)
+      const opdTypes = Array.from(joinedOPDsRef.current);
+      if (opdTypes.length > 0 || displayJoinedRef.current) {
+        socketInstance.emit('resume', {
+          last_seq: lastSeqRef.current,
+          opd_types: opdTypes,
+          display: displayJoinedRef.current
+        }, (result) => {
+          console.log('🔁 Resumed:', result);
+          trackSeq(result);
+          callbacksRef.current.resume.forEach(callback => callback(result));
+        });
+      }
     });
 
     socketInstance.on('disconnect', (reason) => {
@@ -58,6 +86,7 @@ export const SocketProvider = ({ children }) => {
     // Set up event listeners
     socketInstance.on('queue_update', (data) => {
       console.log('📢 Queue update received:', data);
+      trackSeq(data);
       callbacksRef.current.queue_update.forEach(callback => callback(data));
     });
 
@@ -68,9 +97,20 @@ export const SocketProvider = ({ children }) => {
 
     socketInstance.on('display_update', (data) => {
       console.log('📢 Display update received:', data);
+      trackSeq(data);
       callbacksRef.current.display_update.forEach(callback => callback(data));
     });
 
+    socketInstance.on('display_delta', (data) => {
+      console.log('📢 Display delta received:', data);
+      callbacksRef.current.display_delta.forEach(callback => callback(data));
+    });
+
+    socketInstance.on('display_snapshot', (data) => {
+      console.log('📢 Display snapshot received:', data);
+      callbacksRef.current.display_snapshot.forEach(callback => callback(data));
+    });
+
     socketInstance.on('patient_referral', (data) => {
       console.log('📢 Patient referral received:', data);
       callbacksRef.current.patient_referral.forEach(callback => callback(data));
@@ -85,6 +125,7 @@ export const SocketProvider = ({ children }) => {
   }, []);
 
   const joinOPD = (opdType) => {
+    joinedOPDsRef.current.add(opdType);
     if (socket && connected) {
       socket.emit('join_opd', { opd_type: opdType });
       console.log(`✅ Joined OPD: ${opdType}`);
@@ -94,6 +135,7 @@ export const SocketProvider = ({ children }) => {
   };
 
   const leaveOPD = (opdType) => {
+    joinedOPDsRef.current.delete(opdType);
     if (socket && connected) {
       socket.emit('leave_opd', { opd_type: opdType });
       console.log(`👋 Left OPD: ${opdType}`);
@@ -101,6 +143,7 @@ export const SocketProvider = ({ children }) => {
   };
 
   const joinDisplay = () => {
+    displayJoinedRef.current = true;
     if (socket && connected) {
       socket.emit('join_display', {});
       console.log('✅ Joined display room');
@@ -110,12 +153,37 @@ export const SocketProvider = ({ children }) => {
   };
 
   const leaveDisplay = () => {
+    displayJoinedRef.current = false;
     if (socket && connected) {
       socket.emit('leave_display', {});
       console.log('👋 Left display room');
     }
   };
 
+  // Single-OPD displays use a per-OPD room that receives sequenced deltas
+  const joinOPDDisplay = (opdType) => {
+    if (socket && connected) {
+      socket.emit('join_opd_display', { opd_type: opdType });
+      console.log(`✅ Joined OPD display room: ${opdType}`);
+    } else {
+      console.warn('❌ Cannot join OPD display - socket not connected');
+    }
+  };
+
+  const leaveOPDDisplay = (opdType) => {
+    if (socket && connected) {
+      socket.emit('leave_opd_display', { opd_type: opdType });
+      console.log(`👋 Left OPD display room: ${opdType}`);
+    }
+  };
+
+  const requestDisplayResync = (opdType) => {
+    if (socket && connected) {
+      socket.emit('display_resync', { opd_type: opdType });
+      console.log(`🔁 Requested display resync: ${opdType}`);
+    }
+  };
+
   const onQueueUpdate = (callback) => {
     if (!callbacksRef.current.queue_update.includes(callback)) {
       callbacksRef.current.queue_update.push(callback);
@@ -134,18 +202,39 @@ export const SocketProvider = ({ children }) => {
     }
   };
 
+  const onDisplayDelta = (callback) => {
+    if (!callbacksRef.current.display_delta.includes(callback)) {
+      callbacksRef.current.display_delta.push(callback);
+    }
+  };
+
+  const onDisplaySnapshot = (callback) => {
+    if (!callbacksRef.current.display_snapshot.includes(callback)) {
+      callbacksRef.current.display_snapshot.push(callback);
+    }
+  };
+
   const onPatientReferral = (callback) => {
     if (!callbacksRef.current.patient_referral.includes(callback)) {
       callbacksRef.current.patient_referral.push(callback);
     }
   };
 
+  const onResume = (callback) => {
+    if (!callbacksRef.current.resume.includes(callback)) {
+      callbacksRef.current.resume.push(callback);
+    }
+  };
+
   const removeAllListeners = () => {
     callbacksRef.current = {
       queue_update: [],
       patient_status_update: [],
       display_update: [],
-      patient_referral: []
+      display_delta: [],
+      display_snapshot: [],
+      patient_referral: [],
+      resume: []
     };
   };
 
@@ -156,10 +245,16 @@ export const SocketProvider = ({ children }) => {
     leaveOPD,
     joinDisplay,
     leaveDisplay,
+    joinOPDDisplay,
+    leaveOPDDisplay,
+    requestDisplayResync,
     onQueueUpdate,
     onPatientStatusUpdate,
     onDisplayUpdate,
+    onDisplayDelta,
+    onDisplaySnapshot,
     onPatientReferral,
+    onResume,
     removeAllListeners,
   };
 